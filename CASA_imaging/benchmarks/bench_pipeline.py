@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+'''
+
+Benchmarks the orchestration of casa_image_ms.py with mock CASA tasks
+
+A night of synthetic measurement sets and a mask catalogue are written to a
+scratch folder, then casa_image_ms.py is run through the mock casa launcher
+(see mock_casa) in several scenarios:
+
+    serial      one process, measures the driver overhead per file
+    workers N   N worker processes, measures the scheduling efficiency
+    rerun       the same run again, measures the run manifest hit rate
+    shared cal  a new run with the same calibration, measures the
+                calibration cache hit rate
+
+To run (in terminal):
+python bench_pipeline.py --files 24 --size-mb 16 --workers 2 4 8 --scale 0.01
+
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+MOCK_CASA = os.path.join(BENCH_DIR, 'mock_casa', 'casa')
+SCRIPT = os.path.join(os.path.dirname(BENCH_DIR), 'casa_image_ms.py')
+
+sys.path.insert(0, os.path.join(BENCH_DIR, 'mock_casa'))
+from casa import make_ms
+
+
+def make_night(root, n_files, size_mb, n_sources, seed=0):
+    '''
+    Writes a night of synthetic measurement sets and a mask catalogue
+
+    The files are 10 minutes apart in time and 2.5 degrees apart in phase
+    centre right ascension, as for a HERA drift scan.
+
+    Returns
+    -------
+    folders : list
+        measurement set file names
+    sources_file : str
+        mask catalogue in the format of imaging_runs/*/mask_sources.json
+    '''
+    rng = np.random.RandomState(seed)
+    data = os.path.join(root, 'data')
+    os.makedirs(data)
+    folders = []
+    for i in range(n_files):
+        jd = 2458042.1 + i * 600. / 86400.
+        folder = os.path.join(data, 'zen.%.5f.xx.HH.uvR.uvfits.ms' % jd)
+        make_ms(folder, nbytes=int(size_mb * 1e6), ra=np.deg2rad((2.5 * i) % 360.), jd=jd)
+        folders.append(folder)
+
+    sources = dict(('TGSSADR J%05d' % i, {'RA': float(ra), 'DEC': float(dec), 'Total_flux': 1.})
+                   for i, (ra, dec) in enumerate(zip(rng.uniform(0, 360, n_sources),
+                                                     rng.uniform(-40, -20, n_sources))))
+    sources_file = os.path.join(root, 'mask_sources.json')
+    with open(sources_file, 'w') as f:
+        json.dump(sources, f)
+    return folders, sources_file
+
+
+def make_config(root, name, folders, sources_file, cal_cache):
+    '''
+    Writes a run json with a new calibration on the first file of the night
+    '''
+    config = {
+        'data_path': {'run_folder': os.path.join(root, 'runs', name), 'image_folder': 'imgs'},
+        'new_calibration': 'True',
+        'calibration_cache': cal_cache,
+        'new_cal_params': {
+            'file_to_calibrate': folders[0],
+            'model_name': 'GC.cl',
+            'cal_sources': {'galactic_center': {'dir': 'J2000 17h45m40.0409s -29d0m28.118s',
+                                                'shape': 'point', 'fluxunit': 'Jy', 'flux': 1}},
+            'kcal': {'solint': 'inf', 'refant': '11', 'minsnr': 1},
+            'gcal': {'solint': 'inf', 'refant': '11', 'minsnr': 2, 'calmode': 'ap'},
+            'clean_1': {'niter': 500, 'imsize': [512, 512], 'cell': ['500arcsec']},
+            'clean_2': {'niter': 500, 'imsize': [512, 512], 'cell': ['500arcsec']},
+            'clean_final': {'niter': 6000, 'imsize': [512, 512], 'cell': ['250arcsec']},
+            'band_pass_1': {'spw': '', 'minsnr': 1, 'solnorm': 'False', 'bandtype': 'B'},
+            'band_pass_2': {'spw': '', 'minsnr': 1, 'solnorm': 'False', 'bandtype': 'B'},
+            'flag': {'autocorr': 'True'}},
+        'calibration_files': [],
+        'clean_mask_sources': {'file_name': sources_file},
+        'base_mask_params': {'dec': '-30d47m17s', 'radius': '32000arcsec'},
+        'flag': {'autocorr': 'False', 'mode': 'tfcrop'},
+        'clean': {'niter': 6000, 'imsize': [512, 512], 'cell': ['250arcsec'], 'spw': '0:100~800'}}
+    fname = os.path.join(root, name + '.json')
+    with open(fname, 'w') as f:
+        json.dump(config, f, indent=2)
+    return fname
+
+
+def read_stats(fname):
+    '''
+    Reads the mock task calls recorded during a scenario
+    '''
+    if not os.path.exists(fname):
+        return []
+    with open(fname) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_scenario(root, name, config, folders, workers, scale, bandwidth):
+    '''
+    Runs casa_image_ms.py through the mock casa launcher
+
+    Returns
+    -------
+    dict
+        wall time, mock task calls and time spent in tasks
+    '''
+    stats = os.path.join(root, name + '.stats.jsonl')
+    env = dict(os.environ, CASA_EXECUTABLE=MOCK_CASA, MOCK_CASA_STATS=stats,
+               MOCK_CASA_SCALE=str(scale), MOCK_CASA_BANDWIDTH=str(bandwidth))
+    command = [sys.executable, MOCK_CASA, '-c', SCRIPT, config] + folders + ['--workers', str(workers)]
+    start = time.time()
+    with open(os.path.join(root, name + '.log'), 'w') as log:
+        returncode = subprocess.call(command, env=env, cwd=root, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time() - start
+    calls = read_stats(stats)
+    counts = {}
+    for call in calls:
+        counts[call['task']] = counts.get(call['task'], 0) + 1
+    return {'scenario': name, 'workers': workers, 'returncode': returncode, 'wall_seconds': wall,
+            'task_seconds': sum(call['seconds'] for call in calls),
+            'calls': counts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark casa_image_ms.py with mock CASA tasks')
+    parser.add_argument('--files', type=int, default=16, help='number of measurement sets in the night')
+    parser.add_argument('--size-mb', type=float, default=8., help='size of each measurement set in MB')
+    parser.add_argument('--sources', type=int, default=2000, help='number of sources in the mask catalogue')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4], help='worker counts to benchmark')
+    parser.add_argument('--scale', type=float, default=0.01, help='multiplier of the mock task latencies')
+    parser.add_argument('--bandwidth', type=float, default=0., help='mock disk bandwidth in MB/s (0 for none)')
+    parser.add_argument('--root', default=None, help='scratch folder (default: a new temporary folder)')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch folder')
+    parser.add_argument('--out', default=None, help='json file for the results')
+    args = parser.parse_args()
+
+    root = args.root if args.root is not None else tempfile.mkdtemp(prefix='bench_casa_')
+    try:
+        folders, sources_file = make_night(root, args.files, args.size_mb, args.sources)
+        results = []
+
+        config = make_config(root, 'serial', folders, sources_file, os.path.join(root, 'cal_serial'))
+        serial = run_scenario(root, 'serial', config, folders, 1, args.scale, args.bandwidth)
+        serial['overhead_seconds_per_file'] = (serial['wall_seconds'] - serial['task_seconds']) / args.files
+        results.append(serial)
+
+        for workers in args.workers:
+            name = 'workers_%d' % workers
+            config = make_config(root, name, folders, sources_file, os.path.join(root, 'cal_' + name))
+            result = run_scenario(root, name, config, folders, workers, args.scale, args.bandwidth)
+            # Compare with the serial run spread perfectly over the workers
+            result['speedup'] = serial['wall_seconds'] / result['wall_seconds']
+            result['scheduling_efficiency'] = result['speedup'] / workers
+            results.append(result)
+
+            rerun = run_scenario(root, name + '_rerun', config, folders, workers, args.scale, args.bandwidth)
+            rerun['manifest_hit_rate'] = 1. - rerun['calls'].get('clean', 0) / float(args.files)
+            results.append(rerun)
+
+        config = make_config(root, 'shared_cal', folders, sources_file, os.path.join(root, 'cal_serial'))
+        shared = run_scenario(root, 'shared_cal', config, folders, 1, args.scale, args.bandwidth)
+        shared['calibration_cache_hit'] = shared['calls'].get('gaincal', 0) == 0
+        results.append(shared)
+
+        print ('%-18s %8s %10s %10s  %s' % ('scenario', 'workers', 'wall (s)', 'tasks (s)', 'metric'))
+        for r in results:
+            metric = ''
+            for key in ['overhead_seconds_per_file', 'scheduling_efficiency', 'manifest_hit_rate',
+                        'calibration_cache_hit']:
+                if key in r:
+                    metric = '%s = %s' % (key, round(r[key], 3) if not isinstance(r[key], bool) else r[key])
+            if r['returncode'] != 0:
+                metric += ' (exit status %d, see %s.log)' % (r['returncode'], r['scenario'])
+            print ('%-18s %8d %10.2f %10.2f  %s' % (r['scenario'], r['workers'], r['wall_seconds'],
+                                                    r['task_seconds'], metric))
+
+        if args.out is not None:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if not args.keep and args.root is None:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+'''
+
+Stand-in for the CASA task namespace used to benchmark the imaging scripts
+
+Importing this module as casa (it is found first on sys.path when scripts are
+run with the mock casa launcher in this folder) gives flagdata, gaincal,
+bandpass, applycal, split, clean, exportfits, importuvfits, ft, fixvis and the
+tb and cl tools. The tasks do no science. Each one sleeps for a latency and
+reads and writes files in proportion to the size of the measurement set, so
+that the orchestration around them can be timed on any Linux machine.
+
+Environment variables:
+    MOCK_CASA_SCALE      multiplies the task latencies below (default: 0.01)
+    MOCK_CASA_BANDWIDTH  disk bandwidth in MB/s added to the latency for the
+                         bytes each task moves (default: 0, no extra delay)
+    MOCK_CASA_STATS      file each task call is appended to as a json line
+
+'''
+
+import os
+import json
+import time
+import shutil
+import numpy as np
+
+# Rough seconds per call of a 10 minute HERA file with the real tasks
+LATENCY = {'importuvfits': 20., 'flagdata': 10., 'gaincal': 15., 'bandpass': 15.,
+           'applycal': 10., 'split': 15., 'clean': 60., 'exportfits': 2., 'ft': 5.,
+           'fixvis': 10., 'imval': 1.}
+
+SCALE = float(os.environ.get('MOCK_CASA_SCALE', 0.01))
+BANDWIDTH = float(os.environ.get('MOCK_CASA_BANDWIDTH', 0)) * 1e6
+STATS = os.environ.get('MOCK_CASA_STATS')
+CHUNK = 1 << 20
+
+
+def _data_files(vis):
+    '''
+    Returns the column data files of a mock measurement set
+    '''
+    return [os.path.join(vis, name) for name in sorted(os.listdir(vis)) if name.startswith('table.f')]
+
+
+def _read(paths):
+    nbytes = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK)
+                if not chunk:
+                    break
+                nbytes += len(chunk)
+    return nbytes
+
+
+def _write(path, nbytes):
+    block = os.urandom(min(CHUNK, max(nbytes, 1)))
+    with open(path, 'wb') as f:
+        left = nbytes
+        while left > 0:
+            f.write(block[:min(left, len(block))])
+            left -= len(block)
+    return nbytes
+
+
+def _table(path, columns=None, nbytes=0):
+    '''
+    Writes a small mock table directory
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(os.path.join(path, 'mock.json'), 'w') as f:
+        json.dump(columns or {}, f)
+    if nbytes:
+        _write(os.path.join(path, 'table.f0'), nbytes)
+
+
+def _done(task, start, read=0, written=0, vis=None):
+    if BANDWIDTH > 0:
+        time.sleep((read + written) / BANDWIDTH)
+    time.sleep(LATENCY[task] * SCALE)
+    if STATS:
+        with open(STATS, 'a') as f:
+            f.write(json.dumps({'task': task, 'vis': vis, 'pid': os.getpid(), 'start': start,
+                                'seconds': time.time() - start,
+                                'read_bytes': read, 'write_bytes': written}) + '\n')
+
+
+def importuvfits(fitsfile=None, vis=None, **kwargs):
+    start = time.time()
+    read = _read([fitsfile])
+    make_ms(vis, nbytes=read)
+    _done('importuvfits', start, read, read, vis)
+
+
+def flagdata(vis=None, **kwargs):
+    start = time.time()
+    read = _read(_data_files(vis))
+    written = _write(os.path.join(vis, 'table.f1_flags'), read // 32)
+    _done('flagdata', start, read, written, vis)
+
+
+def gaincal(vis=None, caltable=None, **kwargs):
+    start = time.time()
+    read = _read(_data_files(vis))
+    _table(caltable, nbytes=64 * 1024)
+    _done('gaincal', start, read, 64 * 1024, vis)
+
+
+def bandpass(vis=None, caltable=None, **kwargs):
+    start = time.time()
+    read = _read(_data_files(vis))
+    _table(caltable, nbytes=256 * 1024)
+    _done('bandpass', start, read, 256 * 1024, vis)
+
+
+def applycal(vis=None, gaintable=None, **kwargs):
+    start = time.time()
+    read = _read(_data_files(vis))
+    # The corrected column is the same size as the data column
+    written = _write(os.path.join(vis, 'table.f2_corrected'), os.path.getsize(os.path.join(vis, 'table.f0')))
+    _done('applycal', start, read, written, vis)
+
+
+def split(vis=None, outputvis=None, datacolumn=None, spw='', **kwargs):
+    start = time.time()
+    read = _read(_data_files(vis))
+    if os.path.exists(outputvis):
+        shutil.rmtree(outputvis)
+    make_ms(outputvis, nbytes=os.path.getsize(os.path.join(vis, 'table.f0')), like=vis)
+    _done('split', start, read, os.path.getsize(os.path.join(outputvis, 'table.f0')), vis)
+
+
+def clean(vis=None, imagename=None, imsize=(512, 512), **kwargs):
+    start = time.time()
+    read = _read(_data_files(vis))
+    npix = int(imsize[0]) * int(imsize[-1])
+    written = 0
+    for ext in ['.image', '.model', '.residual', '.psf', '.flux']:
+        _table(imagename + ext, nbytes=4 * npix)
+        written += 4 * npix
+    _done('clean', start, read, written, vis)
+
+
+def exportfits(imagename=None, fitsimage=None, **kwargs):
+    start = time.time()
+    read = _read([os.path.join(imagename, 'table.f0')])
+    written = _write(fitsimage, read + 2880)
+    _done('exportfits', start, read, written)
+
+
+def ft(vis=None, complist=None, usescratch=False, **kwargs):
+    start = time.time()
+    written = _write(os.path.join(vis, 'table.f3_model'), os.path.getsize(os.path.join(vis, 'table.f0')))
+    _done('ft', start, 0, written, vis)
+
+
+def fixvis(vis=None, outputvis=None, phasecenter=None, **kwargs):
+    start = time.time()
+    read = _read(_data_files(vis))
+    _done('fixvis', start, read, 0, vis)
+
+
+class _TableTool:
+    '''
+    Mock of the CASA table tool. Columns are stored in mock.json in each table
+    '''
+    def __init__(self):
+        self.path = None
+        self.columns = None
+
+    def open(self, path, nomodify=True):
+        with open(os.path.join(path, 'mock.json')) as f:
+            self.columns = json.load(f)
+        self.path = path
+
+    def getcol(self, name):
+        return np.array(self.columns[name])
+
+    def getcell(self, name, row=0):
+        return np.array(self.columns[name])[..., row]
+
+    def putcell(self, name, row, value):
+        column = np.array(self.columns[name])
+        column[..., row] = value
+        self.columns[name] = column.tolist()
+        with open(os.path.join(self.path, 'mock.json'), 'w') as f:
+            json.dump(self.columns, f)
+
+    def close(self):
+        self.path = None
+        self.columns = None
+
+
+class _ComponentListTool:
+    '''
+    Mock of the CASA component list tool
+    '''
+    def __init__(self):
+        self.components = []
+        self.name = None
+
+    def addcomponent(self, **kwargs):
+        self.components.append(kwargs)
+
+    def rename(self, filename):
+        self.name = filename
+
+    def close(self):
+        if self.name is not None:
+            _table(self.name, {'components': self.components})
+        self.components = []
+        self.name = None
+
+
+tb = _TableTool()
+cl = _ComponentListTool()
+
+
+def make_ms(vis, nbytes=1 << 20, ra=0., dec=np.deg2rad(-30.72), jd=2458042.5, nchan=1024,
+            pol=9, like=None):
+    '''
+    Writes a synthetic measurement set directory with the subtables read by
+    the imaging scripts
+
+    Parameters
+    ----------
+    vis : str
+        measurement set to write
+    nbytes : int
+        size of the main data column
+    ra, dec : float
+        phase centre in radians
+    jd : float
+        start time of the observation (10 minutes long)
+    nchan : int
+        number of channels
+    pol : int
+        CASA polarization code (9 is xx)
+    like : str
+        copy the subtables from this measurement set instead
+    '''
+    if not os.path.exists(vis):
+        os.makedirs(vis)
+    _write(os.path.join(vis, 'table.f0'), nbytes)
+    with open(os.path.join(vis, 'table.dat'), 'w') as f:
+        f.write('mock measurement set\n')
+    if like is not None:
+        for sub in ['SOURCE', 'OBSERVATION', 'SPECTRAL_WINDOW', 'POLARIZATION']:
+            shutil.copytree(os.path.join(like, sub), os.path.join(vis, sub))
+        return
+    mjd_seconds = (jd - 2400000.5) * 86400.
+    _table(os.path.join(vis, 'SOURCE'), {'DIRECTION': [[ra], [dec]]})
+    _table(os.path.join(vis, 'OBSERVATION'), {'TIME_RANGE': [[mjd_seconds], [mjd_seconds + 600.]]})
+    _table(os.path.join(vis, 'SPECTRAL_WINDOW'),
+           {'CHAN_FREQ': (100e6 + 97656.25 * np.arange(nchan))[:, None].tolist()})
+    _table(os.path.join(vis, 'POLARIZATION'), {'CORR_TYPE': [[pol]]})
@@ -6,111 +6,181 @@ for an imaging run of the sky.
 To run (in terminal):
 casa -c casa_image_ms.py <run paramters>.json <measurement sets>.ms
 
+To image the measurement sets with several CASA processes at once:
+casa -c casa_image_ms.py <run paramters>.json <measurement sets>.ms --workers 8
+
 '''
 
 from casa import *
-import numpy as np
 import os
-import collections
+import sys
 import json
 import argparse
 from process_ms import CASA_Imaging
+from casa_worker import find_script, script_args, run_casa, run_pool, convert_json
+from mask_index import MaskRegions
+from ms_manifest import MSManifest
+from sub_bands import image_names
 
 def create_model(infile, cal_sources, model_name):
-    for _, params in cal_sources.iteritems():
+    for _, params in cal_sources.items():
         cl.addcomponent(**params)
     cl.rename(model_name)
     cl.close()
     ft(infile, complist=model_name, usescratch=True)
 
 
-def convert_json(data):
-    if isinstance(data, basestring):
-        return data.encode('utf-8')
-    elif isinstance(data, collections.Mapping):
-        return dict(map(convert_json, data.iteritems()))
-    elif isinstance(data, collections.Iterable):
-        return type(data)(map(convert_json, data))
-    else:
-        return data
+_manifests = {}
+
+def load_manifest(folder):
+    '''
+    Returns the metadata manifest of the directory holding a measurement set
+    (see ms_manifest), loading it only once per directory
+    '''
+    path = os.path.dirname(os.path.abspath(folder.rstrip('/')))
+    if path not in _manifests:
+        _manifests[path] = MSManifest.for_ms(folder)
+    return _manifests[path]
+
+def find_ra_dec(folder):
+    '''
+    Returns the phase centre of a measurement set in radians, from the
+    ms_manifest.json of its directory when the file has been indexed and
+    from its SOURCE table otherwise
+    '''
+    centre = load_manifest(folder).phase_centre(folder)
+    if centre is not None:
+        return centre
+    tb.open(os.path.join(folder,'SOURCE'))
+    direction = tb.getcol('DIRECTION')
+    tb.close()
+    return direction[0][0], direction[1][0]
+
 
-def rad_to_hms(angle):
+def set_mask(ra, dec, srcs, path, mask_size='32000arcsec', imsize=512, cell_size=250):
     '''
-    Converts an angle in radians to a right ascension
+    Makes the CLEAN mask for a single phase centre. To make masks for many
+    measurement sets, create one MaskRegions and call its mask method.
 
     Parameters
     ----------
-    angle : float
-        angle to be converted in radians
+    ra : float
+        right ascension of the phase centre in radians
+    dec : str
+        declination of the central mask
+    srcs : dict or SourceIndex
+        mask sources, with 'RA' and 'DEC' in degrees
+    path : str
+        directory where the region file is written
 
     Returns
     -------
-    ra : string
-        right ascension calculated from the angle given in hours, minutes, and seconds
+    str or list
+        paths of the mask source and central mask region files, or the
+        central mask alone
     '''
-    if (angle < 0):
-        angle += (2*np.pi)
-    time = (angle/(2*np.pi))*24
-    hours = int(time)
-    time = (time%1)*60
-    mins = int(time)
-    secs = (time%1)*60
-    ra = str(hours) + 'h' + str(mins) + 'm' + str(secs) + 's'
-    return (ra)
-
-def dd_to_dms(degs):
+    return MaskRegions(srcs, path, dec, mask_size=mask_size, imsize=imsize, cell_size=cell_size).mask(ra)
+
+def run_workers(config, config_data, gaintable, folders, workers, force=False):
     '''
-    Converts an angle in decimal degrees to a degrees, minutes, and seconds
+    Images measurement sets in a pool of CASA worker processes
+
+    Each measurement set is imaged by its own CASA process with its own
+    scratch directory, where the CASA logs are written. Mask region files
+    are named by their contents (see mask_index), so workers can share them
+    safely. The outcome of every file is written to run_summary.json in the
+    run folder.
 
     Parameters
     ----------
-    angle : float
-        angle to be converted in decimal degrees
+    config : str
+        path of the run parameter json file
+    config_data : dict
+        run parameters read from the json file
+    gaintable : list
+        calibration files applied to every measurement set
+    folders : list
+        measurement sets to image
+    workers : int
+        number of CASA processes to run at once
+    force : bool
+        image files even if the run manifest says they are up to date
 
     Returns
     -------
-    ra : string
-        right ascension calculated from the angle given in degrees, minutes, and seconds
+    dict
+        summary of the run
     '''
-    neg = degs < 0
-    degs = (-1) ** neg * degs
-    degs, d_int = np.modf(degs)
-    mins, m_int = np.modf(60 * degs)
-    secs        =           60 * mins
-    if neg:
-        return (str(int(-d_int)) + 'd' + str(int(m_int)) +'m'+ str(secs) + 's')
-    return (str(int(d_int)) + 'd' + str(int(m_int)) +'m'+ str(secs) + 's')
-
-def find_ra_dec(folder):
-    tb.open(os.path.join(folder,'SOURCE'))
-    angle_ra = tb.getcol('DIRECTION')[0][0]
-    angle_dec = tb.getcol('DIRECTION')[1][0]
-    tb.close()
-    return angle_ra, angle_dec
+    script = find_script('casa_image_ms.py')
+    run_folder = os.path.abspath(config_data['data_path']['run_folder'])
+    img_folder = os.path.join(run_folder, config_data['data_path']['image_folder'])
+    scratch_root = os.path.join(run_folder, 'scratch')
+
+    # Calibration is already done, so workers only apply the gaintable
+    worker_data = dict(config_data)
+    worker_data['new_calibration'] = 'False'
+    worker_data['calibration_files'] = [os.path.abspath(cal) for cal in gaintable]
+    worker_data['data_path'] = dict(config_data['data_path'], run_folder=run_folder)
+    worker_data['clean_mask_sources'] = {'file_name': os.path.abspath(config_data['clean_mask_sources']['file_name'])}
+    worker_config = os.path.join(run_folder, os.path.basename(config)[:-len('.json')] + '.workers.json')
+    with open(worker_config, 'w') as f:
+        json.dump(worker_data, f, indent=2)
+
+    def image_folder(folder):
+        scratch = os.path.join(scratch_root, os.path.basename(folder.rstrip('/')))
+        if not os.path.exists(scratch):
+            os.makedirs(scratch)
+        log = os.path.join(scratch, 'casa.log')
+        print ('Starting worker for: ' + folder)
+        worker_args = [worker_config, os.path.abspath(folder), '--scratch', scratch]
+        if force:
+            worker_args.append('--force')
+        returncode, seconds = run_casa(script, worker_args, cwd=scratch, log=log)
+        # CASA tasks log errors instead of raising, so check for the images too
+        fitsimages = [imgname + '.fits' for imgname in image_names(img_folder, folder, config_data['clean'])]
+        status = 'done' if returncode == 0 and all(os.path.exists(f) for f in fitsimages) else 'failed'
+        print ('Worker ' + status + ' for: ' + folder)
+        return {'ms': folder, 'status': status, 'returncode': returncode,
+                'seconds': seconds, 'scratch': scratch, 'log': log, 'images': fitsimages}
+
+    results = run_pool(image_folder, folders, workers)
+    summary = {'config': os.path.abspath(config),
+               'workers': workers,
+               'gaintable': worker_data['calibration_files'],
+               'results': results,
+               'failed': [r['ms'] for r in results if r['status'] != 'done']}
+    with open(os.path.join(run_folder, 'run_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
 
 
-def set_mask(ra, dec, srcs, path, mask_size='32000arcsec', imsize=512, cell_size=250):
-    fov = np.deg2rad((imsize * cell_size)/3600)
-    mask = 'circle[[' + rad_to_hms(ra) + ', ' + dec + '], ' + mask_size + ']'
-    final_srcs = {k: src for k,src in srcs.iteritems() if ra-fov/2 <= src['RA'] <= ra+fov/2} # check if sources cross into the FOV
-    if len(final_srcs) > 0:
-        fname = 'mask.rgn'
-	fname = os.path.join(path,fname)
-        with open(fname,'w') as f:
-            f.write('#CRTFv0\n')
-            f.write(mask+'\n')
-            for _,v in final_srcs.iteritems():
-                f.write('circle[[' + rad_to_hms(v['RA']) + ', ' + dd_to_dms(v['DEC']) + '], 2000arcsec]\n')
-        mask = fname
-    return mask
-
 if __name__ == '__main__':
 
-    args = sys.argv[3:]
-    folders = [folder for folder in args if folder.endswith('ms')]
+    parser = argparse.ArgumentParser(description='Flag, calibrate and image measurement sets with CASA')
+    parser.add_argument('files', nargs='+', help='run parameter json file followed by the measurement sets to image')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of CASA worker processes imaging measurement sets at once (default: 1)')
+    parser.add_argument('--scratch', default=None,
+                        help='scratch directory of this worker process (set by --workers)')
+    parser.add_argument('--force', action='store_true',
+                        help='recalibrate and image every measurement set, ignoring the calibration cache and run manifest')
+    parser.add_argument('--lst-range', type=float, nargs=2, default=None, metavar=('LST_MIN', 'LST_MAX'),
+                        help='only image measurement sets overlapping this LST range in hours (needs ms_manifest.json)')
+    args = parser.parse_args(script_args('casa_image_ms.py'))
+
+    folders = [folder for folder in args.files if folder.endswith('ms')]
     folders.sort()
 
-    config = [arg for arg in args if arg.endswith('json')][0]
+    if args.lst_range is not None:
+        selected = set()
+        for folder in folders:
+            selected.update(load_manifest(folder).select_lst(*args.lst_range))
+        unindexed = [folder for folder in folders if load_manifest(folder).get(folder) is None]
+        for folder in unindexed:
+            print ('Not in ms_manifest.json, skipping: ' + folder)
+        folders = [folder for folder in folders if os.path.abspath(folder.rstrip('/')) in selected]
+
+    config = [arg for arg in args.files if arg.endswith('json')][0]
 
     with open(config) as f:
         config_data = convert_json(json.load(f))
@@ -118,34 +188,41 @@ if __name__ == '__main__':
     ci = CASA_Imaging(config_data)
 
     if config_data['new_calibration'] == 'True':
-        cal_params = config_data['new_cal_params']
-	infile = cal_params['file_to_calibrate']
-	model_name = os.path.join(config_data['data_path']['run_folder'],cal_params['model_name'])
-	cal_sources = cal_params['cal_sources']
-    	if type(cal_sources.values()[0]) is not dict:
-	    	with open(cal_sources.values()[0],'r') as fp:
-		    cal_sources = convert_json(json.load(fp))
-	create_model(infile,cal_sources,model_name)
-	ci.create_cal_files()
+        # Runs sharing a calibration reuse the tables from the cache
+        if args.force or not ci.load_cached_calibration():
+            cal_params = config_data['new_cal_params']
+            infile = cal_params['file_to_calibrate']
+            model_name = os.path.join(config_data['data_path']['run_folder'],cal_params['model_name'])
+            cal_sources = cal_params['cal_sources']
+            if type(list(cal_sources.values())[0]) is not dict:
+                with open(list(cal_sources.values())[0],'r') as fp:
+                    cal_sources = convert_json(json.load(fp))
+            create_model(infile,cal_sources,model_name)
+            ci.create_cal_files()
+
+    if args.workers > 1:
+        summary = run_workers(config, config_data, ci.gaintable, folders, args.workers, force=args.force)
+        print ('Imaged ' + str(len(folders) - len(summary['failed'])) + ' of ' + str(len(folders)) + ' measurement sets')
+        for folder in summary['failed']:
+            print ('Failed: ' + folder)
+        sys.exit(1 if summary['failed'] else 0)
 
     sources_file = config_data['clean_mask_sources']['file_name']
     mask_dec = config_data['base_mask_params']['dec']
     mask_radius = config_data['base_mask_params']['radius']
-
-
+    imsize = ci.final_clean_params.get('imsize', [512])[0]
+    cell_size = float(ci.final_clean_params.get('cell', ['250arcsec'])[0].replace('arcsec', ''))
 
     with open(sources_file) as f:
         sources = json.load(f)
+    masks = MaskRegions(sources, os.path.join(ci.run_folder, 'masks'), mask_dec, mask_size=mask_radius,
+                        imsize=imsize, cell_size=cell_size)
 
     for folder in folders:
         ra, _ = find_ra_dec(folder)
-        mask = set_mask(ra, mask_dec, sources, path=ci.run_folder, mask_size=mask_radius)
+        mask = masks.mask(ra)
 
-    	if mask.endswith('rgn'):
-    		print mask
-    		ci.final_clean_params['mask'] = mask
-    	else:
-    		print mask
-    		ci.final_clean_params['mask'] = mask
+        print (mask)
+        ci.final_clean_params['mask'] = mask
 
-    	ci.make_image(folder)
+        ci.make_image(folder, force=args.force)
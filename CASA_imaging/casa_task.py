@@ -0,0 +1,38 @@
+'''
+
+Runs a list of CASA tasks given in a json file. This is the script launched
+by casa_worker.run_casa_task in each worker CASA process.
+
+To run (in terminal):
+casa -c casa_task.py <tasks>.json
+
+The json file holds a list of tasks, e.g.
+[{"task": "importuvfits", "kwargs": {"fitsfile": "a.uvfits", "vis": "a.uvfits.ms"}},
+ {"task": "flagdata", "kwargs": {"vis": "a.uvfits.ms", "autocorr": true}}]
+
+Methods of the CASA tools are called by their dotted names, e.g.
+{"task": "cl.addcomponent", "kwargs": {"flux": 1, "dir": "J2000 17h45m40s -29d0m28s"}}
+
+'''
+
+from casa import *
+import sys
+import json
+from casa_worker import script_args, convert_json
+
+if __name__ == '__main__':
+    spec = script_args('casa_task.py')[0]
+    with open(spec) as f:
+        tasks = convert_json(json.load(f))
+
+    for call in tasks:
+        print ('Running ' + call['task'])
+        name = call['task'].split('.')
+        func = globals()[name[0]]
+        for attr in name[1:]:
+            func = getattr(func, attr)
+        result = func(**call['kwargs'])
+        # CASA tasks report most failures by returning False
+        if result is False:
+            print (call['task'] + ' failed')
+            sys.exit(1)
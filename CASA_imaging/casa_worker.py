@@ -0,0 +1,199 @@
+'''
+
+Helpers for running CASA scripts in separate worker processes
+
+CASA tasks and tools are not safe to share between threads, so parallel work
+is done by launching a fresh CASA process per job. The CASA executable can be
+overridden with the CASA_EXECUTABLE environment variable.
+
+'''
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+from multiprocessing.pool import ThreadPool
+try:
+    from collections.abc import Mapping, Iterable
+except ImportError:
+    from collections import Mapping, Iterable
+
+CASA_EXECUTABLE = os.environ.get('CASA_EXECUTABLE', 'casa')
+TASK_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'casa_task.py')
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def convert_json(data):
+    '''
+    Converts the unicode strings read by json into the byte strings CASA
+    tasks expect
+    '''
+    if isinstance(data, basestring):
+        return data if isinstance(data, str) else data.encode('utf-8')
+    elif isinstance(data, Mapping):
+        return dict(map(convert_json, data.items()))
+    elif isinstance(data, Iterable):
+        return type(data)(map(convert_json, data))
+    else:
+        return data
+
+
+def find_script(name):
+    '''
+    Finds the path of a script in the command line used to launch it
+
+    Parameters
+    ----------
+    name : str
+        file name of the script (e.g. casa_image_ms.py)
+
+    Returns
+    -------
+    str
+        path of the script as given on the command line
+    '''
+    # Search from the end, as launchers may also put the script in sys.argv[0]
+    for arg in reversed(sys.argv):
+        if os.path.basename(arg) == name:
+            return arg
+    raise IOError('%s not found in the command line.' % name)
+
+
+def script_args(name):
+    '''
+    Returns the command line arguments given after a script
+
+    CASA adds its own arguments in front of the script when run with
+    casa -c, so the position of the script arguments is not fixed.
+
+    Parameters
+    ----------
+    name : str
+        file name of the script (e.g. casa_image_ms.py)
+
+    Returns
+    -------
+    list
+        arguments following the script on the command line
+    '''
+    script = find_script(name)
+    return sys.argv[len(sys.argv) - sys.argv[::-1].index(script):]
+
+
+def casa_command(script, args):
+    '''
+    Builds the command line used to run a script in a new CASA process
+
+    Parameters
+    ----------
+    script : str
+        path of the script to run
+    args : list
+        arguments passed on to the script
+
+    Returns
+    -------
+    list
+        command line for subprocess
+    '''
+    return ([CASA_EXECUTABLE, '--nologger', '--nogui', '--log2term', '-c',
+             os.path.abspath(script)] + [str(arg) for arg in args])
+
+
+def run_casa(script, args, cwd=None, log=None):
+    '''
+    Runs a script in a new CASA process and waits for it to finish
+
+    Parameters
+    ----------
+    script : str
+        path of the script to run
+    args : list
+        arguments passed on to the script
+    cwd : str
+        working directory of the CASA process. CASA writes its log files here.
+        Default is the current working directory.
+    log : str
+        file that the output of the CASA process is written to.
+        Default is to inherit the output of this process.
+
+    Returns
+    -------
+    returncode : int
+        exit status of the CASA process
+    seconds : float
+        wall time taken by the CASA process
+    '''
+    start = time.time()
+    if log is None:
+        returncode = subprocess.call(casa_command(script, args), cwd=cwd)
+    else:
+        with open(log, 'w') as f:
+            returncode = subprocess.call(casa_command(script, args), cwd=cwd,
+                                         stdout=f, stderr=subprocess.STDOUT)
+    return returncode, time.time() - start
+
+
+def run_pool(func, jobs, workers):
+    '''
+    Runs a function over a list of jobs with at most a set number at once
+
+    The function is expected to launch its own process (see run_casa), so
+    threads are enough to keep the requested number of processes busy.
+
+    Parameters
+    ----------
+    func : function
+        function called with each job
+    jobs : list
+        inputs to the function
+    workers : int
+        maximum number of jobs running at once
+
+    Returns
+    -------
+    list
+        results of the function in the same order as the jobs
+    '''
+    pool = ThreadPool(max(1, int(workers)))
+    try:
+        return pool.map(func, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_casa_task(tasks, cwd=None, log=None):
+    '''
+    Runs one or more CASA tasks in a new CASA process
+
+    Parameters
+    ----------
+    tasks : list
+        (task name, keyword arguments) pairs, run in order
+        e.g. [('flagdata', {'vis': 'file.ms', 'autocorr': True})]
+    cwd : str
+        working directory of the CASA process
+    log : str
+        file that the output of the CASA process is written to
+
+    Returns
+    -------
+    returncode : int
+        exit status of the CASA process, non-zero if a task failed
+    seconds : float
+        wall time taken by the CASA process
+    '''
+    fd, spec = tempfile.mkstemp(suffix='.json', prefix='casa_task_')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump([{'task': task, 'kwargs': kwargs} for task, kwargs in tasks], f)
+        return run_casa(TASK_SCRIPT, [spec], cwd=cwd, log=log)
+    finally:
+        os.remove(spec)
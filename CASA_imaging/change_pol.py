@@ -3,10 +3,20 @@
 To run (in terminal):
 casa -c change_pol.py <measurement sets>
 
+Whole directories of cross polarization files can be imaged in parallel, one
+CASA process per file:
+casa -c change_pol.py /path/to/data --workers 8
+
+The measurement sets are never modified. Each file is imaged through a
+relabelled reference copy (see pol_view.py).
+
 '''
 
-import sys
 import os
+import argparse
+from casa import *
+from casa_worker import find_script, script_args, run_casa, run_pool
+from pol_view import pol_view, remove_view
 
 def find_pol_files(path=None):
     """
@@ -25,76 +35,142 @@ def find_pol_files(path=None):
 
     folders = []
 
-    for folder in os,listdir(path):
-            if (folder[-12:]) == '.uvfits.ms':
+    for folder in os.listdir(path):
+            if folder.endswith('.uvfits.ms'):
                 folders.append(os.path.join(path,folder))
 
     folders.sort()
     return (folders)
 
 
-def get_pol(folder, path=None):
+def output_name(folder, path=None):
     """
 
-    reads in the file and gets the original polarization
-
-    Parameters
-    ----------
-    folder : str
-        File path of the ms file to be altered
-    path : str
-        File path where the new ms file will be written.
-        Default is the current working directory.
+    Returns the name of the relabelled copy of a file, which the image
+    names are based on
 
     """
 
-    # Create a variable to hold the modified file name
     if path is not None:
         if os.path.isdir(path):
-            vis_file = os.path.join(path,folder) + '.fake_xx_pol.ms'
+            return os.path.join(path,os.path.basename(folder.rstrip('/'))) + '.fake_xx_pol.ms'
         else:
             raise IOError("%s not found." % path)
-    else:
-        vis_file = folder + '.fake_xx_pol.ms'
+    return folder.rstrip('/') + '.fake_xx_pol.ms'
 
-    # Create a variable to point to the Polarization table
-    pol_cell = folder + '/POLARIZATION'
 
-    # Open the polarization table and save the polarization index
-    tb.open(pol_cell, nomodify=False)
-    origin_pol = tb.getcell('CORR_TYPE')
+def get_pol(folder, path=None, keep_view=False):
+    """
 
+    Images a single polarization file as if it were xx polarized
 
-    # Check to see if the polarization is already xx
-    if origin_pol[0] == 9:
-        print 'Already xx polarized'
-    else:
-        tb.putcell('CORR_TYPE',0,[9])
-        print 'Now it is xx polarized'
+    The original file is not modified. Clean reads the data through a
+    relabelled reference copy, which is removed afterwards.
+
+    Parameters
+    ----------
+    folder : str
+        File path of the ms file to be imaged
+    path : str
+        File path where the relabelled copy and image will be written.
+        Default is next to the ms file.
+    keep_view : bool
+        Keep the relabelled copy after imaging
+
+    """
 
-    # Close the table
-    tb.close()
+    # Create a variable to hold the relabelled copy name
+    vis_file = output_name(folder, path)
+
+    # Make the relabelled copy and save the original polarization index
+    origin_pol = pol_view(folder, vis_file, corr_type=9)
+    if origin_pol == 9:
+        print ('Already xx polarized')
+    else:
+        print ('Imaging polarization %d as xx' % origin_pol)
 
     # Create a variable to hold the clean output file name
     imgname = vis_file + '.init.img'
 
     # Clean the file to create images
-    clean(vis=folder, imagename=imgname, niter=0, weighting='briggs',robust=-0.5, imsize=[512,512], cell=['250arcsec'],mode='mfs',nterms=1,spw='0:150~900')
+    try:
+        clean(vis=vis_file, imagename=imgname, niter=0, weighting='briggs',robust=-0.5, imsize=[512,512], cell=['250arcsec'],mode='mfs',nterms=1,spw='0:150~900')
+    finally:
+        if not keep_view:
+            remove_view(vis_file)
 
-    #Put the original polariazation back in the data
-    if origin_pol[0] == 9:
-        print 'Was already xx'
-    else:
-        tb.open(pol_cell, nomodify=False)
-        tb.putcell('CORR_TYPE',0,[origin_pol[0]])
-        print 'Polarization returned'        
-        tb.close()
+
+def run_workers(folders, workers, path=None, keep_view=False):
+    """
+
+    Images files in a pool of CASA worker processes, one process per file
+
+    Parameters
+    ----------
+    folders : list
+        ms files to image
+    workers : int
+        Number of CASA processes to run at once
+    path : str
+        File path where the images will be written.
+        Default is next to each ms file.
+    keep_view : bool
+        Keep the relabelled copies after imaging
+
+    Returns
+    -------
+    list
+        ms files that failed
+
+    """
+
+    script = find_script('change_pol.py')
+
+    def image_folder(folder):
+        vis_file = output_name(folder, path)
+        worker_args = [os.path.abspath(folder)]
+        if path is not None:
+            worker_args += ['--path', os.path.abspath(path)]
+        if keep_view:
+            worker_args.append('--keep-view')
+        print ('Starting worker for: ' + folder)
+        returncode, _ = run_casa(script, worker_args, cwd=os.path.dirname(vis_file),
+                                 log=vis_file + '.casa.log')
+        # CASA tasks log errors instead of raising, so check for the image too
+        ok = returncode == 0 and os.path.exists(vis_file + '.init.img.image')
+        print ('Worker ' + ('done' if ok else 'failed') + ' for: ' + folder)
+        return ok
+
+    results = run_pool(image_folder, folders, workers)
+    return [folder for folder, ok in zip(folders, results) if not ok]
 
 
 if __name__ == '__main__':
-    try:
-        folders = sys.argv[3:]
-        for folder in folders:
-            get_pol(folder)
-    except IndexError:
+    parser = argparse.ArgumentParser(description='Image cross polarization measurement sets as xx')
+    parser.add_argument('files', nargs='*', help='ms files, or directories to search for .uvfits.ms files')
+    parser.add_argument('--path', default=None, help='directory for the images (default: next to each file)')
+    parser.add_argument('--workers', type=int, default=1, help='number of files imaged at once')
+    parser.add_argument('--keep-view', action='store_true', help='keep the relabelled copies')
+    args = parser.parse_args(script_args('change_pol.py'))
+
+    folders = []
+    for f in args.files:
+        # A measurement set is a directory too, so look for its main table
+        if os.path.isdir(f) and not os.path.exists(os.path.join(f, 'table.dat')):
+            folders.extend(find_pol_files(f))
+        else:
+            folders.append(f)
+
+    if not folders:
         print ('No file specified to change the polarization')
+    elif args.workers > 1:
+        failed = run_workers(folders, args.workers, path=args.path, keep_view=args.keep_view)
+        print ('Imaged %d of %d files' % (len(folders) - len(failed), len(folders)))
+        for folder in failed:
+            print ('Failed: ' + folder)
+    else:
+        for folder in folders:
+            try:
+                get_pol(folder, path=args.path, keep_view=args.keep_view)
+            except Exception as e:
+                print ('{}: {}'.format(folder, e))
@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+'''
+
+Quick-look dirty images from uvfits files without CASA
+
+CASA clean with niter=0 only grids the visibilities and Fourier transforms
+them, but every call pays for starting CASA, importing the uvfits file to a
+measurement set and reading it back. This module does the same steps with
+numpy on the uvfits files written by miriad_to_uvfits.py:
+
+    - autocorrelations and flagged samples are dropped
+    - the channels given by a CASA style spw (e.g. '0:100~800') are gridded
+      together (mfs) with nearest neighbour gridding
+    - natural, uniform or briggs weighting is applied with the same robust
+      parameter as CASA
+    - the image is written to FITS with the SIN projection, axes and OBSRA /
+      OBSDEC keywords of the images exported by CASA, so they can be read by
+      the beam mapping and closure phase scripts without changes
+
+The w term is ignored, as it is by clean with the default gridmode.
+
+To run (in terminal):
+python dirty_image.py /path/to/data/*.uvfits --imsize 512 --cell 500arcsec --workers 8
+
+Several resolutions are made from one read of each file with
+python dirty_image.py /path/to/data/*.uvfits --imsize 512 --cell 500arcsec 1000arcsec
+
+'''
+
+import os
+import re
+import argparse
+import numpy as np
+from multiprocessing import Pool
+
+C_LIGHT = 299792458.
+
+# AIPS polarization codes of the parallel hands, which are averaged for Stokes I
+PARALLEL_POLS = [-5, -6, -1, -2]
+
+_UNITS = {'arcsec': np.pi / 180. / 3600., 'arcmin': np.pi / 180. / 60.,
+          'deg': np.pi / 180., 'rad': 1.}
+
+
+def parse_cell(cell):
+    '''
+    Converts a CASA cell size to radians
+
+    Parameters
+    ----------
+    cell : str, float or list
+        e.g. '500arcsec', '0.1deg' or ['500arcsec'].
+        Numbers are taken to be in arcsec, as in CASA.
+
+    Returns
+    -------
+    float
+        cell size in radians
+    '''
+    if isinstance(cell, (list, tuple)):
+        cell = cell[0]
+    if isinstance(cell, (int, float)):
+        return cell * _UNITS['arcsec']
+    match = re.match(r'^\s*([0-9.eE+-]+)\s*(arcsec|arcmin|deg|rad)?\s*$', cell)
+    if match is None:
+        raise ValueError('Cell size %s not understood.' % cell)
+    return float(match.group(1)) * _UNITS[match.group(2) or 'arcsec']
+
+
+def parse_imsize(imsize):
+    '''
+    Returns the number of pixels along RA and Dec of a CASA imsize
+    (e.g. 512 or [512, 512])
+    '''
+    if isinstance(imsize, (list, tuple)):
+        return int(imsize[0]), int(imsize[-1])
+    return int(imsize), int(imsize)
+
+
+def parse_spw(spw, nchan=None):
+    '''
+    Converts a CASA spectral window selection to channel numbers
+
+    Only the first spectral window is supported, as for the HERA files.
+
+    Parameters
+    ----------
+    spw : str
+        e.g. '', '0', '0:100~800' or '0:100~300;500~800'. Channel ranges are
+        inclusive, as in CASA.
+    nchan : int
+        number of channels in the file, used to check the selection
+
+    Returns
+    -------
+    array or None
+        selected channel numbers, None for all channels
+    '''
+    spw = spw.strip()
+    if spw in ['', '*', '0']:
+        return None
+    window, _, ranges = spw.partition(':')
+    if window.strip() not in ['0', '*']:
+        raise ValueError('Only spectral window 0 is supported, got %s.' % spw)
+    chans = []
+    for part in ranges.split(';'):
+        start, _, stop = part.partition('~')
+        stop = stop or start
+        chans.extend(range(int(start), int(stop) + 1))
+    chans = np.unique(chans)
+    if nchan is not None and chans[-1] >= nchan:
+        raise ValueError('Channel %d selected but there are only %d channels.' % (chans[-1], nchan))
+    return chans
+
+
+class Visibilities:
+    '''
+    Cross correlation visibilities of one file, ready for gridding
+
+    Attributes
+    ----------
+    uvw : array
+        (Nblts, 3) baseline coordinates in meters
+    data : array
+        (Nblts, Nfreqs) complex visibilities, averaged over the parallel hands
+    weights : array
+        (Nblts, Nfreqs) natural weights, 0 where flagged
+    freqs : array
+        (Nfreqs,) channel frequencies in Hz
+    ra, dec : float
+        phase centre in radians
+    jd : float
+        median Julian date of the samples
+    '''
+    def __init__(self, uvw, data, weights, freqs, ra, dec, jd):
+        self.uvw = uvw
+        self.data = data
+        self.weights = weights
+        self.freqs = freqs
+        self.ra = ra
+        self.dec = dec
+        self.jd = jd
+
+
+def _phase_center(uv):
+    '''
+    Returns the phase centre of a UVData object in radians, for the old
+    (phase_center_ra) and new (phase_center_catalog) versions of pyuvdata
+    '''
+    if getattr(uv, 'phase_center_catalog', None):
+        entry = list(uv.phase_center_catalog.values())[0]
+        return entry['cat_lon'], entry['cat_lat']
+    return uv.phase_center_ra, uv.phase_center_dec
+
+
+def read_uvfits(fname, spw=''):
+    '''
+    Reads the cross correlations of a uvfits file
+
+    Only the selected channels are read from disk.
+
+    Parameters
+    ----------
+    fname : str
+        uvfits file, e.g. written by miriad_to_uvfits.py
+    spw : str
+        CASA style channel selection, see parse_spw
+
+    Returns
+    -------
+    Visibilities
+    '''
+    import pyuvdata
+
+    uv = pyuvdata.UVData()
+    uv.read_uvfits(fname, read_data=False)
+    chans = parse_spw(spw, uv.Nfreqs)
+    uv.read_uvfits(fname, freq_chans=chans, ant_str='cross')
+
+    # Older versions of pyuvdata have a spectral window axis of length 1
+    data = uv.data_array
+    flags = uv.flag_array
+    nsamples = uv.nsample_array
+    if data.ndim == 4:
+        data, flags, nsamples = data[:, 0], flags[:, 0], nsamples[:, 0]
+    freqs = np.asarray(uv.freq_array).reshape(-1)
+
+    pols = [i for i, p in enumerate(uv.polarization_array) if p in PARALLEL_POLS]
+    if not pols:
+        pols = list(range(uv.Npols))
+    weights = np.where(flags[..., pols], 0., nsamples[..., pols])
+    wsum = weights.sum(axis=-1)
+    data = np.where(wsum > 0, (data[..., pols] * weights).sum(axis=-1) / np.where(wsum > 0, wsum, 1.), 0.)
+
+    ra, dec = _phase_center(uv)
+    return Visibilities(uv.uvw_array, data, wsum, freqs, ra, dec, np.median(uv.time_array))
+
+
+def _uv(vis, chans):
+    '''
+    Returns the u and v coordinates in wavelengths of a block of channels
+    '''
+    scale = vis.freqs[chans] / C_LIGHT
+    return vis.uvw[:, 0, None] * scale[None, :], vis.uvw[:, 1, None] * scale[None, :]
+
+
+def _grid_index(u, v, nx, ny, cell):
+    '''
+    Returns the grid cell of each sample and of its complex conjugate, -1
+    where it falls off the grid
+
+    The grid is indexed [v, -u], so the first image axis increases towards
+    the west (decreasing RA) as in CASA images.
+    '''
+    du = 1. / (nx * cell)
+    dv = 1. / (ny * cell)
+    index = []
+    for sign in [1, -1]:
+        iu = np.rint(-sign * u / du).astype(np.int64) + nx // 2
+        iv = np.rint(sign * v / dv).astype(np.int64) + ny // 2
+        good = (iu >= 0) & (iu < nx) & (iv >= 0) & (iv < ny)
+        index.append(np.where(good, iv * nx + iu, -1))
+    return index
+
+
+def _channel_blocks(nchan, block):
+    for start in range(0, nchan, block):
+        yield np.arange(start, min(start + block, nchan))
+
+
+def grid_resolutions(vis, resolutions, weighting='briggs', robust=-0.5, block=32):
+    '''
+    Grids the visibilities onto the grids of several image resolutions at
+    once, so the visibilities are only traversed once for all of them
+
+    The weighting is worked out on each grid separately, as clean would for
+    each image.
+
+    Parameters
+    ----------
+    vis : Visibilities
+        visibilities to grid
+    resolutions : list
+        (imsize, cell) of each image, e.g. [(512, '500arcsec'), (512, '1000arcsec')]
+    others :
+        see grid
+
+    Returns
+    -------
+    list
+        (vis_grid, weight_sum) of each resolution, see grid
+    '''
+    if weighting not in ['natural', 'uniform', 'briggs']:
+        raise ValueError('Weighting %s not supported.' % weighting)
+    shapes = [parse_imsize(imsize) for imsize, _ in resolutions]
+    cells = [parse_cell(cell) for _, cell in resolutions]
+    nchan = len(vis.freqs)
+
+    # The natural weight in each grid cell is needed by uniform and briggs
+    cell_weights = [np.zeros(nx * ny) for nx, ny in shapes]
+    if weighting != 'natural':
+        for chans in _channel_blocks(nchan, block):
+            u, v = _uv(vis, chans)
+            w = vis.weights[:, chans]
+            for (nx, ny), cell, cw in zip(shapes, cells, cell_weights):
+                for index in _grid_index(u, v, nx, ny, cell):
+                    good = index >= 0
+                    cw += np.bincount(index[good], weights=w[good], minlength=cw.size)
+    # Same definition as CASA: the robust parameter sets the weighted cell
+    # weight at which samples are downweighted
+    f2 = [(5. * 10. ** -robust) ** 2 / ((cw ** 2).sum() / cw.sum()) if cw.sum() > 0 else 0.
+          for cw in cell_weights]
+
+    vis_grids = [np.zeros(nx * ny, dtype=complex) for nx, ny in shapes]
+    weight_sums = [0.] * len(resolutions)
+    for chans in _channel_blocks(nchan, block):
+        u, v = _uv(vis, chans)
+        w = vis.weights[:, chans]
+        d = vis.data[:, chans]
+        for i, ((nx, ny), cell) in enumerate(zip(shapes, cells)):
+            for index, values in zip(_grid_index(u, v, nx, ny, cell), [d, np.conj(d)]):
+                good = index >= 0
+                iw = w[good]
+                if weighting == 'uniform':
+                    cw = cell_weights[i][index[good]]
+                    iw = iw / np.where(cw > 0, cw, 1.)
+                elif weighting == 'briggs':
+                    iw = iw / (1. + cell_weights[i][index[good]] * f2[i])
+                npix = vis_grids[i].size
+                vis_grids[i] += np.bincount(index[good], weights=iw * values[good].real, minlength=npix)
+                vis_grids[i] += 1j * np.bincount(index[good], weights=iw * values[good].imag, minlength=npix)
+                weight_sums[i] += iw.sum()
+    return [(g.reshape(ny, nx), ws) for g, (nx, ny), ws in zip(vis_grids, shapes, weight_sums)]
+
+
+def grid(vis, imsize, cell, weighting='briggs', robust=-0.5, block=32):
+    '''
+    Grids the visibilities with the requested weighting
+
+    Parameters
+    ----------
+    vis : Visibilities
+        visibilities to grid
+    imsize : int or list
+        image size in pixels (CASA imsize)
+    cell : str, float or list
+        pixel size (CASA cell)
+    weighting : str
+        natural, uniform or briggs
+    robust : float
+        briggs robust parameter, from -2 (close to uniform) to 2 (close to
+        natural)
+    block : int
+        number of channels gridded at once, which bounds the memory used
+
+    Returns
+    -------
+    vis_grid : array
+        (ny, nx) gridded weighted visibilities
+    weight_sum : float
+        sum of the imaging weights, which normalises the image to Jy/beam
+    '''
+    return grid_resolutions(vis, [(imsize, cell)], weighting=weighting, robust=robust, block=block)[0]
+
+
+def _to_image(vis_grid, weight_sum):
+    if weight_sum == 0:
+        raise ValueError('No unflagged visibilities on the grid.')
+    image = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(vis_grid))).real
+    return image * image.size / weight_sum
+
+
+def dirty_images(vis, resolutions, weighting='briggs', robust=-0.5):
+    '''
+    Makes dirty images at several resolutions from one pass over the
+    visibilities
+
+    Parameters are the same as for grid_resolutions.
+
+    Returns
+    -------
+    list
+        image of each resolution, see dirty_image
+    '''
+    return [_to_image(vis_grid, weight_sum) for vis_grid, weight_sum in
+            grid_resolutions(vis, resolutions, weighting=weighting, robust=robust)]
+
+
+def dirty_image(vis, imsize, cell, weighting='briggs', robust=-0.5):
+    '''
+    Makes a dirty image in Jy/beam, the equivalent of clean with niter=0
+
+    Parameters are the same as for grid.
+
+    Returns
+    -------
+    array
+        (ny, nx) image, indexed [dec, ra] with RA decreasing along the
+        second axis
+    '''
+    return dirty_images(vis, [(imsize, cell)], weighting=weighting, robust=robust)[0]
+
+
+def write_fits(fitsname, image, vis, cell, overwrite=True):
+    '''
+    Writes an image to FITS with the header layout of CASA exportfits
+
+    The data has shape (1, 1, ny, nx) for the Stokes, frequency, Dec and RA
+    axes, and the phase centre is stored in CRVAL1/2 and OBSRA/OBSDEC in
+    degrees.
+    '''
+    from astropy.io import fits
+    from astropy.time import Time
+
+    ny, nx = image.shape
+    cell_deg = np.rad2deg(parse_cell(cell))
+    ra, dec = np.rad2deg(vis.ra) % 360., np.rad2deg(vis.dec)
+    chan_width = np.abs(vis.freqs[1] - vis.freqs[0]) if len(vis.freqs) > 1 else 0.
+
+    header = fits.Header()
+    header['BSCALE'] = 1.
+    header['BZERO'] = 0.
+    header['BTYPE'] = 'Intensity'
+    header['OBJECT'] = ''
+    header['BUNIT'] = 'Jy/beam'
+    header['EQUINOX'] = 2000.
+    header['RADESYS'] = 'FK5'
+    for i, (ctype, crval, cdelt, crpix, cunit) in enumerate([
+            ('RA---SIN', ra, -cell_deg, nx // 2 + 1., 'deg'),
+            ('DEC--SIN', dec, cell_deg, ny // 2 + 1., 'deg'),
+            ('FREQ', np.mean(vis.freqs), len(vis.freqs) * chan_width, 1., 'Hz'),
+            ('STOKES', 1., 1., 1., '')]):
+        header['CTYPE%d' % (i + 1)] = ctype
+        header['CRVAL%d' % (i + 1)] = crval
+        header['CDELT%d' % (i + 1)] = cdelt
+        header['CRPIX%d' % (i + 1)] = crpix
+        header['CUNIT%d' % (i + 1)] = cunit
+    header['SPECSYS'] = 'TOPOCENT'
+    header['TELESCOP'] = 'HERA'
+    header['DATE-OBS'] = Time(vis.jd, format='jd').isot
+    header['TIMESYS'] = 'UTC'
+    header['OBSRA'] = ra
+    header['OBSDEC'] = dec
+    header['ORIGIN'] = 'dirty_image.py'
+
+    data = image[None, None].astype(np.float32)
+    fits.PrimaryHDU(data=data, header=header).writeto(fitsname, overwrite=overwrite)
+
+
+def image_resolutions(fname, outputs, spw='', weighting='briggs', robust=-0.5):
+    '''
+    Reads a uvfits file once and writes its dirty image at several
+    resolutions
+
+    Parameters
+    ----------
+    fname : str
+        uvfits file
+    outputs : list
+        (fitsname, imsize, cell) of each image,
+        e.g. [('a.img.fits', 512, '500arcsec'), ('a.img2.fits', 512, '1000arcsec')]
+    others :
+        see read_uvfits and grid
+
+    Returns
+    -------
+    list
+        FITS files written
+    '''
+    vis = read_uvfits(fname, spw=spw)
+    images = dirty_images(vis, [(imsize, cell) for _, imsize, cell in outputs],
+                          weighting=weighting, robust=robust)
+    for (fitsname, _, cell), image in zip(outputs, images):
+        write_fits(fitsname, image, vis, cell)
+    return [fitsname for fitsname, _, _ in outputs]
+
+
+def image_file(fname, fitsname=None, imsize=(512, 512), cell='500arcsec', spw='',
+               weighting='briggs', robust=-0.5):
+    '''
+    Reads a uvfits file and writes its dirty image
+
+    Parameters
+    ----------
+    fname : str
+        uvfits file
+    fitsname : str
+        output FITS file. Default is fname + '.img.fits'.
+    others :
+        see read_uvfits and grid
+
+    Returns
+    -------
+    str
+        FITS file written
+    '''
+    if fitsname is None:
+        fitsname = fname + '.img.fits'
+    return image_resolutions(fname, [(fitsname, imsize, cell)], spw=spw,
+                             weighting=weighting, robust=robust)[0]
+
+
+def _image_job(job):
+    fname, outputs, params = job
+    try:
+        return image_resolutions(fname, outputs, **params)
+    except Exception as e:
+        print ('{}: {}'.format(fname, e))
+        return None
+
+
+def image_files(files, path=None, workers=None, resolutions=None, **params):
+    '''
+    Makes dirty images of many uvfits files at once, one file per process
+
+    Parameters
+    ----------
+    files : list
+        uvfits files
+    path : str
+        folder the FITS files are written to.
+        Default is next to each uvfits file.
+    workers : int
+        number of processes. Default is the number of CPUs.
+    resolutions : list
+        (imsize, cell, suffix) of each image made from a file, e.g.
+        [(512, '500arcsec', '.img.fits'), (512, '1000arcsec', '.img2.fits')].
+        All of them are made from one read of the file.
+        Default is one image named file + '.img.fits' with the imsize and
+        cell in params.
+    params :
+        imaging parameters passed to image_file
+
+    Returns
+    -------
+    list
+        FITS files written for each input, None where imaging failed
+    '''
+    if path is not None and not os.path.isdir(path):
+        raise IOError('%s not found.' % path)
+    if resolutions is None:
+        resolutions = [(params.pop('imsize', (512, 512)), params.pop('cell', '500arcsec'), '.img.fits')]
+    jobs = []
+    for f in files:
+        out = f if path is None else os.path.join(path, os.path.basename(f))
+        jobs.append((f, [(out + suffix, imsize, cell) for imsize, cell, suffix in resolutions], params))
+    pool = Pool(workers)
+    try:
+        return pool.map(_image_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make quick-look dirty images of uvfits files')
+    parser.add_argument('files', nargs='+', help='uvfits files to image')
+    parser.add_argument('--cell', nargs='+', default=['500arcsec'],
+                        help='pixel size of each image made from a file, e.g. 500arcsec 1000arcsec')
+    parser.add_argument('--imsize', type=int, nargs='+', default=[512],
+                        help='size in pixels of each (square) image, or one size for all of them')
+    parser.add_argument('--spw', default='0:100~800', help='CASA style channel selection')
+    parser.add_argument('--weighting', default='briggs', choices=['natural', 'uniform', 'briggs'])
+    parser.add_argument('--robust', type=float, default=-0.5, help='briggs robust parameter')
+    parser.add_argument('--path', default=None, help='folder for the FITS files (default: next to the data)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: all CPUs)')
+    args = parser.parse_args()
+
+    if len(args.imsize) not in [1, len(args.cell)]:
+        parser.error('give one --imsize, or one for each --cell')
+    imsizes = args.imsize * len(args.cell) if len(args.imsize) == 1 else args.imsize
+    # Named like the comparison images: file.img.fits, file.img2.fits, ...
+    resolutions = [(imsize, cell, '.img.fits' if i == 0 else '.img%d.fits' % (i + 1))
+                   for i, (imsize, cell) in enumerate(zip(imsizes, args.cell))]
+
+    results = image_files(args.files, path=args.path, workers=args.workers, resolutions=resolutions,
+                          spw=args.spw, weighting=args.weighting, robust=args.robust)
+    print ('Imaged %d of %d files' % (sum(r is not None for r in results), len(results)))
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+'''
+
+Stacks the exported images of a night into one memory-mapped cube
+
+Each image is appended to the stack as it is exported, so analysis of a
+night (light curves, beam mapping, movies) reads one float32 cube instead of
+opening hundreds of FITS files. The stack is a folder with two files:
+
+    cube.f32      raw float32 planes of shape (ny, nx), one per image
+    planes.json   image shape and one row per plane: FITS file, JD, LST,
+                  OBSRA, OBSDEC and the celestial WCS keywords
+
+Planes are written before the table, and the table is replaced atomically,
+so a stack is never left listing a plane that was not written. Appends are
+serialised with a lock file, so parallel imaging workers can share a stack.
+An image that is stacked again (e.g. after a rerun) replaces its plane.
+
+Inside CASA the planes are read from the CASA images with the image and
+quanta tools, as the CASA python has no astropy; the offline command below
+reads the FITS files with astropy.
+
+To stack exported images (in terminal):
+python image_stack.py /path/to/run_folder/stack /path/to/run_folder/imgs/*.fits
+
+To read a stack:
+    stack = ImageStack('/path/to/run_folder/stack')
+    lst = stack.lst
+    for i in stack.select_lst(1.5, 2.5):
+        plane = stack.cube[i]
+
+'''
+
+import os
+import sys
+import json
+import fcntl
+import argparse
+import threading
+import numpy as np
+from ms_manifest import jd_to_lst
+
+CUBE_NAME = 'cube.f32'
+TABLE_NAME = 'planes.json'
+LOCK_NAME = 'stack.lock'
+
+# Header keywords kept for the WCS of each plane
+WCS_KEYS = ['CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CDELT1', 'CDELT2', 'CRPIX1', 'CRPIX2',
+            'CUNIT1', 'CUNIT2', 'EQUINOX', 'RADESYS']
+
+# lockf locks belong to the process, so threads of one process also need this
+_thread_lock = threading.Lock()
+
+
+def stack_folder(run_folder, label=None):
+    '''
+    Returns the stack folder of a run, one per sub-band (see sub_bands)
+    '''
+    return os.path.join(run_folder, 'stack' if label is None else 'stack_' + label)
+
+
+def _header_row(fitsfile, header):
+    from astropy.time import Time
+
+    jd = float(Time(header['DATE-OBS'], scale='utc').jd)
+    return {'file': os.path.abspath(fitsfile),
+            'jd': jd,
+            'lst': float(jd_to_lst(jd)),
+            'obsra': header.get('OBSRA'),
+            'obsdec': header.get('OBSDEC'),
+            'wcs': dict((key, header[key]) for key in WCS_KEYS if key in header)}
+
+
+def read_header(fitsfile):
+    '''
+    Reads the metadata of an exported image without its pixels
+
+    Returns
+    -------
+    dict
+        row of the image, as read_image returns
+    '''
+    from astropy.io import fits
+
+    return _header_row(fitsfile, fits.getheader(fitsfile))
+
+
+def read_image(fitsfile):
+    '''
+    Reads the first plane and the metadata of an exported image
+
+    Returns
+    -------
+    plane : array
+        float32 image of shape (ny, nx)
+    row : dict
+        FITS file, JD and LST of DATE-OBS, OBSRA, OBSDEC and WCS keywords
+    '''
+    from astropy.io import fits
+
+    with fits.open(fitsfile) as hdus:
+        header = hdus[0].header
+        data = np.asarray(hdus[0].data, dtype=np.float32)
+    # CASA images have degenerate frequency and Stokes axes in front
+    plane = data.reshape((-1,) + data.shape[-2:])[0]
+    return plane, _header_row(fitsfile, header)
+
+
+def _to_degrees(qa, value, unit):
+    return float(qa.convert(qa.quantity(value, unit), 'deg')['value'])
+
+
+def read_casa_image(imagename, fitsfile):
+    '''
+    Reads the first plane and the metadata of a CASA image with the CASA
+    tools, for stacking inside CASA where astropy is not available
+
+    Parameters
+    ----------
+    imagename : str
+        CASA image (e.g. file.msFinal.combined.img.image)
+    fitsfile : str
+        FITS file it was exported to, which names the plane in the stack
+
+    Returns
+    -------
+    plane, row
+        as read_image returns for the FITS file
+    '''
+    from taskinit import iatool, qatool
+
+    ia = iatool()
+    qa = qatool()
+    ia.open(imagename)
+    try:
+        data = ia.getchunk()
+        cs = ia.coordsys()
+        axes = list(cs.findcoordinate('direction')['pixel'][:2])
+        units = cs.units()
+        crval = cs.referencevalue(format='n')['numeric']
+        cdelt = cs.increment(format='n')['numeric']
+        crpix = cs.referencepixel()['numeric']
+        projection = cs.projection()['type']
+        frame = cs.referencecode('direction')[0]
+        epoch = cs.epoch()
+        pointing = cs.torecord().get('pointingcenter', {})
+        cs.done()
+    finally:
+        ia.close()
+
+    # CASA axes are (RA, Dec, ...) with RA fastest in FITS, so the plane is
+    # transposed to the (ny, nx) order of the FITS data
+    plane = np.asarray(data, dtype=np.float32).reshape(data.shape[:2] + (-1,))[:, :, 0].T
+    jd = float(qa.convert(epoch['m0'], 'd')['value']) + 2400000.5
+    ra, dec = [_to_degrees(qa, crval[i], units[i]) for i in axes]
+    if 'value' in pointing:
+        obsra, obsdec = [float(np.rad2deg(v)) for v in pointing['value'][:2]]
+    else:
+        obsra, obsdec = ra, dec
+    wcs = {'CTYPE1': 'RA---' + projection, 'CTYPE2': 'DEC--' + projection,
+           'CRVAL1': ra, 'CRVAL2': dec,
+           'CDELT1': _to_degrees(qa, cdelt[axes[0]], units[axes[0]]),
+           'CDELT2': _to_degrees(qa, cdelt[axes[1]], units[axes[1]]),
+           # CASA reference pixels count from 0, FITS from 1
+           'CRPIX1': float(crpix[axes[0]]) + 1, 'CRPIX2': float(crpix[axes[1]]) + 1,
+           'CUNIT1': 'deg', 'CUNIT2': 'deg'}
+    if frame == 'J2000':
+        wcs.update({'EQUINOX': 2000., 'RADESYS': 'FK5'})
+    elif frame == 'ICRS':
+        wcs['RADESYS'] = 'ICRS'
+    row = {'file': os.path.abspath(fitsfile),
+           'jd': jd,
+           'lst': float(jd_to_lst(jd)),
+           'obsra': obsra,
+           'obsdec': obsdec,
+           'wcs': wcs}
+    return plane, row
+
+
+def plane_wcs(row, shape):
+    '''
+    Returns the celestial astropy WCS of a plane from its row of the table
+    (see read_image)
+    '''
+    from astropy.wcs import WCS
+    return WCS(dict(row['wcs'], NAXIS=2, NAXIS1=shape[1], NAXIS2=shape[0]))
+
+
+class ImageStack:
+    def __init__(self, folder):
+        '''
+        Parameters
+        ----------
+        folder : str
+            stack folder, made by the first append
+        '''
+        self.folder = folder
+        self.cube_file = os.path.join(folder, CUBE_NAME)
+        self.table_file = os.path.join(folder, TABLE_NAME)
+        self.reload()
+
+    def reload(self):
+        '''
+        Reads the plane table again, e.g. to see planes appended since
+        '''
+        try:
+            with open(self.table_file) as f:
+                table = json.load(f)
+        except (IOError, OSError):
+            table = {'shape': None, 'planes': []}
+        self.shape = None if table['shape'] is None else tuple(table['shape'])
+        self.planes = table['planes']
+        self._cube = None
+
+    def __len__(self):
+        return len(self.planes)
+
+    @property
+    def cube(self):
+        '''
+        Read-only memory map of the planes, shape (Nplanes, ny, nx)
+        '''
+        if self._cube is None and self.planes:
+            self._cube = np.memmap(self.cube_file, dtype=np.float32, mode='r',
+                                   shape=(len(self.planes),) + self.shape)
+        return self._cube
+
+    @property
+    def jd(self):
+        return np.array([row['jd'] for row in self.planes])
+
+    @property
+    def lst(self):
+        return np.array([row['lst'] for row in self.planes])
+
+    @property
+    def files(self):
+        return [row['file'] for row in self.planes]
+
+    def index(self, fitsfile):
+        '''
+        Returns the plane of an image, None if it is not stacked
+        '''
+        fitsfile = os.path.abspath(fitsfile)
+        for i, row in enumerate(self.planes):
+            if row['file'] == fitsfile:
+                return i
+        return None
+
+    def wcs(self, i):
+        '''
+        Returns the celestial astropy WCS of a plane
+        '''
+        return plane_wcs(self.planes[i], self.shape)
+
+    def select_lst(self, lst_min, lst_max):
+        '''
+        Finds the planes in a range of LST
+
+        Parameters
+        ----------
+        lst_min, lst_max : float
+            range of LST in hours. The range wraps through 24 hours if
+            lst_min is larger than lst_max.
+
+        Returns
+        -------
+        array
+            plane indices ordered by LST from lst_min
+        '''
+        lst = self.lst
+        if lst_min <= lst_max:
+            selected = np.where((lst >= lst_min) & (lst <= lst_max))[0]
+        else:
+            selected = np.where((lst >= lst_min) | (lst <= lst_max))[0]
+        return selected[np.argsort((lst[selected] - lst_min) % 24.)]
+
+    def append(self, fitsfile, imagename=None):
+        '''
+        Adds an exported image to the stack, or replaces its plane if it is
+        already stacked
+
+        Parameters
+        ----------
+        fitsfile : str
+            FITS image, e.g. from exportfits
+        imagename : str
+            CASA image the FITS image was exported from. If given, the plane
+            is read from it with the CASA tools instead of from the FITS
+            image with astropy (see read_casa_image).
+
+        Returns
+        -------
+        int
+            plane index of the image
+        '''
+        if imagename is None:
+            plane, row = read_image(fitsfile)
+        else:
+            plane, row = read_casa_image(imagename, fitsfile)
+        if not os.path.exists(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # Another worker made it first
+                pass
+        with _thread_lock:
+            with open(os.path.join(self.folder, LOCK_NAME), 'a') as lock:
+                fcntl.lockf(lock, fcntl.LOCK_EX)
+                try:
+                    # Another process may have appended since this stack was read
+                    self.reload()
+                    if self.shape is None:
+                        self.shape = plane.shape
+                    elif plane.shape != self.shape:
+                        raise ValueError('%s is %s, the stack planes are %s'
+                                         % (fitsfile, plane.shape, self.shape))
+                    i = self.index(fitsfile)
+                    if i is None:
+                        i = len(self.planes)
+                        self.planes.append(row)
+                    else:
+                        self.planes[i] = row
+                    mode = 'r+b' if os.path.exists(self.cube_file) else 'w+b'
+                    with open(self.cube_file, mode) as f:
+                        f.seek(i * plane.nbytes)
+                        f.write(plane.tobytes())
+                    tmp = self.table_file + '.tmp'
+                    with open(tmp, 'w') as f:
+                        json.dump({'shape': list(self.shape), 'planes': self.planes}, f, indent=1)
+                    os.rename(tmp, self.table_file)
+                    self._cube = None
+                finally:
+                    fcntl.lockf(lock, fcntl.LOCK_UN)
+        return i
+
+
+def stack_image(folder, fitsfile, imagename=None):
+    '''
+    Appends an exported image to a stack, printing instead of raising on
+    failure, so a stacking problem never fails the imaging of a file. The
+    stack can be completed later with image_stack.py. Inside CASA, give the
+    CASA image as imagename (see ImageStack.append).
+    '''
+    try:
+        ImageStack(folder).append(fitsfile, imagename=imagename)
+    except Exception as e:
+        print ('Not stacked: {}: {}'.format(fitsfile, e))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stack exported images into a memory-mapped cube')
+    parser.add_argument('stack', help='stack folder')
+    parser.add_argument('files', nargs='*', help='FITS images to append')
+    args = parser.parse_args()
+
+    stack = ImageStack(args.stack)
+    failed = []
+    for fitsfile in sorted(args.files):
+        try:
+            stack.append(fitsfile)
+        except Exception as e:
+            print ('{}: {}'.format(fitsfile, e))
+            failed.append(fitsfile)
+    if len(stack):
+        lst = stack.lst
+        print ('%d planes of %d x %d, LST %.3f to %.3f h' % (len(stack), stack.shape[1], stack.shape[0],
+                                                            lst.min(), lst.max()))
+    sys.exit(1 if failed else 0)
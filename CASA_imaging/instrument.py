@@ -0,0 +1,207 @@
+'''
+
+Timing and resource records for the steps of an imaging run
+
+Every step wrapped in StageLog.stage writes one json line with its wall time,
+CPU time, peak memory, bytes read and written and the sizes of its inputs and
+outputs. Each process writes its own file in run_folder/stages, so parallel
+workers never interleave their records.
+
+To summarise a run (in terminal):
+python instrument.py /path/to/run_folder
+
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+from contextlib import contextmanager
+
+
+def path_size(path):
+    '''
+    Returns the size in bytes of a file or directory, 0 if it does not exist
+    '''
+    if not os.path.exists(path):
+        return 0
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            fp = os.path.join(root, name)
+            if not os.path.islink(fp):
+                size += os.path.getsize(fp)
+    return size
+
+
+def _io_bytes():
+    '''
+    Returns the bytes this process has read from and written to storage,
+    None where /proc/self/io is not available
+    '''
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def _cpu_seconds():
+    '''
+    Returns the CPU time used by this process and its finished children
+    '''
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_utime + self_usage.ru_stime +
+            child_usage.ru_utime + child_usage.ru_stime)
+
+
+def _peak_rss():
+    '''
+    Returns the peak resident memory of this process in bytes (ru_maxrss is
+    in kilobytes on Linux)
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageLog:
+    def __init__(self, run_folder):
+        self.folder = os.path.join(run_folder, 'stages')
+        if not os.path.exists(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                if not os.path.isdir(self.folder):
+                    raise
+        self.fname = os.path.join(self.folder, '%s.%d.jsonl' % (socket.gethostname(), os.getpid()))
+
+    @contextmanager
+    def stage(self, name, inputs=(), outputs=(), **extra):
+        '''
+        Records the resources used by the code run inside the with block
+
+        Example:
+            with log.stage('clean', inputs=[infile], outputs=[imgname + '.image'], ms=infile):
+                clean(infile, imgname, **clean_params)
+
+        The peak memory is the high water mark of the whole process up to
+        the end of the stage, which is the peak of the stage itself when the
+        stages that ran before it used less.
+
+        Parameters
+        ----------
+        name : str
+            name of the step (e.g. flagdata, clean)
+        inputs : list
+            files read by the step, measured before it runs
+        outputs : list
+            files written by the step, measured after it runs
+        extra :
+            other json serialisable fields to record (e.g. ms=infile)
+        '''
+        record = {'stage': name, 'pid': os.getpid(), 'host': socket.gethostname(),
+                  'start': time.time(),
+                  'input_bytes': sum(path_size(p) for p in inputs)}
+        record.update(extra)
+        cpu = _cpu_seconds()
+        read, written = _io_bytes()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            record['wall_seconds'] = time.time() - record['start']
+            record['cpu_seconds'] = _cpu_seconds() - cpu
+            record['peak_rss_bytes'] = _peak_rss()
+            read_after, written_after = _io_bytes()
+            record['read_bytes'] = None if read is None else read_after - read
+            record['write_bytes'] = None if written is None else written_after - written
+            record['output_bytes'] = sum(path_size(p) for p in outputs)
+            record['ok'] = ok
+            with open(self.fname, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+
+def read_records(run_folder):
+    '''
+    Reads every stage record written in a run folder
+
+    Returns
+    -------
+    list
+        records as dictionaries, ordered by start time
+    '''
+    folder = os.path.join(run_folder, 'stages')
+    records = []
+    if os.path.isdir(folder):
+        for name in sorted(os.listdir(folder)):
+            if name.endswith('.jsonl'):
+                with open(os.path.join(folder, name)) as f:
+                    records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda r: r['start'])
+    return records
+
+
+def summarize(run_folder):
+    '''
+    Aggregates the stage records of a run by stage name
+
+    Parameters
+    ----------
+    run_folder : str
+        run folder holding the stages directory
+
+    Returns
+    -------
+    dict
+        per stage: number of calls and failures, total and mean wall time,
+        total CPU time, largest peak memory, total bytes read and written
+        and total output size
+    '''
+    summary = {}
+    for r in read_records(run_folder):
+        s = summary.setdefault(r['stage'], {'calls': 0, 'failed': 0, 'wall_seconds': 0.,
+                                            'cpu_seconds': 0., 'peak_rss_bytes': 0,
+                                            'read_bytes': 0, 'write_bytes': 0,
+                                            'output_bytes': 0})
+        s['calls'] += 1
+        s['failed'] += 0 if r['ok'] else 1
+        s['wall_seconds'] += r['wall_seconds']
+        s['cpu_seconds'] += r['cpu_seconds']
+        s['peak_rss_bytes'] = max(s['peak_rss_bytes'], r['peak_rss_bytes'])
+        s['read_bytes'] += r['read_bytes'] or 0
+        s['write_bytes'] += r['write_bytes'] or 0
+        s['output_bytes'] += r['output_bytes']
+    for s in summary.values():
+        s['mean_wall_seconds'] = s['wall_seconds'] / s['calls']
+    return summary
+
+
+def print_summary(summary):
+    '''
+    Prints the output of summarize as a table, slowest stage first
+    '''
+    gb = 1024. ** 3
+    print ('%-12s %6s %6s %10s %10s %10s %10s %10s %10s %10s' % ('stage', 'calls', 'failed', 'wall (s)',
+                                                             'mean (s)', 'cpu (s)', 'rss (GB)',
+                                                             'read (GB)', 'write (GB)', 'out (GB)'))
+    total = sum(s['wall_seconds'] for s in summary.values())
+    for name, s in sorted(summary.items(), key=lambda item: -item[1]['wall_seconds']):
+        print ('%-12s %6d %6d %10.1f %10.1f %10.1f %10.2f %10.2f %10.2f %10.2f' % (
+            name, s['calls'], s['failed'], s['wall_seconds'], s['mean_wall_seconds'], s['cpu_seconds'],
+            s['peak_rss_bytes'] / gb, s['read_bytes'] / gb, s['write_bytes'] / gb, s['output_bytes'] / gb))
+    print ('Total wall time in stages: %.1f s' % total)
+
+
+if __name__ == '__main__':
+    try:
+        run_folder = sys.argv[1]
+    except IndexError:
+        print ('No run folder specified')
+    else:
+        print_summary(summarize(run_folder))
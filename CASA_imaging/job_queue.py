@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+'''
+
+Job queue on a shared filesystem for imaging on several machines at once
+
+Jobs are small json files in a queue folder that every machine can see (e.g.
+on /data6). A job is a CASA script and its arguments, or a list of CASA tasks
+(see casa_worker.run_casa_task), along with the files it is expected to make.
+Any number of workers on any number of machines take jobs from the queue:
+
+    queue_folder/pending/<id>.json      waiting to run
+    queue_folder/leased/<id>.<owner>.json   running, owned by one worker
+    queue_folder/done/<id>.json         finished, with its history
+    queue_folder/failed/<id>.json       out of attempts, with its history
+
+A worker leases a job by renaming it from pending into leased under a name
+of its own. Renames are atomic on the file server, so when several workers
+race for the same job only one rename succeeds. While the job runs the worker
+touches its lease file as a heartbeat. A lease that has not been touched for
+lease_seconds belongs to a worker that died, and is put back in pending by
+whichever worker notices it first. A failed job is retried until it has been
+tried max_attempts times. SQLite is not used as its locking is unreliable
+over NFS.
+
+Lease ages are measured against the clock of the file server (the time of a
+file touched in the queue folder), so the clocks of the machines do not need
+to agree.
+
+To queue a night of measurement sets (in terminal):
+python job_queue.py /data6/queue submit <run parameters>.json <measurement sets>.ms
+
+To work on the queue with 4 CASA processes, on as many machines as wanted:
+python job_queue.py /data6/queue work --workers 4
+
+To see how the queue is doing:
+python job_queue.py /data6/queue status
+
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import threading
+from casa_worker import run_casa, run_casa_task, run_pool, convert_json
+from run_manifest import hash_params, calibration_inputs, calibration_cache_folder
+from sub_bands import image_names
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STATES = ['pending', 'leased', 'done', 'failed']
+
+
+def _write_json(fname, data):
+    '''
+    Writes a json file through a temporary file and a rename, so readers on
+    other machines never see a partial file
+    '''
+    tmp = '%s.%s.tmp' % (fname, _owner())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.rename(tmp, fname)
+
+
+def _read_json(fname):
+    '''
+    Reads a json file, None if it has gone (e.g. leased by another worker)
+    '''
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _owner():
+    '''
+    Returns a name for this process that is unique across machines
+    '''
+    return '%s-%d-%d' % (socket.gethostname().split('.')[0], os.getpid(), threading.current_thread().ident or 0)
+
+
+class JobQueue:
+    def __init__(self, folder, lease_seconds=600., max_attempts=3):
+        '''
+        Parameters
+        ----------
+        folder : str
+            queue folder on a filesystem shared by all the workers
+        lease_seconds : float
+            time without a heartbeat after which a running job is taken to
+            have died and is put back in the queue
+        max_attempts : int
+            number of times a job is tried before it is moved to failed
+        '''
+        self.folder = os.path.abspath(folder)
+        self.lease_seconds = float(lease_seconds)
+        self.max_attempts = int(max_attempts)
+        for state in STATES:
+            if not os.path.exists(os.path.join(self.folder, state)):
+                try:
+                    os.makedirs(os.path.join(self.folder, state))
+                except OSError:
+                    # Another worker made it first
+                    pass
+
+    def _path(self, state, name):
+        return os.path.join(self.folder, state, name)
+
+    def _ids(self, state):
+        '''
+        Returns the ids of the jobs in a state, oldest first
+        '''
+        entries = []
+        for name in os.listdir(os.path.join(self.folder, state)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                entries.append((os.path.getmtime(self._path(state, name)), name))
+            except OSError:
+                continue
+        entries.sort()
+        return [name.split('.')[0] for _, name in entries]
+
+    def _leases(self):
+        '''
+        Returns the (job id, lease file) pairs of the running jobs
+        '''
+        return [(name.split('.')[0], self._path('leased', name))
+                for name in os.listdir(os.path.join(self.folder, 'leased')) if name.endswith('.json')]
+
+    def now(self):
+        '''
+        Returns the current time of the file server
+
+        Lease files are touched by the file server's clock, so they are
+        compared against a file touched just now rather than this machine's
+        clock.
+        '''
+        clock = os.path.join(self.folder, '.clock.' + _owner())
+        with open(clock, 'w'):
+            pass
+        try:
+            return os.path.getmtime(clock)
+        finally:
+            os.remove(clock)
+
+    def state(self, job_id):
+        '''
+        Returns the state of a job (pending, leased, done or failed), None if
+        it is not in the queue
+        '''
+        for state in ['done', 'failed', 'pending']:
+            if os.path.exists(self._path(state, job_id + '.json')):
+                return state
+        if any(lease_id == job_id for lease_id, _ in self._leases()):
+            return 'leased'
+        return None
+
+    def submit(self, job, after=()):
+        '''
+        Adds a job to the queue
+
+        Jobs are named by a hash of their contents, so submitting the same
+        job twice (e.g. rerunning the submit command after adding files)
+        does not queue it twice.
+
+        Parameters
+        ----------
+        job : dict
+            'script' and 'args' of a CASA script to run, or 'tasks' as
+            (task name, keyword arguments) pairs. Optional keys are 'cwd'
+            (working directory of the CASA process), 'log' (file the output
+            of CASA is written to) and 'outputs' (files the job must make
+            to count as done, as CASA tasks log errors instead of raising).
+        after : list
+            ids of jobs that must be done before this one starts
+
+        Returns
+        -------
+        str
+            id of the job
+        '''
+        job = dict(job, after=list(after))
+        job_id = hash_params(job)[:16]
+        if self.state(job_id) is None:
+            _write_json(self._path('pending', job_id + '.json'),
+                        {'id': job_id, 'job': job, 'attempts': 0, 'history': [],
+                         'submitted': time.time()})
+        return job_id
+
+    def lease(self):
+        '''
+        Takes the oldest job whose dependencies are done
+
+        Returns
+        -------
+        entry : dict or None
+            job entry, None if no job can start now
+        lease : str
+            lease file, which the worker touches as a heartbeat (see beat)
+        '''
+        owner = _owner()
+        for job_id in self._ids('pending'):
+            pending = self._path('pending', job_id + '.json')
+            entry = _read_json(pending)
+            if entry is None:
+                continue
+            after = entry['job'].get('after', [])
+            failed = [dep for dep in after if os.path.exists(self._path('failed', dep + '.json'))]
+            if not all(os.path.exists(self._path('done', dep + '.json')) for dep in after) and not failed:
+                continue
+            lease = self._path('leased', '%s.%s.json' % (job_id, owner))
+            try:
+                # Touch first, so the lease does not look expired to reap
+                os.utime(pending, None)
+                os.rename(pending, lease)
+            except OSError:
+                # Another worker leased it first
+                continue
+            if failed:
+                self._finish(entry, lease, 'failed', {'error': 'dependency failed: ' + ', '.join(failed)})
+                continue
+            return entry, lease
+        return None, None
+
+    def beat(self, lease):
+        '''
+        Touches a lease file to show the job is still running
+
+        Returns
+        -------
+        bool
+            False if the lease was lost (it expired and was given back to
+            the queue)
+        '''
+        try:
+            os.utime(lease, None)
+            return True
+        except OSError:
+            return False
+
+    def _finish(self, entry, lease, state, result):
+        '''
+        Moves a leased job to done, failed or back to pending
+
+        The lease file is removed first: if that fails the lease was lost
+        and the job now belongs to someone else, so the result is dropped.
+        '''
+        try:
+            os.remove(lease)
+        except OSError:
+            return False
+        entry = dict(entry, history=entry['history'] + [result])
+        _write_json(self._path(state, entry['id'] + '.json'), entry)
+        return True
+
+    def complete(self, entry, lease, result):
+        '''
+        Marks a leased job as done
+
+        Returns
+        -------
+        bool
+            False if the lease was lost before the job finished
+        '''
+        return self._finish(entry, lease, 'done', result)
+
+    def fail(self, entry, lease, result):
+        '''
+        Puts a leased job back in the queue, or moves it to failed once it
+        has been tried max_attempts times
+
+        Returns
+        -------
+        bool
+            False if the lease was lost before the job finished
+        '''
+        entry = dict(entry, attempts=entry['attempts'] + 1)
+        state = 'failed' if entry['attempts'] >= self.max_attempts else 'pending'
+        return self._finish(entry, lease, state, result)
+
+    def reap(self):
+        '''
+        Puts the jobs of workers that stopped sending heartbeats back in the
+        queue. Each counts as a failed attempt.
+
+        Returns
+        -------
+        list
+            ids of the jobs whose leases expired
+        '''
+        now = self.now()
+        expired = []
+        for job_id, lease in self._leases():
+            try:
+                age = now - os.path.getmtime(lease)
+            except OSError:
+                continue
+            if age < self.lease_seconds:
+                continue
+            # Take over the lease so only one worker puts the job back
+            claim = self._path('leased', '%s.%s.json' % (job_id, _owner()))
+            try:
+                os.rename(lease, claim)
+            except OSError:
+                continue
+            entry = _read_json(claim)
+            owner = os.path.basename(lease)[len(job_id) + 1:-len('.json')]
+            if entry is None:
+                # Keep a lease that cannot be read for inspection, out of the
+                # queue; submitting the job again queues it afresh
+                quarantine = self._path('failed', '%s.%s.unreadable' % (job_id, owner))
+                try:
+                    os.rename(claim, quarantine)
+                except OSError:
+                    continue
+                print ('Unreadable lease of job %s moved to %s, submit it again to rerun it' % (job_id, quarantine))
+                continue
+            self.fail(entry, claim, {'owner': owner, 'status': 'expired',
+                                     'error': 'no heartbeat for %.0f s' % age})
+            expired.append(job_id)
+        return expired
+
+    def retry(self, job_ids=None):
+        '''
+        Moves failed jobs back to pending with their attempts reset
+
+        Parameters
+        ----------
+        job_ids : list
+            jobs to retry. Default is every failed job.
+
+        Returns
+        -------
+        list
+            ids of the jobs put back in the queue
+        '''
+        if job_ids is None:
+            job_ids = self._ids('failed')
+        retried = []
+        for job_id in job_ids:
+            failed = self._path('failed', job_id + '.json')
+            entry = _read_json(failed)
+            if entry is None:
+                continue
+            _write_json(self._path('pending', job_id + '.json'), dict(entry, attempts=0))
+            os.remove(failed)
+            retried.append(job_id)
+        return retried
+
+    def summary(self):
+        '''
+        Returns the number of jobs in each state
+        '''
+        return dict((state, len(self._ids(state))) for state in STATES)
+
+
+def run_job(job):
+    '''
+    Runs a job in a new CASA process
+
+    Returns
+    -------
+    dict
+        status (done or failed), return code, wall time and any missing outputs
+    '''
+    cwd = job.get('cwd')
+    if cwd is not None and not os.path.exists(cwd):
+        try:
+            os.makedirs(cwd)
+        except OSError:
+            pass
+    log = job.get('log')
+    if 'tasks' in job:
+        returncode, seconds = run_casa_task([(task, kwargs) for task, kwargs in job['tasks']], cwd=cwd, log=log)
+    else:
+        returncode, seconds = run_casa(job['script'], job.get('args', []), cwd=cwd, log=log)
+    # CASA tasks log errors instead of raising, so check for the outputs too
+    missing = [output for output in job.get('outputs', []) if not os.path.exists(output)]
+    result = {'status': 'done' if returncode == 0 and not missing else 'failed',
+              'returncode': returncode, 'seconds': seconds, 'log': log}
+    if missing:
+        result['error'] = 'missing outputs: ' + ', '.join(missing)
+    elif returncode != 0:
+        result['error'] = 'CASA exited with status %d' % returncode
+    return result
+
+
+def work(queue, workers=1, poll=30., exit_when_idle=False):
+    '''
+    Runs jobs from the queue until it is empty or the worker is stopped
+
+    Each of the workers leases one job at a time and runs it in its own CASA
+    process, sending heartbeats while it runs. Start this on every machine
+    that should take part; throughput grows with the number of workers
+    across all machines, up to the number of jobs.
+
+    Parameters
+    ----------
+    queue : JobQueue
+        queue to take jobs from
+    workers : int
+        number of jobs this machine runs at once
+    poll : float
+        seconds to wait before looking again when no job can start
+    exit_when_idle : bool
+        stop once nothing is pending or running anywhere, instead of
+        waiting for new jobs
+
+    Returns
+    -------
+    list
+        results of the jobs run by this machine
+    '''
+    results = []
+    lock = threading.Lock()
+    interval = max(1., min(60., queue.lease_seconds / 4.))
+
+    def worker(_):
+        while True:
+            queue.reap()
+            entry, lease = queue.lease()
+            if entry is None:
+                counts = queue.summary()
+                if exit_when_idle and counts['pending'] == 0 and counts['leased'] == 0:
+                    return
+                # Spread the polling of many workers out over time
+                time.sleep(poll * random.uniform(0.5, 1.5))
+                continue
+            print ('Starting job %s (attempt %d)' % (entry['id'], entry['attempts'] + 1))
+            stop = threading.Event()
+
+            def heartbeat():
+                while not stop.wait(interval):
+                    if not queue.beat(lease):
+                        print ('Lost the lease of job %s' % entry['id'])
+                        return
+
+            beater = threading.Thread(target=heartbeat)
+            beater.daemon = True
+            beater.start()
+            started = time.time()
+            try:
+                result = run_job(entry['job'])
+            except Exception as e:
+                result = {'status': 'failed', 'error': '{}: {}'.format(type(e).__name__, e)}
+            finally:
+                stop.set()
+                beater.join()
+            result = dict(result, owner=_owner(), host=socket.gethostname(), started=started, finished=time.time())
+            if result['status'] == 'done':
+                kept = queue.complete(entry, lease, result)
+            else:
+                kept = queue.fail(entry, lease, result)
+            print ('Job %s %s%s' % (entry['id'], result['status'], '' if kept else ' (lease lost, result dropped)'))
+            with lock:
+                results.append(dict(result, id=entry['id']))
+
+    run_pool(worker, range(max(1, int(workers))), workers)
+    return results
+
+
+def _absolute_config(config_data):
+    '''
+    Returns run parameters with the paths made absolute, so the jobs do not
+    depend on the directory they were submitted from
+    '''
+    config_data = json.loads(json.dumps(config_data))
+    config_data['data_path']['run_folder'] = os.path.abspath(config_data['data_path']['run_folder'])
+    config_data['clean_mask_sources']['file_name'] = os.path.abspath(config_data['clean_mask_sources']['file_name'])
+    config_data['calibration_files'] = [os.path.abspath(cal) for cal in config_data.get('calibration_files', [])]
+    if 'calibration_cache' in config_data:
+        config_data['calibration_cache'] = os.path.abspath(config_data['calibration_cache'])
+    if config_data.get('new_calibration') == 'True':
+        cal_params = config_data['new_cal_params']
+        cal_params['file_to_calibrate'] = os.path.abspath(cal_params['file_to_calibrate'])
+        for name, sources in cal_params['cal_sources'].items():
+            if type(sources) is not dict:
+                cal_params['cal_sources'][name] = os.path.abspath(sources)
+    return config_data
+
+
+def submit_images(queue, config, folders):
+    '''
+    Queues the imaging of measurement sets with a run parameter json file
+
+    Each measurement set is imaged by casa_image_ms.py in its own job. A new
+    calibration is made once, by a job the imaging jobs wait for, and the
+    imaging jobs pick it up from the calibration cache. The cache entry is
+    an output of the calibration job, so a calibration that leaves no
+    tables fails, and so do the imaging jobs waiting on it, instead of each
+    of them calibrating the same file again.
+
+    Parameters
+    ----------
+    queue : JobQueue
+        queue to add the jobs to
+    config : str
+        path of the run parameter json file
+    folders : list
+        measurement sets to image
+
+    Returns
+    -------
+    list
+        ids of the imaging jobs
+    '''
+    script = os.path.join(HERE, 'casa_image_ms.py')
+    with open(config) as f:
+        config_data = _absolute_config(convert_json(json.load(f)))
+    run_folder = config_data['data_path']['run_folder']
+    img_folder = os.path.join(run_folder, config_data['data_path']['image_folder'])
+    scratch_root = os.path.join(run_folder, 'scratch')
+
+    # Jobs read their own copy of the parameters, named by its contents
+    job_config = os.path.join(queue.folder, 'configs', '%s.%s.json' % (
+        os.path.basename(config)[:-len('.json')], hash_params(config_data)[:16]))
+    if not os.path.exists(os.path.dirname(job_config)):
+        os.makedirs(os.path.dirname(job_config))
+    _write_json(job_config, config_data)
+
+    after = []
+    if config_data['new_calibration'] == 'True':
+        scratch = os.path.join(scratch_root, 'calibration')
+        key = hash_params(calibration_inputs(config_data['new_cal_params']))
+        cache_entry = os.path.join(calibration_cache_folder(config_data), key, 'tables.json')
+        after.append(queue.submit({'script': script, 'args': [job_config], 'cwd': scratch,
+                                   'log': os.path.join(scratch, 'casa.log'), 'outputs': [cache_entry]}))
+
+    job_ids = []
+    for folder in folders:
+        folder = os.path.abspath(folder.rstrip('/'))
+        scratch = os.path.join(scratch_root, os.path.basename(folder))
+        fitsimages = [imgname + '.fits' for imgname in image_names(img_folder, folder, config_data['clean'])]
+        job_ids.append(queue.submit({'script': script, 'args': [job_config, folder, '--scratch', scratch],
+                                     'cwd': scratch, 'log': os.path.join(scratch, 'casa.log'),
+                                     'outputs': fitsimages}, after=after))
+    return job_ids
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Job queue on a shared filesystem for imaging on several machines')
+    parser.add_argument('queue', help='queue folder, on a filesystem all the machines can see')
+    parser.add_argument('--lease', type=float, default=600.,
+                        help='seconds without a heartbeat before a running job is retried (default: 600)')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='number of times a job is tried before it fails (default: 3)')
+    commands = parser.add_subparsers(dest='command')
+    submit = commands.add_parser('submit', help='queue the imaging of measurement sets')
+    submit.add_argument('config', help='run parameter json file')
+    submit.add_argument('files', nargs='+', help='measurement sets to image')
+    worker = commands.add_parser('work', help='run jobs from the queue')
+    worker.add_argument('--workers', type=int, default=1, help='number of jobs this machine runs at once')
+    worker.add_argument('--poll', type=float, default=30., help='seconds between looks at an empty queue')
+    worker.add_argument('--exit-when-idle', action='store_true',
+                        help='stop once no job is pending or running, instead of waiting for more')
+    commands.add_parser('status', help='count the jobs in each state and list the failures')
+    retry = commands.add_parser('retry', help='put failed jobs back in the queue')
+    retry.add_argument('ids', nargs='*', help='jobs to retry (default: all failed jobs)')
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue, lease_seconds=args.lease, max_attempts=args.max_attempts)
+
+    if args.command == 'submit':
+        folders = sorted(f for f in args.files if f.rstrip('/').endswith('ms'))
+        job_ids = submit_images(queue, args.config, folders)
+        print ('Queued %d measurement sets' % len(job_ids))
+    elif args.command == 'work':
+        results = work(queue, workers=args.workers, poll=args.poll, exit_when_idle=args.exit_when_idle)
+        print ('Ran %d jobs, %d failed' % (len(results), len([r for r in results if r['status'] != 'done'])))
+    elif args.command == 'status':
+        counts = queue.summary()
+        print (', '.join('%d %s' % (counts[state], state) for state in STATES))
+        for job_id in queue._ids('failed'):
+            entry = _read_json(queue._path('failed', job_id + '.json'))
+            if entry is not None:
+                print ('{}: {}'.format(job_id, entry['history'][-1].get('error') if entry['history'] else ''))
+        sys.exit(1 if counts['failed'] else 0)
+    elif args.command == 'retry':
+        retried = queue.retry(args.ids or None)
+        print ('Put %d jobs back in the queue' % len(retried))
+    else:
+        parser.print_help()
@@ -0,0 +1,213 @@
+'''
+
+Indexed lookup of CLEAN mask sources and reusable mask region files
+
+The mask sources (see imaging_runs/*/mask_sources.json) are sorted by right
+ascension once so that the sources in the field of view of a measurement set
+are found with a binary search. The sources of a bin of phase centre right
+ascension are written once to a region file shared by every measurement set in
+the bin (on any night), and the central mask, placed at the phase centre of
+each file, goes in a second small region file; clean takes both as a list.
+Region files are named by a hash of their contents, so concurrent runs never
+write to a file another run is reading.
+
+'''
+
+import os
+import bisect
+import hashlib
+import numpy as np
+
+
+def rad_to_hms(angle):
+    '''
+    Converts an angle in radians to a right ascension
+
+    Parameters
+    ----------
+    angle : float
+        angle to be converted in radians
+
+    Returns
+    -------
+    ra : string
+        right ascension calculated from the angle given in hours, minutes, and seconds
+    '''
+    if (angle < 0):
+        angle += (2*np.pi)
+    time = (angle/(2*np.pi))*24
+    hours = int(time)
+    time = (time%1)*60
+    mins = int(time)
+    secs = (time%1)*60
+    ra = str(hours) + 'h' + str(mins) + 'm' + str(secs) + 's'
+    return (ra)
+
+
+def dd_to_dms(degs):
+    '''
+    Converts an angle in decimal degrees to a degrees, minutes, and seconds
+
+    Parameters
+    ----------
+    angle : float
+        angle to be converted in decimal degrees
+
+    Returns
+    -------
+    ra : string
+        right ascension calculated from the angle given in degrees, minutes, and seconds
+    '''
+    neg = degs < 0
+    degs = (-1) ** neg * degs
+    degs, d_int = np.modf(degs)
+    mins, m_int = np.modf(60 * degs)
+    secs        =           60 * mins
+    if neg:
+        return (str(int(-d_int)) + 'd' + str(int(m_int)) +'m'+ str(secs) + 's')
+    return (str(int(d_int)) + 'd' + str(int(m_int)) +'m'+ str(secs) + 's')
+
+
+class SourceIndex:
+    def __init__(self, srcs):
+        '''
+        Parameters
+        ----------
+        srcs : dict
+            mask sources keyed by name, each with 'RA' and 'DEC' in degrees
+        '''
+        entries = sorted((float(src['RA']) % 360., name, float(src['DEC']))
+                         for name, src in srcs.items())
+        self.ras = [ra for ra, _, _ in entries]
+        self.sources = [(name, ra, dec) for ra, name, dec in entries]
+
+    def __len__(self):
+        return len(self.sources)
+
+    def query(self, ra, half_width):
+        '''
+        Finds the sources within a range of right ascension
+
+        The range may wrap through 0/360 degrees.
+
+        Parameters
+        ----------
+        ra : float
+            centre of the range in degrees
+        half_width : float
+            half the width of the range in degrees
+
+        Returns
+        -------
+        list
+            (name, RA, DEC) of the sources in the range, in degrees
+        '''
+        if half_width >= 180.:
+            return list(self.sources)
+        lo = (ra - half_width) % 360.
+        hi = (ra + half_width) % 360.
+        if lo <= hi:
+            return self._between(lo, hi)
+        return self._between(lo, 360.) + self._between(0., hi)
+
+    def _between(self, lo, hi):
+        start = bisect.bisect_left(self.ras, lo)
+        stop = bisect.bisect_right(self.ras, hi)
+        return self.sources[start:stop]
+
+
+class MaskRegions:
+    def __init__(self, srcs, folder, dec, mask_size='32000arcsec', imsize=512,
+                 cell_size=250, src_size='2000arcsec', bin_size=1.):
+        '''
+        Parameters
+        ----------
+        srcs : dict or SourceIndex
+            mask sources, with 'RA' and 'DEC' in degrees
+        folder : str
+            directory where the region files are written
+        dec : str
+            declination of the central mask (e.g. -30d47m17s)
+        mask_size : str
+            radius of the central mask
+        imsize : int
+            number of pixels along the side of the image
+        cell_size : float
+            pixel size in arcseconds
+        src_size : str
+            radius of the mask around each source
+        bin_size : float
+            width in degrees of the phase centre bins that share a region
+            file of mask sources
+        '''
+        if not isinstance(srcs, SourceIndex):
+            srcs = SourceIndex(srcs)
+        self.index = srcs
+        self.folder = folder
+        self.dec = dec
+        self.mask_size = mask_size
+        self.src_size = src_size
+        self.fov = imsize * cell_size / 3600.
+        self.bin_size = float(bin_size)
+        self._sources = {}
+
+    def mask(self, ra):
+        '''
+        Returns the CLEAN mask for a phase centre
+
+        Parameters
+        ----------
+        ra : float
+            right ascension of the phase centre in radians
+
+        Returns
+        -------
+        str or list
+            the region files of the mask sources of the RA bin, shared by
+            every file in the bin, and of the central mask of this phase
+            centre; or the central mask alone when no mask sources are in
+            the field of view
+        '''
+        mask = 'circle[[' + rad_to_hms(ra) + ', ' + self.dec + '], ' + self.mask_size + ']'
+        n = int(np.floor((np.rad2deg(ra) % 360.) / self.bin_size))
+        if n not in self._sources:
+            lines = self._source_lines((n + 0.5) * self.bin_size)
+            self._sources[n] = self._write_region(lines) if lines else None
+        if self._sources[n] is None:
+            return mask
+        return [self._sources[n], self._write_region([mask])]
+
+    def _write_region(self, lines):
+        '''
+        Writes region lines to a CRTF file named by a hash of its contents,
+        unless the file already exists
+
+        Returns
+        -------
+        str
+            path of the region file
+        '''
+        text = '\n'.join(['#CRTFv0'] + lines) + '\n'
+        fname = os.path.join(self.folder, 'mask_' + hashlib.sha1(text.encode('utf-8')).hexdigest()[:16] + '.rgn')
+        if not os.path.exists(fname):
+            if not os.path.exists(self.folder):
+                try:
+                    os.makedirs(self.folder)
+                except OSError:
+                    if not os.path.isdir(self.folder):
+                        raise
+            tmp = fname + '.' + str(os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.rename(tmp, fname)
+        return fname
+
+    def _source_lines(self, ra):
+        '''
+        Returns the region lines of the mask sources around a bin centre in
+        degrees
+        '''
+        # Widen the search by half a bin so no file in the bin misses a source
+        srcs = self.index.query(ra, self.fov / 2. + self.bin_size / 2.)
+        return ['circle[[' + rad_to_hms(np.deg2rad(src_ra)) + ', ' + dd_to_dms(src_dec) + '], ' + self.src_size + ']'
+                for _, src_ra, src_dec in srcs]
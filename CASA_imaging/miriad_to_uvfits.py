@@ -1,14 +1,47 @@
 #!/usr/bin/env python
 """
 Example:
-python miriad_to_uvfits.py /path/to/data/*.ms
+python miriad_to_uvfits.py /path/to/data/*.uv
+
+A night of files can be converted in parallel. Files are started largest
+first, and only while their estimated memory fits in the budget, so the
+node does not swap:
+python miriad_to_uvfits.py /path/to/data/*.uv --workers 8 --memory 64
+
+A report of every file converted is written to miriad_to_uvfits_report.json
+in the output directory.
+
+To go straight to measurement sets (the uvfits files are only kept until
+CASA has imported them), with CASA's executable on the PATH:
+python miriad_to_uvfits.py /path/to/data/*.uv --ms --workers 8 --tmp-path /local/scratch
+
+To phase each file to several centres from a single read, writing one
+uvfits file per centre (name.GC.uvfits, name.FornaxA.uvfits):
+python miriad_to_uvfits.py /path/to/data/*.uv --center GC=17h45m40.04s,-29d00m28.1s --center FornaxA=03h22m41.7s,-37d12m30s
 """
 
 import numpy as np
 import pyuvdata
 import sys
 import os
+import json
+import time
+import argparse
+import shutil
+import resource
+import tempfile
+from multiprocessing import Process, Pipe
 from astropy.time import Time
+from casa_worker import run_casa_task
+from rephase import rephase, centred_name, parse_center
+
+# Bytes in memory per byte of miriad visibility data. The data are read as
+# complex doubles (about twice the size on disk) and phase_to_time and
+# write_uvfits hold further copies.
+MEMORY_FACTOR = 6.
+
+# Seconds between checks on running conversions
+POLL_SECONDS = 0.5
 
 def find_uv_files(pol='xx', ends_with = 'uv', path=None):
 	"""
@@ -38,7 +71,7 @@ def find_uv_files(pol='xx', ends_with = 'uv', path=None):
 
 	folders = []
 
-	for folder in os,listdir(path):
+	for folder in os.listdir(path):
 		#If working with other formats of uv files, such as uvR files
 		#Change the end string in the following line to reflect that.
 		if folder.endswith(pol + '.HH.' + ends_with):
@@ -48,7 +81,120 @@ def find_uv_files(pol='xx', ends_with = 'uv', path=None):
 	return (folders)
 
 
-def miriad_to_uvfits(folder, pol='xx', path=None):
+def uvfits_name(folder, path=None):
+	"""
+
+	Returns the uvfits file name a uv file is converted to
+
+	"""
+
+	if path is not None:
+		if os.path.isdir(path):
+			data = os.path.basename(folder.rstrip('/'))
+			return os.path.join(path, data) + '.uvfits'
+		else:
+			raise IOError("%s not found." % path)
+	return folder.rstrip('/') + '.uvfits'
+
+
+def estimate_memory(folder, nchan=None, memory_factor=MEMORY_FACTOR):
+	"""
+
+	Estimates the memory needed to convert a uv file
+
+	Parameters
+	----------
+	folder : str
+		File path of the uv file
+	nchan : int
+		Number of channels selected. Default is all of them.
+	memory_factor : float
+		Bytes in memory per byte of visibility data on disk
+
+	Returns
+	-------
+	int
+		Estimated peak memory in bytes
+
+	"""
+
+	visdata = os.path.getsize(os.path.join(folder, 'visdata'))
+	fraction = 1.
+	if nchan is not None:
+		uv = pyuvdata.UVData()
+		uv.read_miriad(folder, read_data=False)
+		fraction = min(1., float(nchan) / uv.Nfreqs)
+	return int(visdata * memory_factor * fraction)
+
+
+def read_uv(folder, pol='xx', time_range=None, freq_chans=None):
+	"""
+
+	Reads a uv file without phasing it
+
+	Parameters
+	----------
+	folder : str
+		File path of the uv file
+	pol : str
+		Polarization to read
+	time_range : list
+		[start, end] Julian dates to read. Default is the whole file.
+	freq_chans : array
+		Channel numbers to keep. Default is all of them.
+
+	Returns
+	-------
+	UVData
+
+	"""
+
+	uv = pyuvdata.UVData()
+	# Polarization and time are selected while reading, so only that data is loaded
+	uv.read_miriad(folder,polarizations=[pol],time_range=time_range)
+	# Channels are selected before phasing, which then works on less data
+	if freq_chans is not None:
+		uv.select(freq_chans=freq_chans)
+	return uv
+
+
+def read_phased(folder, pol='xx', time_range=None, freq_chans=None):
+	"""
+
+	Reads a uv file and phases it to the middle of the observation
+
+	Parameters are as for read_uv.
+
+	Returns
+	-------
+	UVData
+
+	"""
+
+	uv = read_uv(folder, pol, time_range, freq_chans)
+	uv.phase_to_time(Time(np.median(uv.time_array),format='jd'))
+	return uv
+
+
+def write_uvfits(uv, vis_file):
+	"""
+
+	Writes a uvfits file under a temporary name and renames it when
+	complete, so a failed write never leaves a partial file
+
+	"""
+
+	tmp_file = vis_file + '.part'
+	try:
+		uv.write_uvfits(tmp_file,spoof_nonessential=True,run_check=False,run_check_acceptability=False)
+	except Exception:
+		if os.path.exists(tmp_file):
+			os.remove(tmp_file)
+		raise
+	os.rename(tmp_file, vis_file)
+
+
+def miriad_to_uvfits(folder, pol='xx', path=None, time_range=None, freq_chans=None, centers=None):
 	"""
 
 	Converts a single uv file to uvfits format
@@ -57,34 +203,352 @@ def miriad_to_uvfits(folder, pol='xx', path=None):
 	----------
 	folder : str
 		File path of the uv file to be converted to uvfits format
+	pol : str
+		Polarization to read
 	path : str
 		File path where the new uvfits file will be written.
 		Default is the current working directory.
+	time_range : list
+		[start, end] Julian dates to read. Default is the whole file.
+	freq_chans : array
+		Channel numbers to keep. Default is all of them.
+	centers : list
+		(name, ra, dec) phase centres (see rephase.parse_center). The file
+		is read once and a uvfits file phased to each centre is written,
+		named after the centre (e.g. name.GC.uvfits). Default is one file
+		phased to the middle of the observation.
+
+	Returns
+	-------
+	str or list
+		File path of the uvfits file, or of one file per phase centre
 
 	"""
 
-	if path is not None:
-		if os.path.isdir(path):
-			data = os.path.basename(folder)
-			vis_file = os.path.join(path, data) + '.uvfits'
-		else:
-			raise IOError("%s not found." % path)
+	vis_file = uvfits_name(folder, path)
+	if centers:
+		uv = read_uv(folder, pol, time_range, freq_chans)
+		vis_files = []
+		for name, phased in rephase(uv, centers):
+			vis_files.append(centred_name(vis_file, name))
+			write_uvfits(phased, vis_files[-1])
+			del phased
+		return vis_files
+	write_uvfits(read_phased(folder, pol, time_range, freq_chans), vis_file)
+	return vis_file
+
+
+def ms_name(folder, path=None):
+	"""
+
+	Returns the measurement set file name for a uv file, the same name
+	uvfits_to_ms.py gives the measurement set of its uvfits file
+
+	"""
+
+	return uvfits_name(folder, path) + '.ms'
 
-	else:
-		vis_file = folder + '.uvfits'
 
+def _write_uvfits_tmp(folder, fits_file, pol, time_range, freq_chans):
+	"""
+
+	Writes the uvfits file of a uv file. The UVData object is freed on
+	return, before CASA starts.
+
+	"""
+
+	write_uvfits(read_phased(folder, pol, time_range, freq_chans), fits_file)
+
+
+def miriad_to_ms(folder, pol='xx', path=None, time_range=None, freq_chans=None, tmp_path=None,
+		 flag=False):
+	"""
+
+	Converts a single uv file straight to a measurement set
+
+	The uvfits file CASA imports is written to a temporary directory and
+	deleted once the measurement set is complete, so only the measurement
+	set is left. As it is made by importuvfits from the same uvfits file,
+	the measurement set is the same as the one miriad_to_uvfits.py followed
+	by uvfits_to_ms.py makes. The measurement set is written under a
+	temporary name and renamed when complete.
+
+	Parameters
+	----------
+	folder : str
+		File path of the uv file to be converted
+	pol : str
+		Polarization to read
+	path : str
+		File path where the measurement set will be written.
+		Default is next to the uv file.
+	time_range : list
+		[start, end] Julian dates to read. Default is the whole file.
+	freq_chans : array
+		Channel numbers to keep. Default is all of them.
+	tmp_path : str
+		Directory for the temporary uvfits file, e.g. a local disk.
+		Default is the directory of the measurement set.
+	flag : bool
+		Flag the autocorrelations in the same CASA process
+
+	Returns
+	-------
+	str
+		File path of the measurement set
+
+	"""
+
+	vis_file = ms_name(folder, path)
+	tmp_dir = os.path.abspath(tempfile.mkdtemp(prefix='miriad_to_ms_', dir=tmp_path or os.path.dirname(os.path.abspath(vis_file))))
+	fits_file = os.path.join(tmp_dir, os.path.basename(uvfits_name(folder)))
+	tmp_ms = vis_file + '.part'
 	try:
-		uv = pyuvdata.UVData()
-		uv.read_miriad(folder,polarizations=[pol])
-		uv.phase_to_time(Time(np.median(uv.time_array),format='jd'))
-		uv.write_uvfits(vis_file,spoof_nonessential=True,run_check=False,run_check_acceptability=False)
+		_write_uvfits_tmp(folder, fits_file, pol, time_range, freq_chans)
+		if os.path.exists(tmp_ms):
+			shutil.rmtree(tmp_ms)
+		tasks = [('importuvfits', {'fitsfile': fits_file, 'vis': os.path.abspath(tmp_ms)})]
+		if flag:
+			tasks.append(('flagdata', {'vis': os.path.abspath(tmp_ms), 'autocorr': True}))
+		returncode, _ = run_casa_task(tasks, cwd=tmp_dir, log=vis_file + '.import.log')
+		if returncode != 0 or not os.path.isdir(tmp_ms):
+			raise RuntimeError('CASA exited with status %d (log: %s)' % (returncode, vis_file + '.import.log'))
+		if os.path.exists(vis_file):
+			shutil.rmtree(vis_file)
+		os.rename(tmp_ms, vis_file)
+	except Exception:
+		if os.path.exists(tmp_ms):
+			shutil.rmtree(tmp_ms)
+		raise
+	finally:
+		shutil.rmtree(tmp_dir)
+	return vis_file
+
+
+def _convert_job(job):
+	"""
+
+	Converts one file in a worker process and reports the outcome
+
+	"""
+
+	folder, params, estimate = job
+	params = dict(params)
+	convert = miriad_to_ms if params.pop('ms', False) else miriad_to_uvfits
+	start = time.time()
+	report = {'file': folder, 'estimated_bytes': estimate}
+	try:
+		report['output'] = convert(folder, **params)
+		report['status'] = 'done'
 	except Exception as e:
-		print ('{}: {}'.format(folder, e))
+		report['status'] = 'failed'
+		report['error'] = '{}: {}'.format(type(e).__name__, e)
+	report['seconds'] = time.time() - start
+	# Each worker converts a single file, so its peak memory is that of the file
+	report['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+	return report
 
-if __name__ == '__main__':
+
+def _send_job(job, conn):
+	"""
+
+	Converts a file in a worker process and sends its report back
+
+	"""
+
+	report = _convert_job(job)
 	try:
-		folders = sys.argv[1:]
-		for folder in folders:
-			miriad_to_uvfits(folder)
-	except IndexError:
+		conn.send(report)
+	except Exception as e:
+		conn.send({'file': report['file'], 'estimated_bytes': report['estimated_bytes'],
+			   'status': 'failed', 'seconds': report['seconds'],
+			   'error': 'Report not sent: {}: {}'.format(type(e).__name__, e)})
+	conn.close()
+
+
+def available_memory():
+	"""
+
+	Returns the memory available for new processes in bytes
+
+	"""
+
+	try:
+		with open('/proc/meminfo') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1]) * 1024
+	except IOError:
+		pass
+	return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def convert_files(folders, workers=1, memory=None, memory_factor=MEMORY_FACTOR, **params):
+	"""
+
+	Converts uv files in a pool of worker processes without exceeding a
+	memory budget
+
+	Files are started largest first. A file is only started while the
+	estimated memory of the running conversions plus its own fits in the
+	budget, and the next largest file that fits is started when one
+	finishes. A file larger than the budget runs on its own.
+
+	Each file is converted in a process of its own, which returns the
+	memory of the conversion to the system. A process that dies without
+	a report (e.g. killed for running out of memory) is reported as
+	failed and its memory is released from the budget.
+
+	Parameters
+	----------
+	folders : list
+		File paths of the uv files
+	workers : int
+		Maximum number of files converted at once
+	memory : float
+		Memory budget in bytes. Default is 80% of the available memory.
+	memory_factor : float
+		Bytes in memory per byte of visibility data on disk
+	params :
+		pol, path, time_range, freq_chans and centers passed to miriad_to_uvfits.
+		With ms=True the files are converted with miriad_to_ms instead,
+		which also takes tmp_path and flag.
+
+	Returns
+	-------
+	list
+		Report of each file, see _convert_job
+
+	"""
+
+	if memory is None:
+		memory = 0.8 * available_memory()
+	nchan = None if params.get('freq_chans') is None else len(params['freq_chans'])
+
+	pending = []
+	reports = []
+	for folder in folders:
+		try:
+			pending.append((folder, estimate_memory(folder, nchan, memory_factor)))
+		except Exception as e:
+			reports.append({'file': folder, 'status': 'failed',
+					'error': '{}: {}'.format(type(e).__name__, e)})
+	pending.sort(key=lambda job: -job[1])
+
+	workers = max(1, int(workers))
+	running = []
+	used = 0
+
+	def finished(report):
+		reports.append(report)
+		print ('{} {} in {:.1f} s'.format(report['status'], report['file'], report['seconds']))
+
+	try:
+		while pending or running:
+			job = None
+			if len(running) < workers:
+				for candidate in pending:
+					if not running or used + candidate[1] <= memory:
+						job = candidate
+						break
+			if job is not None:
+				pending.remove(job)
+				conn, child = Pipe(False)
+				proc = Process(target=_send_job, args=((job[0], params, job[1]), child))
+				proc.start()
+				child.close()
+				running.append((proc, conn, job, time.time()))
+				used += job[1]
+				continue
+
+			time.sleep(POLL_SECONDS)
+			for entry in list(running):
+				proc, conn, job, start = entry
+				# The report is read before the process is joined, as the
+				# process only exits once its report has been read
+				if not conn.poll() and proc.is_alive():
+					continue
+				report = None
+				if conn.poll():
+					try:
+						report = conn.recv()
+					except (EOFError, IOError):
+						pass
+				proc.join()
+				conn.close()
+				if report is None:
+					report = {'file': job[0], 'estimated_bytes': job[1], 'status': 'failed',
+						  'seconds': time.time() - start,
+						  'error': 'Worker exited with code {} without a report'.format(proc.exitcode)}
+				running.remove(entry)
+				used -= job[1]
+				finished(report)
+	finally:
+		for proc, conn, job, start in running:
+			proc.terminate()
+			proc.join()
+	return reports
+
+
+def parse_chans(chans):
+	"""
+
+	Converts a channel selection such as '100~800' or '100~300;500~800'
+	(inclusive, as in CASA) to channel numbers
+
+	"""
+
+	selected = []
+	for part in chans.split(';'):
+		start, _, stop = part.partition('~')
+		selected.extend(range(int(start), int(stop or start) + 1))
+	return np.unique(selected)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Convert miriad files to uvfits or measurement sets')
+	parser.add_argument('files', nargs='*', help='uv files to convert')
+	parser.add_argument('--pol', default='xx', help='polarization to read (default: xx)')
+	parser.add_argument('--path', default=None, help='directory for the uvfits files (default: next to the uv files)')
+	parser.add_argument('--time-range', type=float, nargs=2, default=None, metavar=('JD_START', 'JD_END'),
+			    help='only read data between these Julian dates')
+	parser.add_argument('--chans', default=None, help='channels to keep, e.g. 100~800')
+	parser.add_argument('--workers', type=int, default=1, help='number of files converted at once')
+	parser.add_argument('--memory', type=float, default=None,
+			    help='memory budget in GB (default: 80%% of the available memory)')
+	parser.add_argument('--memory-factor', type=float, default=MEMORY_FACTOR,
+			    help='bytes in memory per byte of miriad visibility data')
+	parser.add_argument('--center', action='append', default=None, metavar='NAME=RA,DEC',
+			    help='phase to this J2000 centre, e.g. GC=17h45m40.04s,-29d00m28.1s. '
+				 'Repeat to write one uvfits file per centre from a single read.')
+	parser.add_argument('--ms', action='store_true',
+			    help='write measurement sets (name.uvfits.ms) instead of uvfits files')
+	parser.add_argument('--tmp-path', default=None,
+			    help='directory for the temporary uvfits files with --ms (default: the output directory)')
+	parser.add_argument('--flag', action='store_true', help='flag the autocorrelations of each measurement set with --ms')
+	parser.add_argument('--report', default=None, help='json report file (default: miriad_to_uvfits_report.json in the output directory)')
+	args = parser.parse_args()
+
+	if not args.files:
 		print('No file specified for conversion from miriad to uvfits')
+		sys.exit(1)
+	if args.center and args.ms:
+		parser.error('--center writes uvfits files only, convert them with uvfits_to_ms.py')
+
+	reports = convert_files(args.files, workers=args.workers,
+				memory=None if args.memory is None else args.memory * 1024 ** 3,
+				memory_factor=args.memory_factor, pol=args.pol, path=args.path,
+				time_range=args.time_range,
+				freq_chans=None if args.chans is None else parse_chans(args.chans),
+				**({'ms': True, 'tmp_path': args.tmp_path, 'flag': args.flag} if args.ms else
+				   {'centers': None if args.center is None else [parse_center(c) for c in args.center]}))
+
+	report = args.report or os.path.join(args.path or os.getcwd(), 'miriad_to_uvfits_report.json')
+	failed = [r for r in reports if r['status'] != 'done']
+	with open(report, 'w') as f:
+		json.dump({'files': sorted(reports, key=lambda r: r['file']),
+			   'failed': sorted(r['file'] for r in failed)}, f, indent=2)
+	print('Converted {} of {} files, report written to {}'.format(len(reports) - len(failed), len(reports), report))
+	for r in failed:
+		print('Failed: {}: {}'.format(r['file'], r['error']))
+	sys.exit(1 if failed else 0)
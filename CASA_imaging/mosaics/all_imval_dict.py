@@ -3,6 +3,16 @@
 '''
 To run in terminal use:
 casa -c all_imval_dict.py <directory of 'img.image' files>
+
+Each image is saved as 'img.image.npz' with its values in float32 and the
+parameters of its direction coordinates (reference value, increment,
+reference pixel and projection) instead of the coordinates of every pixel.
+The coordinates are worked out when they are first used:
+	dump = load_dump('zen.2458042.12552.xx.HH.uvR.uvfits.msFinal.combined.img.image.npz')
+	ra, dec = dump.centre
+	coords = dump.coords
+
+Dumps made with the full coordinate arrays load the same way.
 '''
 
 import os
@@ -28,15 +38,106 @@ def find_image_files(path=None):
 	return (folders)
 
 
+def wcs_coords(wcs, x, y):
+	'''
+	Works out the sky coordinates of pixels from the direction coordinates
+	of an image, for the SIN projection CASA images are made with.
+	Arguments:
+		wcs - dictionary of crval, cdelt and crpix (RA then Dec, radians
+		      and 0-based pixels) and projection
+		x, y - pixel indices along the RA and Dec axes
+	Returns:
+		ra, dec - coordinates in radians
+	'''
+	if str(wcs['projection']) != 'SIN':
+		raise ValueError('Only SIN images can be loaded from their WCS, not %s' % wcs['projection'])
+	ra0, dec0 = wcs['crval']
+	l = (np.asarray(x) - wcs['crpix'][0]) * wcs['cdelt'][0]
+	m = (np.asarray(y) - wcs['crpix'][1]) * wcs['cdelt'][1]
+	n = np.sqrt(1. - l ** 2 - m ** 2)
+	dec = np.arcsin(m * np.cos(dec0) + n * np.sin(dec0))
+	ra = (ra0 + np.arctan2(l, n * np.cos(dec0) - m * np.sin(dec0))) % (2 * np.pi)
+	return ra, dec
+
+
+class ImageDump:
+	def __init__(self, npz):
+		'''
+		Values and coordinates of an image saved by create_dict
+		Argument:
+			npz - 'img.image.npz' file
+		'''
+		data = np.load(npz)
+		self.vals = data['vals']
+		self.shape = self.vals.shape[:2]
+		if 'coords' in data.files:
+			# Older dumps hold the coordinates of every pixel
+			self.wcs = None
+			self._coords = data['coords']
+		else:
+			self.wcs = dict((key, data[key]) for key in ['crval', 'cdelt', 'crpix'])
+			self.wcs['projection'] = str(data['projection'])
+			self._coords = None
+
+	def pixel(self, x, y):
+		'''
+		Returns the RA and Dec in radians of a pixel
+		'''
+		if self._coords is not None:
+			return self._coords[x, y, 0], self._coords[x, y, 1]
+		ra, dec = wcs_coords(self.wcs, x, y)
+		return float(ra), float(dec)
+
+	@property
+	def centre(self):
+		'''
+		RA and Dec in radians of the centre pixel
+		'''
+		return self.pixel(self.shape[0] // 2, self.shape[1] // 2)
+
+	@property
+	def coords(self):
+		'''
+		RA and Dec in radians of every pixel, shape (nx, ny, 2), worked out
+		on first use
+		'''
+		if self._coords is None:
+			x, y = np.meshgrid(np.arange(self.shape[0]), np.arange(self.shape[1]), indexing='ij')
+			self._coords = np.stack(wcs_coords(self.wcs, x, y), axis=-1)
+		return self._coords
+
+
+def load_dump(npz):
+	'''
+	Loads an image saved by create_dict (see ImageDump)
+	'''
+	return ImageDump(npz)
+
+
 def create_dict(folder):
 	'''
 	Used to create dictionaries for an image of 512X512 that contains the values 
-	and coordinates of said image.
+	and the direction coordinates of said image.
 	Argument:
 		folder - folder/file of image
 	'''
 	xval = imval(folder, box='0,0,511,511')
-	np.savez(folder,coords=xval['coords'],vals=xval['data'])
+	ia.open(folder)
+	try:
+		cs = ia.coordsys()
+		axes = cs.findcoordinate('direction')['pixel'][:2]
+		units = [cs.units()[i] for i in axes]
+		if units != ['rad', 'rad']:
+			raise ValueError('%s direction axes are in %s, not radians' % (folder, units))
+		crval = [cs.referencevalue(format='n')['numeric'][i] for i in axes]
+		cdelt = [cs.increment(format='n')['numeric'][i] for i in axes]
+		crpix = [cs.referencepixel()['numeric'][i] for i in axes]
+		projection = cs.projection()['type']
+		cs.done()
+	finally:
+		ia.close()
+	np.savez(folder, vals=np.asarray(xval['data'], dtype=np.float32),
+		 crval=crval, cdelt=cdelt, crpix=crpix, projection=projection)
 
 
 if __name__ == '__main__':
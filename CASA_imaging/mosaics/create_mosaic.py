@@ -2,15 +2,31 @@
 
 '''
 To run in terminal use:
-python create_mosaic.py <directory of 'img.image.npz' files>
+python create_mosaic.py <directory of 'img.image.npz' files> <beam fitsfile>
+
+To build the mosaic with 16 processes and keep the maps:
+python create_mosaic.py <directory of 'img.image.npz' files> <beam fitsfile> --workers 16 --save mosaic.npz
+
+To build a high resolution mosaic with its maps memory-mapped in a folder,
+checkpointed every 50 images (run it again to resume an interrupted mosaic):
+python create_mosaic.py <directory of 'img.image.npz' files> <beam fitsfile> --nside 2048 --checkpoint season_mosaic --checkpoint-every 50
+
+The checkpoint folder is a lasting mosaic product: the beam weighted mosaic,
+the maps it is made from and the list of images in it. To bring a season
+mosaic up to date with a new night, only that night's images are added:
+python create_mosaic.py <directory of the new night's 'img.image.npz' files> <beam fitsfile> --checkpoint season_mosaic
 '''
 
 import sys, os
+import json
+import argparse
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
 import healpy as hp
 from pyuvdata import UVBeam
 import numpy as np
 import time
+from all_imval_dict import load_dump
 
 def create_beam_avg(fitsfile):
 	hera_beam = UVBeam()
@@ -59,44 +75,524 @@ def beam_factor_2D(ra, dec, hera_zen_ra):
     return hp.get_interp_val(fullbeamavg,np_ra,np_dec, lonlat=True)
 
 def data_paste_mod(npz):
-    data=np.load(npz)
-    coords=data['coords']
-    vals=data['vals']
+    dump=load_dump(npz)
+    vals=dump.vals
     nside=512
     global emptymap
     global new_beam_countl
     vals=vals.reshape(512**2)
-    center_ra_dec=np.rad2deg(coords[256,256,:2])
-    coords=coords.reshape((512**2,4))
-    pixels=[]
-    
-    coords = np.rad2deg(coords[:, 0:2])
-    pixels = hp.ang2pix(nside, coords[:, 0], coords[:, 1], lonlat=True)
-    new_beam_count[pixels] += beam_factor_2D(coords[:, 0], coords[:, 1],center_ra_dec[0])        
+    pixels, weights = geometry.pixels(nside, dump)
+    new_beam_count[pixels] += weights
             
     emptymap[pixels]+=vals
     return emptymap
 
 
+class GeometryCache:
+    def __init__(self, decimals=2):
+        '''
+        Pixel geometry and beam weights shared by drift scan images
+
+        Images from one run have the same shape and cell size and are
+        phased at the same declination, so they only differ by the RA of
+        their phase centre. The RA offset and declination of each pixel
+        and its beam weight (see beam_factor_2D, which only depends on the
+        RA offset) are worked out for the first image of a geometry; later
+        images only shift the RA before finding their HEALPix pixels, and
+        never need the coordinates of every pixel (see load_dump).
+
+        Parameters
+        ----------
+        decimals : int
+            decimal places of a degree to which the phase centre
+            declinations of images sharing a geometry agree
+        '''
+        self.decimals = decimals
+        self.entries = {}
+
+    def key(self, dump):
+        '''
+        Returns the geometry of an image: shape, cell size in arcsec,
+        phase centre declination in degrees and the beam in use
+        '''
+        ny, nx = dump.shape
+        centre = dump.centre
+        step = np.subtract(dump.pixel(ny // 2 + 1, nx // 2), centre)
+        cell = np.rad2deg(np.hypot(step[0] * np.cos(centre[1]), step[1])) * 3600
+        return (ny, nx, round(cell, 3), round(np.rad2deg(centre[1]), self.decimals), id(fullbeamavg))
+
+    def get(self, dump):
+        '''
+        Returns the RA offsets from the phase centre and declinations of the
+        pixels in degrees, and their beam weights, flattened
+        '''
+        key = self.key(dump)
+        if key not in self.entries:
+            ny, nx = dump.shape
+            center_ra = np.rad2deg(dump.centre[0])
+            radec = np.rad2deg(dump.coords.reshape((ny * nx, -1))[:, 0:2])
+            dra = (radec[:, 0] - center_ra + 180.) % 360. - 180.
+            weights = beam_factor_2D(radec[:, 0], radec[:, 1], center_ra)
+            self.entries[key] = (dra, radec[:, 1], weights)
+        return self.entries[key]
+
+    def pixels(self, nside, dump):
+        '''
+        Finds the HEALPix pixels of an image and their beam weights
+
+        Parameters
+        ----------
+        nside : int
+            HEALPix resolution
+        dump : ImageDump
+            image dictionary from load_dump
+
+        Returns
+        -------
+        pixels : array
+            HEALPix pixel of each image pixel, flattened
+        weights : array
+            beam weight of each image pixel
+        '''
+        dra, dec, weights = self.get(dump)
+        ra = (np.rad2deg(dump.centre[0]) + dra) % 360.
+        return hp.ang2pix(nside, ra, dec, lonlat=True), weights
+
+
+# Geometry of the images seen by this process
+geometry = GeometryCache()
+
+
+# Files of a mosaic kept on disk (see MosaicAccumulator)
+MAP_FILES = {'sum': ('sum.f64', np.float64), 'weight': ('weight.f64', np.float64),
+             'hits': ('hits.i64', np.int64), 'beam_sum': ('beam_sum.f64', np.float64),
+             'beam_sq': ('beam_sq.f64', np.float64), 'mosaic': ('mosaic.f64', np.float64)}
+# Maps added to by each image, in the order reduce_pixels returns them
+SUMMED = ['sum', 'weight', 'hits', 'beam_sum', 'beam_sq']
+CHECKPOINT_NAME = 'checkpoint.json'
+UNDO_NAME = 'undo.npz'
+
+
+def reduce_pixels(pixels, vals, weights):
+    '''
+    Sums values and beam weights falling on the same HEALPix pixel
+
+    Returns
+    -------
+    touched : array
+        HEALPix pixels with at least one value, sorted
+    sums : list
+        sum of the values, of the weights B, number of values, sum of B
+        times the values and sum of B**2 of each touched pixel (see SUMMED)
+    '''
+    touched, inverse = np.unique(pixels, return_inverse=True)
+    return touched, [np.bincount(inverse, weights=vals), np.bincount(inverse, weights=weights),
+                     np.bincount(inverse), np.bincount(inverse, weights=weights * vals),
+                     np.bincount(inverse, weights=weights ** 2)]
+
+
+def combine_reduced(reduced):
+    '''
+    Adds up the outputs of reduce_pixels of several images
+
+    Parameters
+    ----------
+    reduced : list
+        (touched, sums) pairs from reduce_pixels
+
+    Returns
+    -------
+    touched, sums
+        as reduce_pixels returns for all the images together
+    '''
+    touched, inverse = np.unique(np.concatenate([r[0] for r in reduced]), return_inverse=True)
+    sums = [np.bincount(inverse, weights=np.concatenate([r[1][i] for r in reduced]))
+            for i in range(len(SUMMED))]
+    sums[SUMMED.index('hits')] = sums[SUMMED.index('hits')].astype(np.int64)
+    return touched, sums
+
+
+class MosaicAccumulator:
+    def __init__(self, nside=512, folder=None):
+        '''
+        Sum, beam weight and hit count HEALPix maps of a set of images
+
+        Accumulators built over different images are combined with merge,
+        in any order, so a mosaic can be built from partial maps made in
+        parallel.
+
+        Besides the plain sums of the values and beam weights, the maps hold
+        the beam weighted sum of the values and the sum of the squared beam
+        weights, and mosaic, their ratio: the beam weighted mean of the
+        images on the sky. mosaic is updated at the pixels of each image as
+        it is added, so a mosaic kept in a folder is brought up to date with
+        a new night by adding only that night's images.
+
+        With a folder, the maps are memory-mapped files in it, so mosaics
+        of high nside do not need to fit in memory. Images added are then
+        held back until checkpoint, which adds them to the maps and records
+        them in checkpoint.json. An interrupted mosaic is opened again from
+        the folder and carries on from its last checkpoint: images added
+        since are not in the maps, and are not listed in inputs.
+
+        Parameters
+        ----------
+        nside : int
+            HEALPix resolution of the maps
+        folder : str
+            folder of the memory-mapped maps, opened if it holds a mosaic
+        '''
+        self.nside = nside
+        self.folder = folder
+        self.inputs = []
+        self._pending = []
+        self._pending_inputs = []
+        if folder is None:
+            npix = hp.nside2npix(nside)
+            for name, (_, dtype) in MAP_FILES.items():
+                setattr(self, name, np.zeros(npix, dtype=dtype))
+        else:
+            self._open()
+
+    def _open(self):
+        npix = hp.nside2npix(self.nside)
+        checkpoint = os.path.join(self.folder, CHECKPOINT_NAME)
+        if os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                state = json.load(f)
+            if state['nside'] != self.nside:
+                raise ValueError('%s holds a mosaic of nside %d, not %d' % (self.folder, state['nside'], self.nside))
+            mode = 'r+'
+            missing = [fname for fname, _ in MAP_FILES.values() if not os.path.exists(os.path.join(self.folder, fname))]
+            if missing:
+                raise ValueError('%s has no %s, build the mosaic again' % (self.folder, ', '.join(sorted(missing))))
+        else:
+            # Maps without a checkpoint were never completed, so start again
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            state = {'nside': self.nside, 'generation': 0, 'inputs': []}
+            mode = 'w+'
+        for name, (fname, dtype) in MAP_FILES.items():
+            setattr(self, name, np.memmap(os.path.join(self.folder, fname), dtype=dtype, mode=mode, shape=(npix,)))
+        self.generation = state['generation']
+        self.inputs = state['inputs']
+        if mode == 'w+':
+            self._write_checkpoint()
+
+        # Undo an update interrupted before its checkpoint was written
+        undo = os.path.join(self.folder, UNDO_NAME)
+        if os.path.exists(undo):
+            data = np.load(undo)
+            if int(data['generation']) == self.generation:
+                for name in MAP_FILES:
+                    getattr(self, name)[data['pixels']] = data[name]
+                self._flush()
+            os.remove(undo)
+
+    def _flush(self):
+        for name in MAP_FILES:
+            getattr(self, name).flush()
+
+    def _write_checkpoint(self):
+        checkpoint = os.path.join(self.folder, CHECKPOINT_NAME)
+        tmp = checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'nside': self.nside, 'generation': self.generation, 'inputs': self.inputs}, f, indent=1)
+        os.rename(tmp, checkpoint)
+
+    @staticmethod
+    def stored_nside(folder):
+        '''
+        Returns the nside of the mosaic kept in a folder, None if there is
+        none
+        '''
+        checkpoint = os.path.join(folder, CHECKPOINT_NAME)
+        if not os.path.exists(checkpoint):
+            return None
+        with open(checkpoint) as f:
+            return json.load(f)['nside']
+
+    def _apply(self, touched, sums, inputs):
+        '''
+        Adds summed pixels into the maps and records their inputs. The
+        maps on disk are updated so that an interruption at any point
+        leaves them matching checkpoint.json, or restorable from the undo
+        file to match it.
+        '''
+        if self.folder is not None:
+            undo = os.path.join(self.folder, UNDO_NAME)
+            tmp = os.path.join(self.folder, 'undo.tmp.npz')
+            np.savez(tmp, generation=self.generation, pixels=touched,
+                     **dict((name, getattr(self, name)[touched]) for name in MAP_FILES))
+            os.rename(tmp, undo)
+        for name, summed in zip(SUMMED, sums):
+            getattr(self, name)[touched] += summed
+        beam_sq = self.beam_sq[touched]
+        self.mosaic[touched] = np.where(beam_sq > 0, self.beam_sum[touched] / np.where(beam_sq > 0, beam_sq, 1.), 0.)
+        self.inputs.extend(inputs)
+        if self.folder is not None:
+            self._flush()
+            self.generation += 1
+            self._write_checkpoint()
+            os.remove(undo)
+
+    def add(self, pixels, vals, weights, inputs=()):
+        '''
+        Adds pixel values and beam weights into the maps. Values falling on
+        the same HEALPix pixel are all added.
+
+        Parameters
+        ----------
+        pixels : array
+            HEALPix pixel of each value
+        vals, weights : array
+            values and their beam weights
+        inputs : list
+            files the values come from, recorded in inputs
+        '''
+        self.add_reduced(*reduce_pixels(pixels, vals, weights), inputs=inputs)
+
+    def add_reduced(self, touched, sums, inputs=()):
+        '''
+        Adds pixels summed by reduce_pixels into the maps, or holds them
+        until the next checkpoint if the maps are on disk
+        '''
+        if self.folder is None:
+            self._apply(touched, sums, list(inputs))
+        else:
+            self._pending.append((touched, sums))
+            self._pending_inputs.extend(inputs)
+
+    def add_npz(self, npz):
+        '''
+        Adds an image dictionary made by all_imval_dict.py, weighted by the
+        beam (see beam_factor_2D) as in data_paste_mod. The geometry of the
+        image comes from the cache of this process (see GeometryCache).
+        '''
+        dump = load_dump(npz)
+        pixels, weights = geometry.pixels(self.nside, dump)
+        self.add(pixels, dump.vals.reshape(len(pixels)), weights, inputs=[os.path.abspath(npz)])
+
+    def checkpoint(self):
+        '''
+        Adds the images held since the last checkpoint into the maps on
+        disk and records them in checkpoint.json
+        '''
+        if self.folder is None or not self._pending:
+            return
+        touched, sums = combine_reduced(self._pending)
+        self._apply(touched, sums, self._pending_inputs)
+        self._pending = []
+        self._pending_inputs = []
+
+    def merge(self, other):
+        '''
+        Adds the maps of another accumulator into this one
+
+        Returns
+        -------
+        MosaicAccumulator
+            this accumulator
+        '''
+        if other.nside != self.nside:
+            raise ValueError('Cannot merge maps of nside %d and %d' % (other.nside, self.nside))
+        touched = np.nonzero(other.hits)[0]
+        self._apply(touched, [getattr(other, name)[touched] for name in SUMMED], other.inputs)
+        return self
+
+    def save(self, fname):
+        '''
+        Writes the maps to an npz file
+        '''
+        maps = dict((name, getattr(self, name)) for name in MAP_FILES)
+        np.savez(fname, nside=self.nside, inputs=np.array(self.inputs, dtype=str), **maps)
+
+    @classmethod
+    def load(cls, fname):
+        '''
+        Reads maps written by save
+        '''
+        data = np.load(fname)
+        acc = cls(int(data['nside']))
+        for name in MAP_FILES:
+            # Files saved before the beam weighted maps only have the sums
+            if name in data.files:
+                getattr(acc, name)[:] = data[name]
+        if 'inputs' in data.files:
+            acc.inputs = [str(npz) for npz in data['inputs']]
+        return acc
+
+
+def _init_worker(beam):
+    '''
+    Sets the beam used by beam_factor_2D in a worker process
+    '''
+    global fullbeamavg
+    fullbeamavg = beam
+
+
+def _accumulate(job):
+    '''
+    Sums the pixels of a chunk of image dictionaries
+
+    Only the HEALPix pixels the chunk touches are sent back, not whole
+    maps, which would be npix in size at any coverage.
+
+    Returns
+    -------
+    reduced : tuple
+        touched pixels and sums (see combine_reduced), None if no image
+        could be read
+    inputs : list
+        image dictionaries summed
+    failed : list
+        image dictionaries that could not be read
+    '''
+    files, nside = job
+    reduced = []
+    inputs = []
+    failed = []
+    for npz in files:
+        _, image = _image_pixels((npz, nside))
+        if image is None:
+            failed.append(npz)
+        else:
+            reduced.append(image)
+            inputs.append(os.path.abspath(npz))
+    return (combine_reduced(reduced) if reduced else None), inputs, failed
+
+
+def _image_pixels(job):
+    '''
+    Finds the summed HEALPix pixels of one image dictionary (see
+    reduce_pixels), None if it cannot be read
+    '''
+    npz, nside = job
+    try:
+        dump = load_dump(npz)
+        pixels, weights = geometry.pixels(nside, dump)
+        return npz, reduce_pixels(pixels, dump.vals.reshape(len(pixels)), weights)
+    except Exception as e:
+        print('{}: {}'.format(npz, e))
+        return npz, None
+
+
+def build_mosaic(files, beam, nside=512, workers=1, folder=None, checkpoint_every=20):
+    '''
+    Builds a mosaic from image dictionaries in a pool of processes
+
+    Without a folder, the files are split into one chunk per worker. Each
+    worker sums the pixels its chunk touches, and the sums are added into
+    the maps at the end.
+
+    With a folder, the maps are memory-mapped files in it (see
+    MosaicAccumulator) and only the one copy of them is made. The workers
+    find the pixels of each image, which are added to the maps and
+    checkpointed every checkpoint_every images. Files already recorded in
+    the folder are skipped, so an interrupted mosaic is resumed by running
+    it again with the same folder.
+
+    Parameters
+    ----------
+    files : list
+        img.image.npz files made by all_imval_dict.py
+    beam : array
+        HEALPix map of the averaged beam, see create_beam_avg
+    nside : int
+        HEALPix resolution of the mosaic
+    workers : int
+        number of processes
+    folder : str
+        folder for memory-mapped, checkpointed maps
+    checkpoint_every : int
+        images added between checkpoints
+
+    Returns
+    -------
+    mosaic : MosaicAccumulator
+    failed : list
+        image dictionaries that could not be read, which are not in the
+        mosaic
+    '''
+    failed = []
+    if folder is not None:
+        mosaic = MosaicAccumulator(nside, folder)
+        done = set(mosaic.inputs)
+        todo = [npz for npz in files if os.path.abspath(npz) not in done]
+        if len(todo) < len(files):
+            print('Resuming mosaic in %s: %d of %d images already added' % (folder, len(files) - len(todo), len(files)))
+        if not todo:
+            return mosaic, failed
+        pool = Pool(max(1, min(int(workers), len(todo))), initializer=_init_worker, initargs=(beam,))
+        try:
+            held = 0
+            for npz, reduced in pool.imap(_image_pixels, [(npz, nside) for npz in todo]):
+                if reduced is None:
+                    failed.append(npz)
+                    continue
+                mosaic.add_reduced(reduced[0], reduced[1], inputs=[os.path.abspath(npz)])
+                held += 1
+                if held >= checkpoint_every:
+                    mosaic.checkpoint()
+                    held = 0
+            mosaic.checkpoint()
+        finally:
+            pool.close()
+            pool.join()
+        return mosaic, failed
+
+    workers = max(1, min(int(workers), len(files)))
+    chunks = [list(chunk) for chunk in np.array_split(files, workers)]
+    pool = Pool(workers, initializer=_init_worker, initargs=(beam,))
+    try:
+        partials = pool.map(_accumulate, [(chunk, nside) for chunk in chunks], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    mosaic = MosaicAccumulator(nside)
+    for reduced, inputs, chunk_failed in partials:
+        if reduced is not None:
+            mosaic.add_reduced(reduced[0], reduced[1], inputs=inputs)
+        failed += chunk_failed
+    return mosaic, failed
+
+
 if __name__ == '__main__':
-	try:
-		arg = sys.argv[-2:]
-		print 'Directory of image dictionaries being used is:'+arg[0]
-		print 'Beam fitsfile being used is:'+arg[1]
-		folders = find_npz_files(arg[0])
-		nside=512
-		fullbeamavg = create_beam_avg(arg[1])
-		emptymap=np.zeros(hp.nside2npix(nside))
-		new_beam_count=np.zeros(hp.nside2npix(nside))
-		for folder in folders:
-			data_paste_mod(folder)
-		beam_sum_map = hp.mollview(new_beam_count,return_projected_map=True)
-		projected_map = hp.mollview(emptymap+2,norm='log',max=2.05,xsize=4800,return_projected_map=True)
-		#beam_sum_map.savefig(str(time.time())+'beam_sum_map',format='png')
-		#projected_map.savefig(str(time.time())+'projected_map', format='png')
-		plt.show()
-	except IndexError:
+	parser = argparse.ArgumentParser(description='Build a HEALPix mosaic from image dictionaries')
+	parser.add_argument('folder', help="directory of 'img.image.npz' files")
+	parser.add_argument('beam', help='beam fitsfile')
+	parser.add_argument('--workers', type=int, default=1, help='number of processes building partial maps')
+	parser.add_argument('--nside', type=int, default=None, help='HEALPix resolution of the mosaic (default: that of the checkpoint folder, or 512)')
+	parser.add_argument('--save', default=None, help='npz file to write the maps to')
+	parser.add_argument('--checkpoint', default=None, help='folder to keep memory-mapped maps and checkpoints in; images already in it are skipped')
+	parser.add_argument('--checkpoint-every', type=int, default=20, help='images added between checkpoints (default: 20)')
+	args = parser.parse_args()
+
+	print('Directory of image dictionaries being used is:'+args.folder)
+	print('Beam fitsfile being used is:'+args.beam)
+	folders = find_npz_files(args.folder)
+	if not folders:
 		print('No file specified')
+		sys.exit(1)
+	nside = args.nside
+	if nside is None:
+		nside = (args.checkpoint and MosaicAccumulator.stored_nside(args.checkpoint)) or 512
+	fullbeamavg = create_beam_avg(args.beam)
+	mosaic, failed = build_mosaic(folders, fullbeamavg, nside=nside, workers=args.workers,
+				      folder=args.checkpoint, checkpoint_every=args.checkpoint_every)
+	for npz in failed:
+		print('Not in the mosaic: ' + npz)
+	if args.save is not None:
+		mosaic.save(args.save)
+	emptymap = mosaic.sum
+	new_beam_count = mosaic.weight
+	beam_sum_map = hp.mollview(new_beam_count,return_projected_map=True)
+	projected_map = hp.mollview(emptymap+2,norm='log',max=2.05,xsize=4800,return_projected_map=True)
+	weighted_map = hp.mollview(mosaic.mosaic,title='Beam weighted mosaic (%d images)' % len(mosaic.inputs),return_projected_map=True)
+	#beam_sum_map.savefig(str(time.time())+'beam_sum_map',format='png')
+	#projected_map.savefig(str(time.time())+'projected_map', format='png')
+	plt.show()
+	sys.exit(1 if failed else 0)
 
 '''
 nside=512
@@ -0,0 +1,249 @@
+'''
+
+Indexes the metadata of a directory of measurement sets into one json file
+
+The phase centre, time range, LST range, spectral window and polarizations of
+every measurement set are read once with CASA and written to
+ms_manifest.json in the directory of the data. The imaging driver and any LST
+selection read the manifest instead of opening the CASA tables of each file.
+
+Each entry records the size and modification time of the data files of the
+tables it was read from. A measurement set that is converted again no longer matches its entry,
+so it is indexed again the next time the directory is indexed, and the entry
+is ignored until then.
+
+To run (in terminal):
+casa -c ms_manifest.py /path/to/data/*.ms
+
+The manifest can then be read without CASA:
+    manifest = MSManifest.for_ms('/path/to/data/zen.2458042.12552.xx.HH.uvR.uvfits.ms')
+    ra, dec = manifest.phase_centre('/path/to/data/zen.2458042.12552.xx.HH.uvR.uvfits.ms')
+
+'''
+
+import os
+import json
+import numpy as np
+from casa_worker import script_args
+
+MANIFEST_NAME = 'ms_manifest.json'
+HERA_LONGITUDE = 21.42830  # degrees east
+# Tables the metadata is read from
+METADATA_TABLES = ['SOURCE', 'OBSERVATION', 'SPECTRAL_WINDOW', 'POLARIZATION']
+
+# CASA Stokes enumeration used in the CORR_TYPE column of the POLARIZATION table
+CORR_TYPES = {1: 'I', 2: 'Q', 3: 'U', 4: 'V', 5: 'rr', 6: 'rl', 7: 'lr', 8: 'll',
+              9: 'xx', 10: 'xy', 11: 'yx', 12: 'yy'}
+
+
+def jd_to_lst(jd, longitude=HERA_LONGITUDE):
+    '''
+    Converts Julian dates to local sidereal times
+
+    Uses the linear approximation of Greenwich mean sidereal time, which is
+    accurate to well under a second over the HERA observing seasons.
+
+    Parameters
+    ----------
+    jd : float or array
+        Julian dates (UTC)
+    longitude : float
+        longitude of the observatory in degrees east
+            default : HERA
+
+    Returns
+    -------
+    float or array
+        local sidereal times in hours
+    '''
+    gmst = 18.697374558 + 24.06570982441908 * (np.asarray(jd) - 2451545.0)
+    return (gmst + longitude / 15.) % 24.
+
+
+def ms_stamp(folder):
+    '''
+    Returns the size and modification time of the data files (table.dat and
+    table.f*) of each metadata table of a measurement set, which change when
+    the file is made again. Lock files and directory times are left out, as
+    CASA changes them whenever it opens a table.
+    '''
+    stamp = {}
+    for table in METADATA_TABLES:
+        path = os.path.join(folder, table)
+        files = {}
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name == 'table.dat' or name.startswith('table.f'):
+                    fname = os.path.join(path, name)
+                    files[name] = [os.path.getsize(fname), os.path.getmtime(fname)]
+        stamp[table] = files
+    return stamp
+
+
+def read_ms_metadata(folder):
+    '''
+    Reads the metadata of a single measurement set with the CASA table tool
+
+    Parameters
+    ----------
+    folder : str
+        measurement set file name
+
+    Returns
+    -------
+    dict
+        phase centre (radians), time range (JD), LST range (hours), spectral
+        window (first channel frequency, channel width and number of channels
+        in Hz), polarizations and the stamp of the tables (see ms_stamp)
+    '''
+    from casa import tb
+
+    tb.open(os.path.join(folder, 'SOURCE'))
+    direction = tb.getcol('DIRECTION')
+    tb.close()
+
+    tb.open(os.path.join(folder, 'OBSERVATION'))
+    time_range = tb.getcol('TIME_RANGE')
+    tb.close()
+
+    tb.open(os.path.join(folder, 'SPECTRAL_WINDOW'))
+    chan_freq = tb.getcol('CHAN_FREQ')
+    tb.close()
+
+    tb.open(os.path.join(folder, 'POLARIZATION'))
+    corr_type = tb.getcol('CORR_TYPE')
+    tb.close()
+
+    # TIME_RANGE is in MJD seconds
+    jd = np.array([time_range[0].min(), time_range[1].max()]) / 86400. + 2400000.5
+    return {'ra': float(direction[0][0]),
+            'dec': float(direction[1][0]),
+            'jd': [float(t) for t in jd],
+            'lst': [float(t) for t in jd_to_lst(jd)],
+            'spw': [{'freq0': float(freqs[0]),
+                     'chan_width': float(freqs[1] - freqs[0]) if len(freqs) > 1 else 0.,
+                     'nchan': len(freqs)} for freqs in chan_freq.T],
+            'pols': [CORR_TYPES.get(int(c), str(int(c))) for c in corr_type[:, 0]],
+            # Taken after reading, so the entry matches the tables as they are left
+            'stamp': ms_stamp(folder)}
+
+
+def index_ms(folders, manifest=None, force=False):
+    '''
+    Adds measurement sets to a manifest, grouped by data directory
+
+    Parameters
+    ----------
+    folders : list
+        measurement set file names
+    manifest : str
+        manifest file to write. Default is ms_manifest.json in the directory
+        of each measurement set.
+    force : bool
+        read files that are already in the manifest again, even if they
+        have not changed since
+            default : False
+
+    Returns
+    -------
+    list
+        manifest files that were written
+    '''
+    groups = {}
+    for folder in folders:
+        folder = os.path.abspath(folder.rstrip('/'))
+        path = manifest if manifest is not None else os.path.join(os.path.dirname(folder), MANIFEST_NAME)
+        groups.setdefault(path, []).append(folder)
+
+    for path, group in groups.items():
+        entries = MSManifest(path).entries
+        for folder in group:
+            if force or folder not in entries or entries[folder].get('stamp') != ms_stamp(folder):
+                print ('Indexing: ' + folder)
+                entries[folder] = read_ms_metadata(folder)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entries, f, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+    return sorted(groups)
+
+
+class MSManifest:
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (IOError, OSError):
+            self.entries = {}
+
+    @classmethod
+    def for_ms(cls, folder):
+        '''
+        Loads the manifest stored next to a measurement set
+        '''
+        folder = os.path.abspath(folder.rstrip('/'))
+        return cls(os.path.join(os.path.dirname(folder), MANIFEST_NAME))
+
+    def get(self, folder):
+        '''
+        Returns the metadata of a measurement set, None if it is not indexed
+        or has changed since it was indexed
+        '''
+        entry = self.entries.get(os.path.abspath(folder.rstrip('/')))
+        if entry is None or entry.get('stamp') != ms_stamp(folder):
+            return None
+        return entry
+
+    def phase_centre(self, folder):
+        '''
+        Returns the phase centre of a measurement set in radians
+
+        Returns
+        -------
+        ra, dec : float
+            phase centre, None if the file is not indexed or has changed
+        '''
+        entry = self.get(folder)
+        if entry is None:
+            return None
+        return entry['ra'], entry['dec']
+
+    def select_lst(self, lst_min, lst_max):
+        '''
+        Finds the measurement sets overlapping a range of LST
+
+        Parameters
+        ----------
+        lst_min, lst_max : float
+            range of LST in hours. The range wraps through 24 hours if
+            lst_min is larger than lst_max.
+
+        Returns
+        -------
+        list
+            sorted measurement set file names, leaving out files that have
+            changed since they were indexed
+        '''
+        def contains(start, stop, lst):
+            if start <= stop:
+                return start <= lst <= stop
+            return lst >= start or lst <= stop
+
+        selected = []
+        for folder, entry in self.entries.items():
+            if entry.get('stamp') != ms_stamp(folder):
+                continue
+            start, stop = entry['lst']
+            if contains(lst_min, lst_max, start) or contains(start, stop, lst_min):
+                selected.append(folder)
+        return sorted(selected)
+
+
+if __name__ == '__main__':
+    args = script_args('ms_manifest.py')
+    force = '--force' in args
+    folders = [folder for folder in args if folder.rstrip('/').endswith('ms')]
+    if len(folders) == 0:
+        print ('No measurement sets specified for indexing')
+    for path in index_ms(folders, force=force):
+        print ('Wrote: ' + path)
@@ -0,0 +1,214 @@
+'''
+
+Staged pipeline for processing many files through a chain of steps
+
+Each stage (e.g. import, flag, image) has its own pool of worker threads and
+is connected to the next stage by a bounded queue, so file N+1 can be
+imported while file N is being cleaned. The stage functions are expected to
+do their work in a separate process (see casa_worker.run_casa_task), so the
+threads only wait on them. The bounded queues keep a fast stage from running
+far ahead of a slow one and filling the disk.
+
+Example:
+    stages = [Stage('import', import_file, workers=2),
+              Stage('flag', flag_file, workers=2),
+              Stage('image', image_file, workers=4)]
+    results = Pipeline(stages).run(files)
+
+'''
+
+import sys
+import time
+import threading
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from casa_worker import run_casa_task
+
+_DONE = object()
+
+
+def casa_tasks(tasks, log=None):
+    '''
+    Runs CASA tasks in a new CASA process for a pipeline stage
+
+    Parameters
+    ----------
+    tasks : list
+        (task name, keyword arguments) pairs, see casa_worker.run_casa_task
+    log : str
+        file that the output of the CASA process is written to
+
+    Raises
+    ------
+    RuntimeError
+        if the CASA process or one of the tasks failed
+    '''
+    returncode, _ = run_casa_task(tasks, log=log)
+    if returncode != 0:
+        raise RuntimeError('CASA exited with status %d running %s (log: %s)'
+                           % (returncode, ', '.join(task for task, _ in tasks), log))
+
+
+class Stage:
+    def __init__(self, name, func, workers=1):
+        '''
+        Parameters
+        ----------
+        name : str
+            name of the stage used in the report
+        func : function
+            called with the output of the previous stage (or the input item
+            for the first stage). Its return value is passed to the next
+            stage. An exception marks the item as failed.
+        workers : int
+            number of items this stage works on at once
+        '''
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.done = 0
+        self.failed = 0
+        self.busy = 0.
+        self.start = None
+        self.stop = None
+        self._lock = threading.Lock()
+
+    def _record(self, start, stop, ok):
+        with self._lock:
+            if self.start is None or start < self.start:
+                self.start = start
+            if self.stop is None or stop > self.stop:
+                self.stop = stop
+            self.busy += stop - start
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+
+    def stats(self):
+        '''
+        Returns the throughput of the stage
+
+        Returns
+        -------
+        dict
+            items done and failed, seconds spent working, wall time between
+            the first item starting and the last finishing, items per hour
+            and the mean number of workers busy
+        '''
+        wall = (self.stop - self.start) if self.start is not None else 0.
+        return {'stage': self.name,
+                'workers': self.workers,
+                'done': self.done,
+                'failed': self.failed,
+                'busy_seconds': self.busy,
+                'wall_seconds': wall,
+                'items_per_hour': 3600. * self.done / wall if wall > 0 else 0.,
+                'mean_busy_workers': self.busy / wall if wall > 0 else 0.}
+
+
+class Pipeline:
+    def __init__(self, stages, queue_size=2):
+        '''
+        Parameters
+        ----------
+        stages : list
+            Stage objects, in order
+        queue_size : int
+            number of finished items that may wait between two stages
+        '''
+        self.stages = stages
+        self.queue_size = queue_size
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def _work(self, stage, inbox, outbox):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # Pass the marker on so the other workers of this stage stop
+                inbox.put(_DONE)
+                return
+            key, value = item
+            start = time.time()
+            try:
+                result = stage.func(value)
+                ok = True
+            except Exception:
+                ok = False
+                with self._lock:
+                    self.failures.append({'item': key, 'stage': stage.name,
+                                          'error': traceback.format_exc()})
+                sys.stderr.write('%s failed in %s\n' % (key, stage.name))
+            stage._record(start, time.time(), ok)
+            if ok:
+                outbox.put((key, result))
+
+    def run(self, items):
+        '''
+        Runs every item through all the stages
+
+        Parameters
+        ----------
+        items : list
+            inputs to the first stage
+
+        Returns
+        -------
+        dict
+            output of the last stage keyed by input item, for the items
+            that made it through every stage
+        '''
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        results = queue.Queue()
+        queues.append(results)
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            stage_threads = [threading.Thread(target=self._work, args=(stage, queues[i], queues[i + 1]))
+                             for _ in range(stage.workers)]
+            for t in stage_threads:
+                t.daemon = True
+                t.start()
+            threads.append(stage_threads)
+
+        for item in items:
+            queues[0].put((item, item))
+        queues[0].put(_DONE)
+
+        # Each stage is finished once all of its workers have seen the marker
+        for i, stage_threads in enumerate(threads):
+            for t in stage_threads:
+                t.join()
+            queues[i + 1].put(_DONE)
+
+        output = {}
+        while True:
+            item = results.get()
+            if item is _DONE:
+                break
+            output[item[0]] = item[1]
+        return output
+
+    def report(self):
+        '''
+        Prints the throughput of each stage and the failed items
+
+        Returns
+        -------
+        list
+            stats of each stage (see Stage.stats)
+        '''
+        stats = [stage.stats() for stage in self.stages]
+        print ('%-10s %8s %6s %6s %12s %12s %10s' % ('stage', 'workers', 'done', 'failed',
+                                                  'busy (s)', 'items/hour', 'busy/wall'))
+        for s in stats:
+            print ('%-10s %8d %6d %6d %12.1f %12.1f %10.2f' % (s['stage'], s['workers'], s['done'], s['failed'],
+                                                             s['busy_seconds'], s['items_per_hour'],
+                                                             s['mean_busy_workers']))
+        for failure in self.failures:
+            print ('Failed: %s in %s' % (failure['item'], failure['stage']))
+        return stats
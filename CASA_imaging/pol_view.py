@@ -0,0 +1,142 @@
+'''
+
+Relabelled views of measurement sets for imaging one polarization as another
+
+CASA only images the xx polarization of a single polarization measurement
+set as Stokes I, so xy, yx and yy files are imaged by labelling them as xx.
+Instead of editing the POLARIZATION table of the original file, a reference
+copy is made: the small tables are copied, the large data files of the main
+table are symbolic links to the original, and only the copied POLARIZATION
+table is edited. The original is never opened for writing, so a run that
+dies part way leaves it untouched and any number of jobs can image the same
+file at once.
+
+The view is only meant for tasks that read the data (e.g. clean with
+niter=0). Tasks that write to the main table (applycal, flagdata, ft) would
+write through the links into the original file.
+
+'''
+
+import os
+import shutil
+
+# CASA Stokes codes of the polarizations found in HERA files
+CORR_TYPES = {'xx': 9, 'xy': 10, 'yx': 11, 'yy': 12}
+
+
+def _is_data_file(name):
+    '''
+    Returns True for the column data files of a table (table.f0,
+    table.f0_TSM1, ...), which hold the bulk of a measurement set
+    '''
+    return name.startswith('table.f')
+
+
+def reference_copy(ms, vis_file):
+    '''
+    Makes a copy of a measurement set that shares its data files
+
+    The copy is made under a temporary name and renamed when complete, so a
+    partly written view is never left at vis_file.
+
+    Parameters
+    ----------
+    ms : str
+        measurement set to copy
+    vis_file : str
+        path of the copy. An existing copy is replaced.
+
+    Returns
+    -------
+    str
+        path of the copy
+    '''
+    ms = os.path.abspath(ms.rstrip('/'))
+    vis_file = os.path.abspath(vis_file.rstrip('/'))
+    tmp = '%s.tmp%d' % (vis_file, os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for name in os.listdir(ms):
+        src = os.path.join(ms, name)
+        dst = os.path.join(tmp, name)
+        if os.path.isdir(src):
+            # Subtables are small, and a copy gives each view its own lock files
+            shutil.copytree(src, dst, symlinks=True)
+        elif _is_data_file(name):
+            os.symlink(src, dst)
+        else:
+            shutil.copy2(src, dst)
+    if os.path.exists(vis_file):
+        remove_view(vis_file)
+    os.rename(tmp, vis_file)
+    return vis_file
+
+
+def remove_view(vis_file):
+    '''
+    Deletes a reference copy. Only the links are removed, not the data
+    files of the original measurement set.
+    '''
+    # rmtree removes symbolic links without following them
+    shutil.rmtree(vis_file)
+
+
+def relabel_pol(vis_file, corr_type=9):
+    '''
+    Sets the polarization of a single polarization measurement set
+
+    Run this on a reference copy, not on the original file.
+
+    Parameters
+    ----------
+    vis_file : str
+        measurement set to relabel
+    corr_type : int
+        CASA Stokes code to label the data with (see CORR_TYPES). Default is xx.
+
+    Returns
+    -------
+    int
+        original Stokes code of the data
+    '''
+    from casa import tb
+
+    tb.open(os.path.join(vis_file, 'POLARIZATION'), nomodify=False)
+    try:
+        origin_pol = tb.getcell('CORR_TYPE', 0)
+        if len(origin_pol) != 1:
+            raise ValueError('%s has %d polarizations, only single polarization files can be relabelled.'
+                             % (vis_file, len(origin_pol)))
+        if origin_pol[0] != corr_type:
+            tb.putcell('CORR_TYPE', 0, [corr_type])
+    finally:
+        tb.close()
+    return int(origin_pol[0])
+
+
+def pol_view(ms, vis_file, corr_type=9):
+    '''
+    Makes a reference copy of a measurement set labelled with another
+    polarization
+
+    Parameters
+    ----------
+    ms : str
+        single polarization measurement set. It is not modified.
+    vis_file : str
+        path of the view
+    corr_type : int
+        CASA Stokes code to label the data with. Default is xx.
+
+    Returns
+    -------
+    int
+        original Stokes code of the data
+    '''
+    reference_copy(ms, vis_file)
+    try:
+        return relabel_pol(vis_file, corr_type)
+    except Exception:
+        remove_view(vis_file)
+        raise
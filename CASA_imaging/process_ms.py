@@ -5,53 +5,72 @@ Script to generate image from a measurement set using David's procedure
 '''
 
 import os
+import shutil
 from casa import *
 import numpy as np
+import json
+from run_manifest import RunManifest, CalibrationCache, image_key, hash_params, calibration_inputs, calibration_cache_folder
+from instrument import StageLog
+from casa_worker import run_casa_task, run_pool
+from sub_bands import sub_bands, image_name
+from image_stack import stack_folder, stack_image
 
 class CASA_Imaging:
     def __init__(self,config_data):
-	self.gaintable = []
-    	if config_data['new_calibration'] == 'True':
-        	cal_params = config_data['new_cal_params']
-        	self.infile = cal_params['file_to_calibrate']
-        	self.kcal = cal_params['kcal']
-        	self.gcal = cal_params['gcal']
-        	self.model_name = cal_params['model_name']
-        	self.cal_sources = cal_params['cal_sources']
-        	self.clean_1_params = cal_params['clean_1']
-        	self.clean_2_params = cal_params['clean_2']
-       		self.clean_final_params = cal_params['clean_final']
-        	self.band_pass_1 = cal_params['band_pass_1']
-        	self.band_pass_2 = cal_params['band_pass_2']
-        	self.cal_flag = cal_params['flag']
-        	try:
-            		if self.cal_flag['autocorr'] == "True":
-                		self.cal_flag['autocorr'] = True
-            		elif self.cal_flag['autocorr'] == "False":
-                		self.cal_flag['autocorr'] = False
-        	except:
-            		pass
-    	else:
-        	self.gaintable = config_data['calibration_files']
-
-    	self.run_folder = config_data['data_path']['run_folder']
-    	self.img_folder = os.path.join(self.run_folder, config_data['data_path']['image_folder'])
-
-    	if not os.path.exists(self.run_folder):
-        	os.makedirs(self.run_folder)
-    	if not os.path.exists(self.img_folder):
-    		os.makedirs(self.img_folder)
-
-    	self.final_clean_params = config_data['clean']
-	self.flag_params = config_data['flag']
-
-	try:
-        	if self.flag_params['autocorr'] == "True":
-            		self.flag_params['autocorr'] = True
-        	elif self.flag_params['autocorr'] == "False":
-            		self.flag_params['autocorr'] = False
-    	except:
-        	pass
+        self.gaintable = []
+        if config_data['new_calibration'] == 'True':
+            cal_params = config_data['new_cal_params']
+            self.cal_params = cal_params
+            self.infile = cal_params['file_to_calibrate']
+            self.kcal = cal_params['kcal']
+            self.gcal = cal_params['gcal']
+            self.model_name = cal_params['model_name']
+            self.cal_sources = cal_params['cal_sources']
+            self.clean_1_params = cal_params['clean_1']
+            self.clean_2_params = cal_params['clean_2']
+            self.clean_final_params = cal_params['clean_final']
+            self.band_pass_1 = cal_params['band_pass_1']
+            self.band_pass_2 = cal_params['band_pass_2']
+            self.cal_flag = cal_params['flag']
+            self.split_free = cal_params.get('split_free', 'False') == 'True'
+            try:
+                if self.cal_flag['autocorr'] == "True":
+                    self.cal_flag['autocorr'] = True
+                elif self.cal_flag['autocorr'] == "False":
+                    self.cal_flag['autocorr'] = False
+            except:
+                pass
+        else:
+            self.gaintable = config_data['calibration_files']
+
+        self.run_folder = config_data['data_path']['run_folder']
+        self.img_folder = os.path.join(self.run_folder, config_data['data_path']['image_folder'])
+
+        if not os.path.exists(self.run_folder):
+            os.makedirs(self.run_folder)
+        if not os.path.exists(self.img_folder):
+            os.makedirs(self.img_folder)
+
+        self.final_clean_params = config_data['clean']
+        self.flag_params = config_data['flag']
+        # Number of sub-band cleans run at once, default is all of them
+        self.sub_band_workers = config_data.get('sub_band_workers')
+        # Append each exported image to the stack of the run (see image_stack)
+        self.image_stack = config_data.get('image_stack', 'False') == 'True'
+        self.manifest = RunManifest(self.run_folder)
+        self.log = StageLog(self.run_folder)
+
+        # Calibration tables are cached next to the run folder so that runs
+        # sharing a calibration can reuse it
+        self.cal_cache_folder = calibration_cache_folder(config_data)
+
+        try:
+            if self.flag_params['autocorr'] == "True":
+                self.flag_params['autocorr'] = True
+            elif self.flag_params['autocorr'] == "False":
+                self.flag_params['autocorr'] = False
+        except:
+            pass
 
     def _calname(self,m,c):
         '''
@@ -80,7 +99,8 @@ class CASA_Imaging:
         infile : str
             input measurement set file name
         '''
-        flagdata(infile, autocorr=True)
+        with self.log.stage('flagdata', inputs=[infile], ms=infile):
+            flagdata(infile, autocorr=True)
 
     def _gaincal(self, infile, kcal=None, gcal=None):
         '''
@@ -108,11 +128,13 @@ class CASA_Imaging:
 
         #create calibration files
         kc = os.path.join(self.run_folder,self._calname(infile, "K"))
-        gaincal(infile, caltable=kc, gaintype='K', **kcal)
+        with self.log.stage('gaincal', inputs=[infile], outputs=[kc], ms=infile, gaintype='K'):
+            gaincal(infile, caltable=kc, gaintype='K', **kcal)
 
         #check for frequency errors
         gc = os.path.join(self.run_folder,self._calname(infile, "G"))
-        gaincal(infile, caltable=gc, gaintype='G', gaintable=kc, **gcal)
+        with self.log.stage('gaincal', inputs=[infile], outputs=[gc], ms=infile, gaintype='G'):
+            gaincal(infile, caltable=gc, gaintype='G', gaintable=kc, **gcal)
 
         # Apply the calibration to the infile
         self._apply_cal(infile, [kc, gc])
@@ -133,7 +155,8 @@ class CASA_Imaging:
         '''
         if gaintable is None:
             gaintable = self.gaintable
-        applycal(infile,gaintable=gaintable)
+        with self.log.stage('applycal', inputs=[infile], ms=infile):
+            applycal(infile,gaintable=gaintable)
 
     def _split(self,infile,outfile,spw=""):
         '''
@@ -150,7 +173,8 @@ class CASA_Imaging:
             spectral window for the split to isolate
                 default : ""
         '''
-        split(infile, outfile, datacolumn="corrected", spw=spw)
+        with self.log.stage('split', inputs=[infile], outputs=[outfile], ms=infile):
+            split(infile, outfile, datacolumn="corrected", spw=spw)
 
     def _clean(self,infile, imgname,**kwargs):
         '''
@@ -163,9 +187,10 @@ class CASA_Imaging:
         imgname : str
             file name of the output image files
         '''
-        clean(vis=infile, imagename=imgname, **kwargs)
+        with self.log.stage('clean', inputs=[infile], outputs=[imgname + '.image'], ms=infile):
+            clean(vis=infile, imagename=imgname, **kwargs)
 
-    def _band_pass(self,infile,**kwargs):
+    def _band_pass(self,infile,gaintable=None,cal="B",**kwargs):
         '''
         Creates a bandpass calibration solution
 
@@ -173,13 +198,63 @@ class CASA_Imaging:
         ----------
         infile : str
             input measurement set file name
+        gaintable : list
+            calibration files applied on the fly while solving. These are
+            applied together with the new solution afterwards.
+                default : None
+        cal : str
+            calibration name used in the file name of the solution
+                default : "B"
         '''
-        bc = self._calname(infile, "B")
-	bc = os.path.join(self.run_folder,bc)
-	bandpass(vis=infile, caltable=bc, solnorm=False, **kwargs)
-        applycal(infile, gaintable=[bc])
+        if gaintable is None:
+            gaintable = []
+        bc = self._calname(infile, cal)
+        bc = os.path.join(self.run_folder,bc)
+        # solnorm is given as a string in the run files
+        solnorm = kwargs.pop('solnorm', False)
+        if solnorm in ('True', 'False'):
+            solnorm = (solnorm == 'True')
+        if len(gaintable) > 0:
+            kwargs['gaintable'] = gaintable
+        with self.log.stage('bandpass', inputs=[infile], outputs=[bc], ms=infile):
+            bandpass(vis=infile, caltable=bc, solnorm=solnorm, **kwargs)
+        self._apply_cal(infile, gaintable + [bc])
         return (bc)
 
+    def _cal_inputs(self, infile=None):
+        '''
+        Collects the inputs that determine the calibration tables
+
+        Returns
+        -------
+        dict
+            calibrated file, model components and calibration parameters
+        '''
+        return calibration_inputs(self.cal_params, infile)
+
+    def load_cached_calibration(self, infile=None):
+        '''
+        Sets the gaintable from the calibration cache if an earlier run made
+        calibration tables from the same inputs
+
+        Parameters
+        ----------
+        infile : str
+            input measurement set file name
+
+        Returns
+        -------
+        bool
+            True if cached calibration tables were found
+        '''
+        key = hash_params(self._cal_inputs(infile))
+        tables = CalibrationCache(self.cal_cache_folder).get(key)
+        if tables is None:
+            return False
+        print ('\nUsing cached calibration: ' + os.path.join(self.cal_cache_folder, key) + '\n')
+        self.gaintable = tables
+        return True
+
     def create_cal_files(self,infile=None):
         '''
         Runs the full processing algorithm including calibration file creation on
@@ -193,12 +268,15 @@ class CASA_Imaging:
         img_dir : str
             directory name where image files are written
         '''
-	if infile is None:
-	    infile = self.infile
+        if infile is None:
+            infile = self.infile
+        if self.split_free:
+            return self._create_cal_files_chained(infile)
         run_dir = self.run_folder
         img_dir = self.img_folder
         print ('\nFlagging Data...\n')
-        flagdata(infile, **self.cal_flag)
+        with self.log.stage('flagdata', inputs=[infile], ms=infile):
+            flagdata(infile, **self.cal_flag)
 
         print ('\nInitial Calibration...\n')
         kc, gc = self._gaincal(infile)
@@ -209,7 +287,7 @@ class CASA_Imaging:
         self._split(infile,file_to_clean)
 
         print ('\nCleaning Data...\n')
-        clean(vis=file_to_clean,imagename=imgname, **self.clean_1_params)
+        self._clean(file_to_clean, imgname, **self.clean_1_params)
 
         print ('\nRunning Band Pass...\n')
         bc = self._band_pass(file_to_clean, **self.band_pass_1)
@@ -220,7 +298,7 @@ class CASA_Imaging:
         imgname2 = file_to_clean +".init.img"
 
         print ('\nCleaning Data...\n')
-        clean(vis=file_2_clean, imagename=imgname2, **self.clean_2_params)
+        self._clean(file_2_clean, imgname2, **self.clean_2_params)
 
         print ('\nRunning Band Pass...\n')
         bc1 = self._band_pass(file_2_clean, **self.band_pass_2)
@@ -229,14 +307,158 @@ class CASA_Imaging:
         imgnameFinal = os.path.join(img_dir,os.path.basename(imgnameFinal))
 
         print ('\nFinal Clean...\n')
-        clean(vis=file_3_clean, imagename=imgnameFinal, **self.clean_final_params)
+        self._clean(file_3_clean, imgnameFinal, **self.clean_final_params)
+
+        self.gaintable = [kc,gc,bc,bc1]
+        self._cache_cal_files(infile)
+
+    def _create_cal_files_chained(self, infile):
+        '''
+        Runs the same calibration as create_cal_files without splitting the
+        corrected data into new measurement sets
+
+        Each bandpass solve applies the earlier solutions on the fly through
+        its gaintable, so all solutions come from the one measurement set and
+        only its CORRECTED_DATA column is rewritten between rounds. The
+        intermediate cleans write their model to the MODEL_DATA column
+        (usescratch=True) so that it replaces the starting model for the
+        following bandpass, as it does in a freshly split measurement set.
+        Unlike the split chain, the second bandpass is solved over all
+        channels, so its channels line up with the files it is applied to.
+
+        Parameters
+        ----------
+        infile : str
+            input measurement set file name
+        '''
+        run_dir = self.run_folder
+        img_dir = self.img_folder
+        print ('\nFlagging Data...\n')
+        with self.log.stage('flagdata', inputs=[infile], ms=infile):
+            flagdata(infile, **self.cal_flag)
+
+        print ('\nInitial Calibration...\n')
+        kc, gc = self._gaincal(infile)
+
+        print ('\nCleaning Data...\n')
+        imgname = os.path.join(run_dir,os.path.basename(infile) + ".init.img")
+        clean_params = dict(usescratch=True)
+        clean_params.update(self.clean_1_params)
+        self._clean(infile, imgname, **clean_params)
+
+        print ('\nRunning Band Pass...\n')
+        bc = self._band_pass(infile, gaintable=[kc,gc], **self.band_pass_1)
+
+        print ('\nCleaning Data...\n')
+        imgname2 = os.path.join(run_dir,os.path.basename(infile) + ".init2.img")
+        clean_params = dict(usescratch=True)
+        clean_params.update(self.clean_2_params)
+        self._clean(infile, imgname2, **clean_params)
+
+        print ('\nRunning Band Pass...\n')
+        bc1 = self._band_pass(infile, gaintable=[kc,gc,bc], cal="B2", **self.band_pass_2)
+        imgnameFinal = infile + "Final.combined.img"
+        imgnameFinal = os.path.join(img_dir,os.path.basename(imgnameFinal))
+
+        print ('\nFinal Clean...\n')
+        self._clean(infile, imgnameFinal, **self.clean_final_params)
 
         self.gaintable = [kc,gc,bc,bc1]
+        self._cache_cal_files(infile)
+
+    def _cache_cal_files(self, infile):
+        '''
+        Stores the current gaintable in the calibration cache and switches the
+        gaintable to the cached copies, so that this run and later runs that
+        load the cache apply the same files
+
+        Parameters
+        ----------
+        infile : str
+            input measurement set file name
+        '''
+        inputs = self._cal_inputs(infile)
+        self.gaintable = CalibrationCache(self.cal_cache_folder).put(hash_params(inputs), self.gaintable, inputs=inputs)
+
+    def _clean_sub_bands(self, infile, bands, datacolumn='corrected'):
+        '''
+        Cleans and exports the sub-band images of a flagged and calibrated
+        measurement set, with the sub-bands imaged at once
+
+        CASA tasks cannot run in parallel in one process, so each sub-band is
+        cleaned by its own CASA process. Clean saves its model with the data,
+        so each process first splits its sub-band into a measurement set of
+        its own and cleans that, and the shared file is only read.
+
+        Parameters
+        ----------
+        infile : str
+            measurement set file name
+        bands : list
+            (image name, clean parameters) pairs, one per sub-band
+        datacolumn : str
+            column split out of the measurement set, 'corrected' once it is
+            calibrated
+                default : 'corrected'
+
+        Raises
+        ------
+        RuntimeError
+            if any sub-band was not imaged, after all of them have run
+        '''
+        def clean_band(band):
+            imgname, params = band
+            vis = imgname + '.vis'
+            if os.path.exists(vis):
+                shutil.rmtree(vis)
+            try:
+                # The split file only holds the sub-band, so clean takes all of it
+                returncode, _ = run_casa_task([('split', {'vis': infile, 'outputvis': vis, 'spw': params.get('spw', ''),
+                                                          'datacolumn': datacolumn}),
+                                               ('clean', dict(params, vis=vis, imagename=imgname, spw='')),
+                                               ('exportfits', {'imagename': imgname + '.image',
+                                                               'fitsimage': imgname + '.fits'})],
+                                              log=imgname + '.casa.log')
+            finally:
+                if os.path.exists(vis):
+                    shutil.rmtree(vis)
+            # CASA tasks log errors instead of raising, so check for the image too
+            if returncode != 0 or not os.path.exists(imgname + '.fits'):
+                print ('Sub-band clean failed, see ' + imgname + '.casa.log')
+                return imgname
+            return None
+
+        workers = self.sub_band_workers or len(bands)
+        outputs = [imgname + '.image' for imgname, _ in bands]
+        with self.log.stage('clean', inputs=[infile], outputs=outputs, ms=infile, sub_bands=len(bands)):
+            failed = [imgname for imgname in run_pool(clean_band, bands, workers) if imgname is not None]
+            if failed:
+                raise RuntimeError('%d of %d sub-bands of %s failed: %s' % (len(failed), len(bands), infile,
+                                                                           ', '.join(failed)))
+
+    def _remove_image(self, imgname):
+        '''
+        Removes the products of an earlier clean so that a stale image is
+        rebuilt from scratch instead of continuing from the old model
+
+        Parameters
+        ----------
+        imgname : str
+            image name given to clean
+        '''
+        for ext in ['.image', '.model', '.residual', '.psf', '.flux', '.mask', '.fits']:
+            if os.path.isdir(imgname + ext):
+                shutil.rmtree(imgname + ext)
+            elif os.path.exists(imgname + ext):
+                os.remove(imgname + ext)
 
-    def make_image(self, infile, flag_params = None, cal_files = None, clean_params = None):
+    def make_image(self, infile, flag_params = None, cal_files = None, clean_params = None, force = False):
         '''
         Flags, calibrates, and cleans a measurement single measurement set
 
+        Files that were already imaged with the same flag and clean parameters
+        and calibration files (see run_manifest) are skipped.
+
         Parameters
         ----------
         infile : str
@@ -244,6 +466,14 @@ class CASA_Imaging:
         gaintable : str, list
             string or list of strings of calibration file names to use to calibrate
             measurement sets
+        force : bool
+            image the file even if the run manifest says it is up to date
+                default : False
+
+        Returns
+        -------
+        bool
+            True if the file was imaged, False if it was skipped
         '''
 
         if flag_params is None:
@@ -255,21 +485,49 @@ class CASA_Imaging:
         if clean_params is None:
             clean_params = self.final_clean_params
 
+        split = sub_bands(clean_params)
+        bands = [(image_name(self.img_folder, infile, label), params) for label, params in split]
+        outputs = []
+        for imgname, _ in bands:
+            outputs += [imgname + '.image', imgname + '.fits']
+
+        key = image_key(infile, flag_params, clean_params, cal_files)
+        if not force and self.manifest.is_current(infile, key):
+            print ('Up to date, skipping: ' + infile)
+            return False
+
         print ('Running File: ' + infile)
-        img_dir = self.img_folder
+        self.manifest.forget(infile)
+        for imgname, _ in bands:
+            self._remove_image(imgname)
 
         print ('\nFlagging Data...\n')
-        flagdata(infile, **flag_params)
+        with self.log.stage('flagdata', inputs=[infile], ms=infile):
+            flagdata(infile, **flag_params)
 
         print ('\nCalibrating Data...\n')
 
-    	if len(cal_files) > 0:
-            	applycal(infile, gaintable=cal_files)
-
-    	imgnameFinal = infile + 'Final.combined.img'
-        imgnameFinal = os.path.join(img_dir,os.path.basename(imgnameFinal))
-
-    	print ('\nCleaning...\n')
-        clean(infile, imgnameFinal, **clean_params)
-
-        exportfits(imagename=(imgnameFinal+'.image'),fitsimage=(imgnameFinal+'.fits'))
+        if len(cal_files) > 0:
+            self._apply_cal(infile, cal_files)
+
+        print ('\nCleaning...\n')
+        if len(bands) > 1:
+            self._clean_sub_bands(infile, bands, datacolumn='corrected' if len(cal_files) > 0 else 'data')
+        else:
+            imgnameFinal, params = bands[0]
+            self._clean(infile, imgnameFinal, **params)
+
+            with self.log.stage('exportfits', inputs=[imgnameFinal + '.image'], outputs=[imgnameFinal + '.fits'], ms=infile):
+                exportfits(imagename=(imgnameFinal+'.image'),fitsimage=(imgnameFinal+'.fits'))
+
+        if self.image_stack:
+            for (label, _), (imgname, _) in zip(split, bands):
+                if os.path.exists(imgname + '.fits'):
+                    stack_image(stack_folder(self.run_folder, label), imgname + '.fits',
+                                imagename=imgname + '.image')
+
+        # Flagging and calibrating change the measurement set, so the key is
+        # taken again to match the file as it is left on disk
+        if all(os.path.exists(output) for output in outputs):
+            self.manifest.record(infile, image_key(infile, flag_params, clean_params, cal_files), outputs)
+        return True
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+'''
+
+Renders a movie of a night of images without a display
+
+The frames are drawn in a pool of processes, one frame per task, with the
+Agg backend, so a night renders in the time of one frame per core. Every
+frame uses the same colour scale, and is labelled with its LST and JD. The
+frames are written as a PNG sequence and can then be put together into a
+GIF or, with ffmpeg, an mp4.
+
+The images are read from an image stack (see image_stack.py), or from FITS
+files, which are ordered by time.
+
+To run (in terminal):
+python render_movie.py /path/to/run_folder/stack --frames /path/to/frames --output night.gif --workers 16
+python render_movie.py /path/to/run_folder/imgs --frames /path/to/frames --output night.mp4 --vmin -5 --vmax 50
+
+'''
+
+import os
+import sys
+import glob
+import argparse
+import subprocess
+import numpy as np
+from multiprocessing import Pool
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from image_stack import ImageStack, read_image, read_header, plane_wcs, TABLE_NAME
+
+# Frames used to choose the colour scale when it is not given
+SCALE_SAMPLE = 16
+
+# Open stacks of this worker process, so each frame does not reopen the table
+_stacks = {}
+
+
+def find_frames(source):
+    '''
+    Lists the images of a stack folder, a directory of FITS files or a list
+    of FITS files, in time order
+
+    Returns
+    -------
+    list
+        (source, key, jd, lst) per frame, where key is the plane index of a
+        stack or None for a FITS file
+    '''
+    if isinstance(source, str) and os.path.exists(os.path.join(source, TABLE_NAME)):
+        stack = ImageStack(source)
+        frames = [(source, i, row['jd'], row['lst']) for i, row in enumerate(stack.planes)]
+    else:
+        if isinstance(source, str):
+            files = glob.glob(os.path.join(source, '*.fits')) if os.path.isdir(source) else [source]
+        else:
+            files = source
+        frames = []
+        # Only the headers are read here; the pixels are read by the frame workers
+        for fitsfile in files:
+            row = read_header(fitsfile)
+            frames.append((fitsfile, None, row['jd'], row['lst']))
+    return sorted(frames, key=lambda frame: frame[2])
+
+
+def read_frame(source, key):
+    '''
+    Reads the image and metadata row of a frame
+    '''
+    if key is None:
+        return read_image(source)
+    if source not in _stacks:
+        _stacks[source] = ImageStack(source)
+    stack = _stacks[source]
+    return np.asarray(stack.cube[key]), stack.planes[key]
+
+
+def colour_scale(frames, percentiles=(1., 99.9)):
+    '''
+    Chooses one colour scale for the whole movie from the percentiles of a
+    sample of the frames spread over the night
+
+    Returns
+    -------
+    vmin, vmax : float
+    '''
+    picks = np.unique(np.linspace(0, len(frames) - 1, min(SCALE_SAMPLE, len(frames))).astype(int))
+    values = []
+    for i in picks:
+        plane, _ = read_frame(frames[i][0], frames[i][1])
+        values.append(plane[np.isfinite(plane)].ravel())
+    vmin, vmax = np.percentile(np.concatenate(values), percentiles)
+    return float(vmin), float(vmax)
+
+
+def _hms(hours):
+    hours = hours % 24.
+    h = int(hours)
+    m = int((hours - h) * 60)
+    s = ((hours - h) * 60 - m) * 60
+    return '%02d:%02d:%04.1f' % (h, m, s)
+
+
+def render_frame(job):
+    '''
+    Draws one frame to a PNG file
+
+    Parameters
+    ----------
+    job : tuple
+        (source, key, png file, vmin, vmax, options) where options holds
+        cmap, size (inches), dpi and pixel_axes (plain pixel axes instead
+        of RA and Dec)
+
+    Returns
+    -------
+    str
+        PNG file, or None if the frame failed
+    '''
+    source, key, png, vmin, vmax, options = job
+    try:
+        plane, row = read_frame(source, key)
+        fig = plt.figure(figsize=(options['size'], options['size']))
+        if options['pixel_axes']:
+            ax = fig.add_axes([0.12, 0.1, 0.8, 0.8])
+            ax.set_xlabel('x (pixel)')
+            ax.set_ylabel('y (pixel)')
+        else:
+            ax = fig.add_axes([0.12, 0.1, 0.8, 0.8], projection=plane_wcs(row, plane.shape))
+            lon, lat = ax.coords[0], ax.coords[1]
+            lon.set_major_formatter('hh:mm')
+            lon.set_axislabel('RA')
+            lat.set_axislabel('Dec')
+        ax.imshow(plane, origin='lower', vmin=vmin, vmax=vmax, cmap=options['cmap'], interpolation='nearest')
+        ax.set_title('LST %s   JD %.5f' % (_hms(row['lst']), row['jd']), fontsize='small')
+        fig.savefig(png + '.part.png', dpi=options['dpi'])
+        plt.close(fig)
+        os.rename(png + '.part.png', png)
+        return png
+    except Exception as e:
+        print ('{}: {}'.format(source if key is None else '%s[%d]' % (source, key), e))
+        return None
+
+
+def render_frames(frames, folder, vmin, vmax, workers=1, cmap='viridis', size=6., dpi=100, pixel_axes=False):
+    '''
+    Draws the frames of a movie in a pool of processes
+
+    Parameters
+    ----------
+    frames : list
+        frames from find_frames
+    folder : str
+        directory for the PNG files (frame_00000.png, ...)
+    vmin, vmax : float
+        colour scale shared by all the frames
+    workers : int
+        number of frames drawn at once
+
+    Returns
+    -------
+    list
+        PNG files in frame order, None for frames that failed
+    '''
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    # Frames left from a longer movie would end up in this one
+    for png in glob.glob(os.path.join(folder, 'frame_*.png')):
+        os.remove(png)
+    options = {'cmap': cmap, 'size': size, 'dpi': dpi, 'pixel_axes': pixel_axes}
+    jobs = [(source, key, os.path.join(folder, 'frame_%05d.png' % n), vmin, vmax, options)
+            for n, (source, key, _, _) in enumerate(frames)]
+    pool = Pool(max(1, int(workers)))
+    try:
+        return pool.map(render_frame, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_gif(pngs, output, fps=10):
+    '''
+    Puts PNG frames together into an animated GIF (needs Pillow)
+    '''
+    from PIL import Image
+    images = [Image.open(png).convert('RGB') for png in pngs]
+    images[0].save(output, save_all=True, append_images=images[1:], duration=int(1000. / fps), loop=0)
+
+
+def write_video(folder, output, fps=10):
+    '''
+    Puts the PNG frames of a folder together into a video with ffmpeg
+    '''
+    subprocess.check_call(['ffmpeg', '-y', '-loglevel', 'error', '-framerate', str(fps),
+                           '-i', os.path.join(folder, 'frame_%05d.png'),
+                           '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', output])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a movie of a night of images')
+    parser.add_argument('source', nargs='+', help='image stack folder, directory of FITS images or FITS files')
+    parser.add_argument('--frames', default='frames', help='directory for the PNG frames (default: frames)')
+    parser.add_argument('--output', default=None, help='movie file, .gif or .mp4 (default: PNG frames only)')
+    parser.add_argument('--workers', type=int, default=1, help='number of frames drawn at once')
+    parser.add_argument('--vmin', type=float, default=None, help='bottom of the colour scale')
+    parser.add_argument('--vmax', type=float, default=None, help='top of the colour scale')
+    parser.add_argument('--cmap', default='viridis', help='matplotlib colour map')
+    parser.add_argument('--size', type=float, default=6., help='frame size in inches')
+    parser.add_argument('--dpi', type=int, default=100, help='frame resolution')
+    parser.add_argument('--fps', type=float, default=10., help='frames per second of the movie')
+    parser.add_argument('--pixel-axes', action='store_true', help='label the axes in pixels instead of RA and Dec')
+    args = parser.parse_args()
+
+    frames = find_frames(args.source[0] if len(args.source) == 1 else args.source)
+    if not frames:
+        print ('No images found')
+        sys.exit(1)
+
+    vmin, vmax = args.vmin, args.vmax
+    if vmin is None or vmax is None:
+        auto = colour_scale(frames)
+        vmin = auto[0] if vmin is None else vmin
+        vmax = auto[1] if vmax is None else vmax
+    print ('Rendering %d frames with colour scale %g to %g' % (len(frames), vmin, vmax))
+
+    pngs = render_frames(frames, args.frames, vmin, vmax, workers=args.workers, cmap=args.cmap,
+                         size=args.size, dpi=args.dpi, pixel_axes=args.pixel_axes)
+    failed = [frame for frame, png in zip(frames, pngs) if png is None]
+    if failed:
+        # A movie with frames missing would hide the gap, so stop at the frames
+        print ('%d frames failed, not making the movie' % len(failed))
+        sys.exit(1)
+
+    if args.output is not None:
+        if args.output.endswith('.gif'):
+            write_gif(pngs, args.output, fps=args.fps)
+        else:
+            write_video(args.frames, args.output, fps=args.fps)
+        print ('Movie written to ' + args.output)
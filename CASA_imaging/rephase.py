@@ -0,0 +1,221 @@
+'''
+
+Phases one read of drift scan data to several phase centres at once
+
+UVData.phase works out the geometry of every time with astropy and rotates
+the data in place, so imaging one file toward several calibrators means
+reading and phasing it once per calibrator. Here the geometry of every
+phase centre at every time is found in a single astropy transform, and the
+uvw coordinates and phase rotation of each centre are applied to all the
+baseline-times and frequencies with broadcast array operations.
+
+The uvw coordinates are in the J2000 frame of the phase centre, and the data
+are rotated with the same convention as UVData.phase, so the output matches
+phasing the file to each centre in turn.
+
+Example:
+    uv = UVData()
+    uv.read_miriad('zen.2458042.12552.xx.HH.uvR')
+    centers = [parse_center('GC=17h45m40.04s,-29d00m28.1s'),
+               parse_center('FornaxA=03h22m41.7s,-37d12m30s')]
+    for name, phased in rephase(uv, centers):
+        phased.write_uvfits(centred_name('zen.2458042.12552.xx.HH.uvR.uvfits', name),
+                            spoof_nonessential=True)
+
+'''
+
+import os
+import numpy as np
+from copy import deepcopy
+
+# Speed of light in m/s
+C = 299792458.
+
+
+def parse_center(text):
+    '''
+    Reads a named phase centre given as name=RA,Dec
+
+    RA with an h (e.g. 17h45m40.04s) is read as hours, otherwise as degrees;
+    Dec is in degrees (e.g. -29d00m28.1s or -29.0078). Coordinates are J2000.
+
+    Returns
+    -------
+    name : str
+    ra : float
+        right ascension in radians
+    dec : float
+        declination in radians
+    '''
+    from astropy.coordinates import Angle
+    import astropy.units as u
+
+    name, _, coords = text.partition('=')
+    if not coords:
+        raise ValueError('Phase centre %s is not in the form name=RA,Dec' % text)
+    ra, dec = coords.split(',')
+    ra = Angle(ra, unit=u.hourangle if 'h' in ra else u.deg)
+    dec = Angle(dec, unit=u.deg)
+    return name, float(ra.rad), float(dec.rad)
+
+
+def centred_name(vis_file, name):
+    '''
+    Returns the file name for the copy of a file phased to a named centre
+
+    Example: zen.2458042.12552.xx.HH.uvR.uvfits -> zen.2458042.12552.xx.HH.uvR.GC.uvfits
+    '''
+    root, ext = os.path.splitext(vis_file)
+    return root + '.' + name + ext
+
+
+def _unit(xyz):
+    return xyz / np.linalg.norm(xyz, axis=-1)[..., None]
+
+
+def tangent_frames(jds, ras, decs):
+    '''
+    Finds the u, v and w axes of each phase centre in the earth fixed frame
+    at each time
+
+    The phase centres and the J2000 north pole are carried to every time in
+    one astropy transform, which applies precession, nutation, earth
+    rotation and aberration.
+
+    Parameters
+    ----------
+    jds : array
+        Julian dates, shape (Ntimes,)
+    ras, decs : array
+        J2000 phase centres in radians, shape (Ncenters,)
+
+    Returns
+    -------
+    array
+        unit vectors of the u (east), v (north) and w (toward the centre)
+        axes in ITRS coordinates, shape (Ncenters, Ntimes, 3, 3)
+    '''
+    from astropy.time import Time
+    from astropy.coordinates import SkyCoord, ITRS
+    import astropy.units as u
+
+    jds = np.asarray(jds, dtype=float)
+    ras = np.asarray(ras, dtype=float)
+    decs = np.asarray(decs, dtype=float)
+    ncenters, ntimes = len(ras), len(jds)
+    # The last row of each time is the pole, which sets the v axis
+    ra = np.concatenate([ras, [0.]])[:, None] * np.ones(ntimes)
+    dec = np.concatenate([decs, [np.pi / 2]])[:, None] * np.ones(ntimes)
+    obstime = Time(np.ones((ncenters + 1, 1)) * jds, format='jd')
+    coords = SkyCoord(ra=ra * u.rad, dec=dec * u.rad, frame='icrs')
+    xyz = coords.transform_to(ITRS(obstime=obstime)).cartesian.xyz.value
+    xyz = _unit(np.moveaxis(xyz, 0, -1))
+    w = xyz[:ncenters]
+    pole = xyz[ncenters:]
+    east = _unit(np.cross(pole, w))
+    north = np.cross(w, east)
+    return np.stack([east, north, w], axis=-2)
+
+
+def baseline_vectors(uv):
+    '''
+    Returns the earth fixed baseline vector of each baseline-time in metres,
+    shape (Nblts, 3), with the UVData convention of antenna 2 minus antenna 1
+    '''
+    index = dict((ant, i) for i, ant in enumerate(uv.antenna_numbers))
+    positions = np.asarray(uv.antenna_positions)
+    ant1 = np.array([index[a] for a in uv.ant_1_array])
+    ant2 = np.array([index[a] for a in uv.ant_2_array])
+    return positions[ant2] - positions[ant1]
+
+
+def phase_uvw(baselines, time_index, frames):
+    '''
+    Projects baseline vectors on to the axes of several phase centres
+
+    Parameters
+    ----------
+    baselines : array
+        earth fixed baseline vectors, shape (Nblts, 3)
+    time_index : array
+        index of the time of each baseline-time into frames, shape (Nblts,)
+    frames : array
+        axes from tangent_frames, shape (Ncenters, Ntimes, 3, 3)
+
+    Returns
+    -------
+    array
+        uvw coordinates in metres, shape (Ncenters, Nblts, 3)
+    '''
+    return np.einsum('bk,cbjk->cbj', baselines, frames[:, time_index])
+
+
+def phasor(w, freqs):
+    '''
+    Returns the phase rotation that points drift scan data at a centre with
+    the given w coordinates, as applied by UVData.phase
+
+    Parameters
+    ----------
+    w : array
+        w coordinate of each baseline-time in metres, shape (Nblts,)
+    freqs : array
+        frequencies in Hz, shape (Nspws, Nfreqs)
+
+    Returns
+    -------
+    array
+        complex factors shaped to multiply a UVData data_array,
+        (Nblts, Nspws, Nfreqs, 1)
+    '''
+    return np.exp(-2j * np.pi / C * w[:, None, None, None] * np.asarray(freqs)[None, :, :, None])
+
+
+def rephase(uv, centers):
+    '''
+    Phases a UVData object to several phase centres
+
+    The geometry of all the centres is worked out up front; the phased
+    copies are then made one at a time, so only one extra copy of the data
+    is held at once. Phased input is unphased to drift first.
+
+    Parameters
+    ----------
+    uv : UVData
+        data to phase. It is not changed, apart from being unphased to
+        drift if it was phased.
+    centers : list
+        (name, ra, dec) phase centres in J2000 radians, see parse_center
+
+    Yields
+    ------
+    name : str
+        name of the centre
+    phased : UVData
+        copy of the data phased to the centre
+    '''
+    if uv.phase_type == 'phased':
+        uv.unphase_to_drift()
+    times, time_index = np.unique(uv.time_array, return_inverse=True)
+    frames = tangent_frames(times, [ra for _, ra, _ in centers], [dec for _, _, dec in centers])
+    baselines = baseline_vectors(uv)
+
+    # Copy the metadata without the data, which is replaced in every copy
+    data = uv.data_array
+    uv.data_array = None
+    try:
+        template = deepcopy(uv)
+    finally:
+        uv.data_array = data
+
+    for c, (name, ra, dec) in enumerate(centers):
+        uvw = phase_uvw(baselines, time_index, frames[c:c + 1])[0]
+        phased = deepcopy(template)
+        phased.uvw_array = uvw
+        phased.data_array = data * phasor(uvw[:, 2], uv.freq_array)
+        phased.phase_center_ra = ra
+        phased.phase_center_dec = dec
+        phased.phase_center_epoch = 2000.
+        phased.object_name = name
+        phased.set_phased()
+        yield name, phased
@@ -0,0 +1,297 @@
+'''
+
+Run manifest used to skip measurement sets that are already imaged
+
+Each imaged measurement set gets a small json entry in the manifest folder of
+the run. The entry holds a hash of the measurement set (path, size and
+modification time), the flag and clean parameters and the calibration tables
+used, along with the output files that were made. A file whose hash and
+outputs still match does not need to be imaged again.
+
+file_to_calibrate is written to when a calibration is made (ft, flagdata,
+applycal and the cleans of the self-calibration), so it is imaged again
+whenever the calibration is made again rather than taken from the cache.
+
+Calibration tables from the self-calibration routine are kept in a cache
+shared between runs, stored under a hash of the calibration inputs.
+
+'''
+
+import os
+import json
+import shutil
+import hashlib
+
+
+def fingerprint(path):
+    '''
+    Describes a file or directory by its path, total size and last change
+
+    Only the files are looked at. CASA rewrites the table.lock file of a
+    table, and so the modification time of its directory, whenever it opens
+    the table, even just to read it, so lock files and directory times are
+    left out.
+
+    Parameters
+    ----------
+    path : str
+        file or directory (e.g. a measurement set or calibration table)
+
+    Returns
+    -------
+    dict
+        absolute path, size in bytes and latest modification time
+    '''
+    path = os.path.abspath(path)
+    if not os.path.exists(path):
+        return {'path': path, 'size': None, 'mtime': None}
+    if not os.path.isdir(path):
+        return {'path': path, 'size': os.path.getsize(path), 'mtime': os.path.getmtime(path)}
+    size = 0
+    mtime = None
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            fp = os.path.join(root, name)
+            if name == 'table.lock' or os.path.islink(fp):
+                continue
+            size += os.path.getsize(fp)
+            mtime = max(mtime, os.path.getmtime(fp)) if mtime is not None else os.path.getmtime(fp)
+    return {'path': path, 'size': size, 'mtime': mtime}
+
+
+def hash_params(*params):
+    '''
+    Hashes json serialisable parameters independently of dictionary order
+
+    Returns
+    -------
+    str
+        hex digest of the parameters
+    '''
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def image_key(infile, flag_params, clean_params, gaintable):
+    '''
+    Hash of everything that determines the image of a measurement set
+
+    Parameters
+    ----------
+    infile : str
+        measurement set file name
+    flag_params : dict
+        parameters passed to flagdata
+    clean_params : dict
+        parameters passed to clean
+    gaintable : list
+        calibration files applied to the measurement set
+
+    Returns
+    -------
+    str
+        hex digest identifying the imaging of this measurement set
+    '''
+    return hash_params(fingerprint(infile), flag_params, clean_params,
+                       [fingerprint(cal) for cal in gaintable])
+
+
+def calibration_inputs(cal_params, infile=None):
+    '''
+    Collects the inputs that determine the calibration tables, which key
+    them in the calibration cache
+
+    Parameters
+    ----------
+    cal_params : dict
+        new_cal_params of the run parameter json file
+    infile : str
+        measurement set calibrated. Default is file_to_calibrate.
+
+    Returns
+    -------
+    dict
+        calibrated file, model components and calibration parameters
+    '''
+    if infile is None:
+        infile = cal_params['file_to_calibrate']
+    cal_sources = cal_params['cal_sources']
+    if type(list(cal_sources.values())[0]) is not dict:
+        with open(list(cal_sources.values())[0], 'r') as fp:
+            cal_sources = json.load(fp)
+    flag = dict(cal_params['flag'])
+    if flag.get('autocorr') in ('True', 'False'):
+        flag['autocorr'] = flag['autocorr'] == 'True'
+    split_free = cal_params.get('split_free', 'False')
+    return {'file_to_calibrate': os.path.abspath(infile),
+            'cal_sources': cal_sources,
+            'flag': flag,
+            'kcal': cal_params['kcal'],
+            'gcal': cal_params['gcal'],
+            'clean_1': cal_params['clean_1'],
+            'clean_2': cal_params['clean_2'],
+            'band_pass_1': cal_params['band_pass_1'],
+            'band_pass_2': cal_params['band_pass_2'],
+            'split_free': split_free is True or split_free == 'True'}
+
+
+def calibration_cache_folder(config_data):
+    '''
+    Returns the calibration cache folder of a run, by default next to the
+    run folder so that runs sharing a calibration can reuse it
+    '''
+    run_folder = config_data['data_path']['run_folder']
+    return config_data.get('calibration_cache',
+                           os.path.join(os.path.dirname(os.path.abspath(run_folder)), 'calibration_cache'))
+
+
+class RunManifest:
+    def __init__(self, run_folder):
+        self.folder = os.path.join(run_folder, 'manifest')
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    def _entry(self, infile):
+        '''
+        Returns the file name of the manifest entry of a measurement set
+        '''
+        return os.path.join(self.folder, os.path.basename(infile.rstrip('/')) + '.json')
+
+    def get(self, infile):
+        '''
+        Reads the manifest entry of a measurement set
+
+        Returns
+        -------
+        dict or None
+            manifest entry, None if the file has not been imaged
+        '''
+        try:
+            with open(self._entry(infile)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def is_current(self, infile, key):
+        '''
+        Checks whether a measurement set was already imaged with the same inputs
+
+        Parameters
+        ----------
+        infile : str
+            measurement set file name
+        key : str
+            hash from image_key for the current run
+
+        Returns
+        -------
+        bool
+            True if the hash matches and all recorded outputs still exist
+        '''
+        entry = self.get(infile)
+        if entry is None or entry['key'] != key:
+            return False
+        return all(os.path.exists(output) for output in entry['outputs'])
+
+    def record(self, infile, key, outputs):
+        '''
+        Writes the manifest entry of a measurement set
+
+        The entry is written to a temporary file and renamed so that an
+        interrupted run never leaves a partial entry behind.
+
+        Parameters
+        ----------
+        infile : str
+            measurement set file name
+        key : str
+            hash from image_key, taken after the file was processed
+        outputs : list
+            files produced for this measurement set
+        '''
+        entry = self._entry(infile)
+        with open(entry + '.tmp', 'w') as f:
+            json.dump({'ms': os.path.abspath(infile), 'key': key,
+                       'outputs': [os.path.abspath(o) for o in outputs]}, f, indent=2)
+        os.rename(entry + '.tmp', entry)
+
+    def forget(self, infile):
+        '''
+        Removes the manifest entry of a measurement set
+        '''
+        if os.path.exists(self._entry(infile)):
+            os.remove(self._entry(infile))
+
+
+class CalibrationCache:
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    def get(self, key):
+        '''
+        Looks up the calibration tables stored under a key
+
+        Parameters
+        ----------
+        key : str
+            hash of the calibration inputs
+
+        Returns
+        -------
+        list or None
+            file names of the cached calibration tables in the order they
+            are applied, None if there is no complete entry for the key
+        '''
+        entry = os.path.join(self.folder, key)
+        try:
+            with open(os.path.join(entry, 'tables.json')) as f:
+                tables = json.load(f)['tables']
+        except (IOError, OSError, ValueError):
+            return None
+        tables = [os.path.join(entry, table) for table in tables]
+        if not all(os.path.exists(table) for table in tables):
+            return None
+        return tables
+
+    def put(self, key, tables, inputs=None):
+        '''
+        Copies calibration tables into the cache
+
+        The tables are copied into a temporary folder that is renamed once
+        complete, so readers never see a partial entry.
+
+        Parameters
+        ----------
+        key : str
+            hash of the calibration inputs
+        tables : list
+            file names of the calibration tables in the order they are applied
+        inputs : dict
+            parameters the key was made from, stored for reference
+
+        Returns
+        -------
+        list
+            file names of the cached copies of the tables
+        '''
+        entry = os.path.join(self.folder, key)
+        if self.get(key) is not None:
+            return self.get(key)
+        tmp = entry + '.tmp.' + str(os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        names = []
+        for i, table in enumerate(tables):
+            # Prefix with the position so tables from the same file stay distinct
+            name = str(i) + '_' + os.path.basename(table.rstrip('/'))
+            shutil.copytree(table, os.path.join(tmp, name))
+            names.append(name)
+        with open(os.path.join(tmp, 'tables.json'), 'w') as f:
+            json.dump({'tables': names, 'inputs': inputs}, f, indent=2, default=str)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+        return self.get(key)
@@ -0,0 +1,547 @@
+#!/usr/bin/env python
+'''
+
+Plans and runs an imaging run as a graph of CASA steps
+
+A run json file is compiled into the same steps casa_image_ms.py carries out
+(import, flag, calibrate, split, clean, bandpass, final clean, export), each
+with the files it reads, writes and modifies in place. Steps are ordered by
+those files: a step that reads a file waits for the step that last wrote it,
+and a step that modifies a file waits for everything that used it before.
+Steps that do not share files, such as the imaging of different measurement
+sets once the calibration is done, run in parallel, each in its own CASA
+process.
+
+Every finished step leaves a record in run_folder/plan. A step is up to date
+when its record exists, its CASA calls are unchanged, its outputs exist, the
+files it reads from outside the run are unchanged and none of the steps it
+depends on has run since. An interrupted run therefore resumes at the first
+step that did not finish.
+
+To list what would run (in terminal):
+python run_planner.py <run parameters>.json <measurement sets or uvfits files> --dry-run
+
+To run it with 8 CASA processes at once:
+python run_planner.py <run parameters>.json <measurement sets or uvfits files> --workers 8
+
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+from casa_worker import run_casa, run_casa_task
+from run_manifest import fingerprint, hash_params
+from mask_index import MaskRegions
+from ms_manifest import MSManifest
+from sub_bands import sub_bands, image_name
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Products clean writes next to the image
+CLEAN_PRODUCTS = ['.image', '.model', '.residual', '.psf', '.flux']
+
+
+class Node:
+    def __init__(self, name, tasks=None, script=None, inputs=(), outputs=(), modifies=(), deps=()):
+        '''
+        Parameters
+        ----------
+        name : str
+            unique name of the step, e.g. zen.2458042.12552.xx.HH.uvR.uvfits.ms/clean
+        tasks : list or function
+            (CASA task name, keyword arguments) pairs run in one CASA process
+            (see casa_worker.run_casa_task). A function returning the list is
+            called just before the step is checked or run, for arguments
+            that depend on the outputs of earlier steps.
+        script : list
+            CASA script and its arguments, run instead of tasks
+        inputs : list
+            files the step reads
+        outputs : list
+            files the step makes. They are removed before it runs.
+        modifies : list
+            files the step changes in place (e.g. flagdata on a measurement set)
+        deps : list
+            names of steps that must run first, in addition to those found
+            from the files
+        '''
+        self.name = name
+        self.tasks = tasks
+        self.script = script
+        self.inputs = [os.path.abspath(p) for p in inputs]
+        self.outputs = [os.path.abspath(p) for p in outputs]
+        self.modifies = [os.path.abspath(p) for p in modifies]
+        self.deps = list(deps)
+
+    def calls(self):
+        '''
+        Returns the CASA calls of the step
+        '''
+        if self.script is not None:
+            return {'script': self.script}
+        return {'tasks': self.tasks() if callable(self.tasks) else self.tasks}
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class Plan:
+    def __init__(self, run_folder):
+        '''
+        Parameters
+        ----------
+        run_folder : str
+            run folder. The step records and CASA logs are kept in its plan
+            subdirectory.
+        '''
+        self.folder = os.path.join(os.path.abspath(run_folder), 'plan')
+        self.log_folder = os.path.join(self.folder, 'logs')
+        self.nodes = []
+        self._by_name = {}
+        self._last_writer = {}
+        self._readers = {}
+
+    def add(self, node):
+        '''
+        Adds a step after the steps already added, depending on them through
+        the files it shares with them
+
+        Returns
+        -------
+        Node
+            the step added
+        '''
+        if node.name in self._by_name:
+            raise ValueError('Step %s is already in the plan.' % node.name)
+        deps = list(node.deps)
+        for path in node.inputs:
+            if path in self._last_writer:
+                deps.append(self._last_writer[path])
+        for path in node.outputs + node.modifies:
+            # Wait for the last change and everything that read it since
+            if path in self._last_writer:
+                deps.append(self._last_writer[path])
+            deps.extend(self._readers.get(path, []))
+        for path in node.outputs:
+            # A file made again later belongs to the later step, so the
+            # earlier one does not go out of date when it is replaced
+            if path in self._last_writer:
+                earlier = self._by_name[self._last_writer[path]]
+                if path in earlier.outputs:
+                    earlier.outputs.remove(path)
+        node.deps = sorted(set(dep for dep in deps if dep != node.name))
+        for path in node.inputs:
+            self._readers.setdefault(path, []).append(node.name)
+        for path in node.outputs + node.modifies:
+            self._last_writer[path] = node.name
+            self._readers[path] = []
+        self.nodes.append(node)
+        self._by_name[node.name] = node
+        return node
+
+    def _record_file(self, node):
+        return os.path.join(self.folder, node.name.replace('/', '__') + '.json')
+
+    def _read_record(self, node):
+        try:
+            with open(self._record_file(node)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _external_inputs(self, node):
+        '''
+        Returns the inputs of a step that no step in the plan writes
+        '''
+        return [p for p in node.inputs if p not in self._last_writer]
+
+    def status(self, force=False):
+        '''
+        Works out which steps are up to date
+
+        Parameters
+        ----------
+        force : bool
+            treat every step as out of date
+
+        Returns
+        -------
+        dict
+            reason each step has to run (None for steps that are up to date)
+        '''
+        reasons = {}
+        for node in self.nodes:
+            record = self._read_record(node)
+            reason = None
+            if force:
+                reason = 'forced'
+            elif record is None:
+                reason = 'not run'
+            else:
+                for dep in node.deps:
+                    dep_record = self._read_record(self._by_name[dep])
+                    if reasons[dep] is not None:
+                        reason = dep + ' runs first'
+                    elif dep_record['finished'] > record['started']:
+                        reason = dep + ' ran since'
+                    if reason is not None:
+                        break
+            if reason is None:
+                reason = self._check(node, record)
+            reasons[node.name] = reason
+        return reasons
+
+    def _check(self, node, record):
+        '''
+        Returns why a step whose dependencies are up to date has to run,
+        None if it is up to date
+        '''
+        try:
+            calls = hash_params(node.calls())
+        except Exception as e:
+            return 'arguments unavailable: {}'.format(e)
+        if record['calls'] != calls:
+            return 'parameters changed'
+        if not all(os.path.exists(p) for p in node.outputs):
+            return 'output missing'
+        if any(fingerprint(p) != record['inputs'].get(p) for p in self._external_inputs(node)):
+            return 'input changed'
+        return None
+
+    def dry_run(self, force=False):
+        '''
+        Prints every step in order with whether and why it would run
+
+        Returns
+        -------
+        list
+            names of the steps that would run
+        '''
+        reasons = self.status(force=force)
+        for node in self.nodes:
+            reason = reasons[node.name]
+            print ('%-12s %s%s' % ('up to date' if reason is None else 'run', node.name,
+                                   '' if reason is None else ' (' + reason + ')'))
+        return [name for name, reason in reasons.items() if reason is not None]
+
+    def _run_node(self, node, calls):
+        '''
+        Runs one step in a new CASA process and records it if it succeeded
+
+        Returns
+        -------
+        bool
+            True if the step succeeded
+        '''
+        record_file = self._record_file(node)
+        _remove(record_file)
+        for path in node.outputs:
+            _remove(path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+        log = os.path.join(self.log_folder, node.name.replace('/', '__') + '.log')
+        started = time.time()
+        if 'script' in calls:
+            returncode, _ = run_casa(calls['script'][0], calls['script'][1:], cwd=self.log_folder, log=log)
+        else:
+            returncode, _ = run_casa_task(calls['tasks'], cwd=self.log_folder, log=log)
+        # CASA tasks log errors instead of raising, so check for the outputs too
+        if returncode != 0 or not all(os.path.exists(p) for p in node.outputs):
+            return False
+        record = {'name': node.name, 'calls': hash_params(calls), 'started': started,
+                  'finished': time.time(), 'log': log,
+                  'inputs': dict((p, fingerprint(p)) for p in self._external_inputs(node))}
+        with open(record_file + '.tmp', 'w') as f:
+            json.dump(record, f, indent=2)
+        os.rename(record_file + '.tmp', record_file)
+        return True
+
+    def run(self, workers=1, force=False):
+        '''
+        Runs the steps that are out of date, at most workers at once
+
+        A step that fails stops the steps that depend on it. Independent
+        steps carry on.
+
+        Parameters
+        ----------
+        workers : int
+            number of CASA processes running at once
+        force : bool
+            run every step
+
+        Returns
+        -------
+        dict
+            names of the steps that were 'done', 'failed', 'skipped' (after
+            a failure) or 'up to date'
+        '''
+        for folder in [self.folder, self.log_folder]:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+        reasons = self.status(force=force)
+        state = dict((name, 'up to date' if reason is None else 'pending') for name, reason in reasons.items())
+        cond = threading.Condition()
+        running = [0]
+
+        def work(node, calls):
+            print ('Running: ' + node.name)
+            try:
+                ok = self._run_node(node, calls)
+            except Exception as e:
+                print ('{}: {}'.format(node.name, e))
+                ok = False
+            print (('Done: ' if ok else 'Failed: ') + node.name)
+            with cond:
+                state[node.name] = 'done' if ok else 'failed'
+                running[0] -= 1
+                cond.notify()
+
+        with cond:
+            while True:
+                for node in self.nodes:
+                    if state[node.name] != 'pending':
+                        continue
+                    dep_states = [state[dep] for dep in node.deps]
+                    if any(s in ['failed', 'skipped'] for s in dep_states):
+                        state[node.name] = 'skipped'
+                        print ('Skipped: ' + node.name)
+                    elif running[0] < workers and all(s in ['done', 'up to date'] for s in dep_states):
+                        # Arguments that depend on earlier steps are worked out here
+                        try:
+                            calls = node.calls()
+                        except Exception as e:
+                            print ('{}: {}'.format(node.name, e))
+                            print ('Failed: ' + node.name)
+                            state[node.name] = 'failed'
+                            continue
+                        state[node.name] = 'running'
+                        running[0] += 1
+                        t = threading.Thread(target=work, args=(node, calls))
+                        t.daemon = True
+                        t.start()
+                if running[0] == 0 and 'pending' not in state.values():
+                    break
+                cond.wait()
+        return state
+
+
+def _bool(value):
+    '''
+    Converts the 'True' and 'False' strings of the run files to booleans
+    '''
+    return {'True': True, 'False': False}.get(value, value)
+
+
+def _calname(m, c, run_folder):
+    return os.path.join(run_folder, os.path.basename(m) + c + '.cal')
+
+
+def _band_pass_params(params):
+    params = dict(params)
+    params['solnorm'] = _bool(params.get('solnorm', False))
+    return params
+
+
+def _clean_outputs(imgname):
+    return [imgname + ext for ext in CLEAN_PRODUCTS]
+
+
+def _cal_nodes(plan, config_data, run_folder, img_folder):
+    '''
+    Adds the self-calibration steps of process_ms.CASA_Imaging.create_cal_files
+
+    Returns
+    -------
+    list
+        calibration tables applied to every measurement set
+    '''
+    cal_params = config_data['new_cal_params']
+    infile = os.path.abspath(cal_params['file_to_calibrate'])
+    name = os.path.basename(infile)
+    model_name = os.path.join(run_folder, cal_params['model_name'])
+    cal_sources = cal_params['cal_sources']
+    if type(list(cal_sources.values())[0]) is not dict:
+        with open(list(cal_sources.values())[0]) as fp:
+            cal_sources = json.load(fp)
+    cal_flag = dict((k, _bool(v)) for k, v in cal_params['flag'].items())
+
+    plan.add(Node('cal/model', inputs=[], outputs=[model_name], modifies=[infile],
+                  tasks=[('cl.addcomponent', params) for _, params in sorted(cal_sources.items())] +
+                        [('cl.rename', {'filename': model_name}), ('cl.close', {}),
+                         ('ft', {'vis': infile, 'complist': model_name, 'usescratch': True})]))
+    plan.add(Node('cal/flagdata', modifies=[infile], tasks=[('flagdata', dict(cal_flag, vis=infile))]))
+
+    kc = _calname(infile, 'K', run_folder)
+    gc = _calname(infile, 'G', run_folder)
+    plan.add(Node('cal/gaincal_K', inputs=[infile], outputs=[kc],
+                  tasks=[('gaincal', dict(cal_params['kcal'], vis=infile, caltable=kc, gaintype='K'))]))
+    plan.add(Node('cal/gaincal_G', inputs=[infile, kc], outputs=[gc],
+                  tasks=[('gaincal', dict(cal_params['gcal'], vis=infile, caltable=gc, gaintype='G', gaintable=kc))]))
+    plan.add(Node('cal/applycal_KG', inputs=[kc, gc], modifies=[infile],
+                  tasks=[('applycal', {'vis': infile, 'gaintable': [kc, gc]})]))
+    final_img = os.path.join(img_folder, name + 'Final.combined.img')
+
+    if _bool(cal_params.get('split_free', 'False')) is True:
+        # As _create_cal_files_chained: every solution comes from infile
+        bc = _calname(infile, 'B', run_folder)
+        bc1 = _calname(infile, 'B2', run_folder)
+        img1 = os.path.join(run_folder, name + '.init.img')
+        img2 = os.path.join(run_folder, name + '.init2.img')
+        plan.add(Node('cal/clean_1', modifies=[infile], outputs=_clean_outputs(img1),
+                      tasks=[('clean', dict(dict(usescratch=True), **dict(cal_params['clean_1'], vis=infile, imagename=img1)))]))
+        plan.add(Node('cal/bandpass_1', inputs=[infile, kc, gc], outputs=[bc],
+                      tasks=[('bandpass', dict(_band_pass_params(cal_params['band_pass_1']), vis=infile, caltable=bc,
+                                               gaintable=[kc, gc]))]))
+        plan.add(Node('cal/applycal_B', inputs=[kc, gc, bc], modifies=[infile],
+                      tasks=[('applycal', {'vis': infile, 'gaintable': [kc, gc, bc]})]))
+        plan.add(Node('cal/clean_2', modifies=[infile], outputs=_clean_outputs(img2),
+                      tasks=[('clean', dict(dict(usescratch=True), **dict(cal_params['clean_2'], vis=infile, imagename=img2)))]))
+        plan.add(Node('cal/bandpass_2', inputs=[infile, kc, gc, bc], outputs=[bc1],
+                      tasks=[('bandpass', dict(_band_pass_params(cal_params['band_pass_2']), vis=infile, caltable=bc1,
+                                               gaintable=[kc, gc, bc]))]))
+        plan.add(Node('cal/applycal_B2', inputs=[kc, gc, bc, bc1], modifies=[infile],
+                      tasks=[('applycal', {'vis': infile, 'gaintable': [kc, gc, bc, bc1]})]))
+        plan.add(Node('cal/clean_final', modifies=[infile], outputs=_clean_outputs(final_img),
+                      tasks=[('clean', dict(cal_params['clean_final'], vis=infile, imagename=final_img))]))
+        return [kc, gc, bc, bc1]
+
+    split_ms = os.path.join(run_folder, name + 'split.ms')
+    split_2 = split_ms + 'c2.ms'
+    bc = _calname(split_ms, 'B', run_folder)
+    bc1 = _calname(split_2, 'B', run_folder)
+    img1 = os.path.join(run_folder, name + '.init.img')
+    img2 = split_ms + '.init.img'
+    plan.add(Node('cal/split_1', inputs=[infile], outputs=[split_ms],
+                  tasks=[('split', {'vis': infile, 'outputvis': split_ms, 'datacolumn': 'corrected', 'spw': ''})]))
+    plan.add(Node('cal/clean_1', modifies=[split_ms], outputs=_clean_outputs(img1),
+                  tasks=[('clean', dict(cal_params['clean_1'], vis=split_ms, imagename=img1))]))
+    plan.add(Node('cal/bandpass_1', inputs=[split_ms], outputs=[bc],
+                  tasks=[('bandpass', dict(_band_pass_params(cal_params['band_pass_1']), vis=split_ms, caltable=bc))]))
+    plan.add(Node('cal/applycal_B', inputs=[bc], modifies=[split_ms],
+                  tasks=[('applycal', {'vis': split_ms, 'gaintable': [bc]})]))
+    plan.add(Node('cal/split_2', inputs=[split_ms], outputs=[split_2],
+                  tasks=[('split', {'vis': split_ms, 'outputvis': split_2, 'datacolumn': 'corrected',
+                                    'spw': '0:100~800'})]))
+    plan.add(Node('cal/clean_2', modifies=[split_2], outputs=_clean_outputs(img2),
+                  tasks=[('clean', dict(cal_params['clean_2'], vis=split_2, imagename=img2))]))
+    plan.add(Node('cal/bandpass_2', inputs=[split_2], outputs=[bc1],
+                  tasks=[('bandpass', dict(_band_pass_params(cal_params['band_pass_2']), vis=split_2, caltable=bc1))]))
+    plan.add(Node('cal/applycal_B2', inputs=[bc1], modifies=[split_2],
+                  tasks=[('applycal', {'vis': split_2, 'gaintable': [bc1]})]))
+    plan.add(Node('cal/clean_final', modifies=[split_2], outputs=_clean_outputs(final_img),
+                  tasks=[('clean', dict(cal_params['clean_final'], vis=split_2, imagename=final_img))]))
+    return [kc, gc, bc, bc1]
+
+
+def compile_run(config_data, files):
+    '''
+    Compiles a run into a plan with the steps of casa_image_ms.py
+
+    Parameters
+    ----------
+    config_data : dict
+        run parameters read from the run json file
+    files : list
+        measurement sets to image, or uvfits files to import first
+        (imported to file + '.ms', as by uvfits_to_ms.py)
+
+    Returns
+    -------
+    Plan
+    '''
+    run_folder = os.path.abspath(config_data['data_path']['run_folder'])
+    img_folder = os.path.join(run_folder, config_data['data_path']['image_folder'])
+    plan = Plan(run_folder)
+
+    folders = []
+    for f in sorted(files):
+        f = os.path.abspath(f.rstrip('/'))
+        if f.endswith('.uvfits'):
+            plan.add(Node(os.path.basename(f) + '.ms/importuvfits', inputs=[f], outputs=[f + '.ms'],
+                          tasks=[('importuvfits', {'fitsfile': f, 'vis': f + '.ms'})]))
+            f = f + '.ms'
+        folders.append(f)
+
+    # The phase centres used for the masks are read from ms_manifest.json
+    for folder in folders:
+        manifest = os.path.join(os.path.dirname(folder), 'ms_manifest.json')
+        plan.add(Node(os.path.basename(folder) + '/index', inputs=[folder], modifies=[manifest],
+                      script=[os.path.join(HERE, 'ms_manifest.py'), folder]))
+
+    if config_data['new_calibration'] == 'True':
+        gaintable = _cal_nodes(plan, config_data, run_folder, img_folder)
+    else:
+        gaintable = [os.path.abspath(cal) for cal in config_data['calibration_files']]
+
+    flag_params = dict((k, _bool(v)) for k, v in config_data['flag'].items())
+    clean_params = config_data['clean']
+    sources_file = os.path.abspath(config_data['clean_mask_sources']['file_name'])
+    masks = {}
+
+    def mask_for(folder):
+        if 'regions' not in masks:
+            with open(sources_file) as f:
+                sources = json.load(f)
+            masks['regions'] = MaskRegions(sources, os.path.join(run_folder, 'masks'),
+                                           config_data['base_mask_params']['dec'],
+                                           mask_size=config_data['base_mask_params']['radius'],
+                                           imsize=clean_params.get('imsize', [512])[0],
+                                           cell_size=float(clean_params.get('cell', ['250arcsec'])[0].replace('arcsec', '')))
+        ra, _ = MSManifest.for_ms(folder).phase_centre(folder)
+        return masks['regions'].mask(ra)
+
+    for folder in folders:
+        name = os.path.basename(folder)
+        plan.add(Node(name + '/flagdata', modifies=[folder], tasks=[('flagdata', dict(flag_params, vis=folder))]))
+        if len(gaintable) > 0:
+            plan.add(Node(name + '/applycal', inputs=gaintable, modifies=[folder],
+                          tasks=[('applycal', {'vis': folder, 'gaintable': gaintable})]))
+
+        # Sub-bands share the flagging and calibration above. Clean saves its
+        # model with the data, so the cleans of one file still run in turn.
+        for label, params in sub_bands(clean_params):
+            imgname = image_name(img_folder, folder, label)
+            step = name + ('/clean' if label is None else '/clean_' + label)
+
+            def clean_tasks(folder=folder, imgname=imgname, params=params):
+                return [('clean', dict(params, vis=folder, imagename=imgname, mask=mask_for(folder)))]
+
+            plan.add(Node(step, tasks=clean_tasks, modifies=[folder], outputs=_clean_outputs(imgname),
+                          deps=[name + '/index']))
+            plan.add(Node(step.replace('/clean', '/exportfits'), inputs=[imgname + '.image'], outputs=[imgname + '.fits'],
+                          tasks=[('exportfits', {'imagename': imgname + '.image', 'fitsimage': imgname + '.fits'})]))
+    return plan
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plan and run an imaging run as a graph of CASA steps')
+    parser.add_argument('config', help='run parameter json file')
+    parser.add_argument('files', nargs='+', help='measurement sets to image, or uvfits files to import and image')
+    parser.add_argument('--workers', type=int, default=1, help='number of CASA processes running at once')
+    parser.add_argument('--dry-run', action='store_true', help='list the steps and whether they would run')
+    parser.add_argument('--force', action='store_true', help='run every step, even if it is up to date')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config_data = json.load(f)
+    plan = compile_run(config_data, args.files)
+
+    if args.dry_run:
+        plan.dry_run(force=args.force)
+        sys.exit(0)
+
+    state = plan.run(workers=args.workers, force=args.force)
+    counts = {}
+    for s in state.values():
+        counts[s] = counts.get(s, 0) + 1
+    print (', '.join('%d %s' % (n, s) for s, n in sorted(counts.items())))
+    sys.exit(1 if counts.get('failed') or counts.get('skipped') else 0)
@@ -0,0 +1,89 @@
+'''
+
+Sub-band imaging: several spectral window selections from one calibration
+
+The spw of the clean parameters in the run json file may be a list of
+selections, or a dictionary of names and selections, instead of a single
+selection:
+
+    "clean" : {
+      ...
+      "spw" : {"110-120MHz": "0:102~205", "120-130MHz": "0:205~307"}
+    }
+
+Each measurement set is then flagged and calibrated once and imaged in every
+sub-band. The final image of a sub-band is named after it
+(e.g. file.msFinal.combined.110-120MHz.img), with a name made from the
+selection itself when a list is given (e.g. file.msFinal.combined.0_102-205.img).
+
+'''
+
+import os
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def band_label(spw):
+    '''
+    Makes a file name friendly label from a spectral window selection
+
+    Example: '0:102~205' -> '0_102-205'
+    '''
+    return spw.replace(' ', '').replace(':', '_').replace('~', '-').replace(',', '+').replace(';', '+')
+
+
+def sub_bands(clean_params):
+    '''
+    Splits clean parameters into one set per sub-band
+
+    Parameters
+    ----------
+    clean_params : dict
+        clean parameters from the run json file, whose spw may be a single
+        selection, a list of selections or a dictionary of named selections
+
+    Returns
+    -------
+    list
+        (label, clean parameters) pairs. The label is None when spw is a
+        single selection, in which case the parameters are returned as given.
+    '''
+    spw = clean_params.get('spw', '')
+    if isinstance(spw, basestring):
+        return [(None, clean_params)]
+    if isinstance(spw, dict):
+        bands = sorted(spw.items())
+    else:
+        bands = [(band_label(s), s) for s in spw]
+    return [(label, dict(clean_params, spw=s)) for label, s in bands]
+
+
+def image_name(img_folder, infile, label=None):
+    '''
+    Returns the name of the final image of a measurement set, without the
+    .image or .fits extension
+
+    Parameters
+    ----------
+    img_folder : str
+        image folder of the run
+    infile : str
+        measurement set file name
+    label : str
+        sub-band label from sub_bands, None for a single band
+    '''
+    name = os.path.basename(infile.rstrip('/')) + 'Final.combined'
+    if label is not None:
+        name += '.' + label
+    return os.path.join(img_folder, name + '.img')
+
+
+def image_names(img_folder, infile, clean_params):
+    '''
+    Returns the names of all the final images of a measurement set, one per
+    sub-band
+    '''
+    return [image_name(img_folder, infile, label) for label, _ in sub_bands(clean_params)]
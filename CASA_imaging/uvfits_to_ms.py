@@ -1,11 +1,17 @@
 """
 Example:
 casa -c uvfits_to_ms.py /path/to/data/*.uv
+
+To import several files at once and flag the autocorrelations as each
+file finishes importing:
+casa -c uvfits_to_ms.py /path/to/data/*.uvfits --flag --import-workers 4 --flag-workers 2
 """
 
 from casa import importuvfits
-import sys
 import os
+import argparse
+from casa_worker import script_args
+from pipeline import Stage, Pipeline, casa_tasks
 
 def find_uvfits_files(path=None,polarization='xx'):
     """
@@ -40,37 +46,76 @@ def find_uvfits_files(path=None,polarization='xx'):
     folders.sort()
     return (folders)
 
-def convert_uvfits(folder,path=None):
+def ms_name(folder, path=None):
     """
 
-    Converts a single uvfits file to ms format
+    Returns the measurement set file name for a uvfits file
 
     Parameters
     ----------
     folder : str
-        File path of the uvfits file to be converted to
-        ms format
+        File path of the uvfits file
     path : str
         File path where the new ms file will be written.
-        Default is the current working directory.
+        Default is next to the uvfits file.
 
     """
     if path is not None:
         if os.path.isdir(path):
             file_name = os.path.basename(folder)
-            vis_file = os.path.join(path,file_name) + '.ms'
+            return os.path.join(path,file_name) + '.ms'
         else:
             raise IOError("%s not found." % path)
 
-    else:
-        vis_file = folder + '.ms'
+    return folder + '.ms'
+
+def convert_uvfits(folder,path=None):
+    """
+
+    Converts a single uvfits file to ms format
 
+    Parameters
+    ----------
+    folder : str
+        File path of the uvfits file to be converted to
+        ms format
+    path : str
+        File path where the new ms file will be written.
+        Default is the current working directory.
+
+    """
+    vis_file = ms_name(folder, path=path)
     importuvfits(fitsfile=folder,vis=vis_file)
 
 if __name__ == '__main__':
-    try:
-        folders = sys.argv[3:]
-        for folder in folders:
-            convert_uvfits(folder)
-    except IndexError:
+    parser = argparse.ArgumentParser(description='Convert uvfits files to measurement sets with CASA')
+    parser.add_argument('folders', nargs='*', help='uvfits files to convert')
+    parser.add_argument('--path', default=None, help='directory for the measurement sets (default: next to the uvfits files)')
+    parser.add_argument('--flag', action='store_true', help='flag the autocorrelations of each new measurement set')
+    parser.add_argument('--import-workers', type=int, default=1, help='number of files imported at once (default: 1)')
+    parser.add_argument('--flag-workers', type=int, default=1, help='number of files flagged at once (default: 1)')
+    args = parser.parse_args(script_args('uvfits_to_ms.py'))
+
+    if len(args.folders) == 0:
         print ('No file specified for conversion from uvfits to ms')
+    elif args.import_workers == 1 and not args.flag:
+        for folder in args.folders:
+            convert_uvfits(folder, path=args.path)
+    else:
+        # Run each import and flag in its own CASA process so that file N+1
+        # is imported while file N is flagged
+        def import_file(folder):
+            vis_file = ms_name(folder, path=args.path)
+            casa_tasks([('importuvfits', {'fitsfile': folder, 'vis': vis_file})], log=vis_file + '.import.log')
+            return vis_file
+
+        def flag_file(vis_file):
+            casa_tasks([('flagdata', {'vis': vis_file, 'autocorr': True})], log=vis_file + '.flag.log')
+            return vis_file
+
+        stages = [Stage('import', import_file, workers=args.import_workers)]
+        if args.flag:
+            stages.append(Stage('flag', flag_file, workers=args.flag_workers))
+        pipeline = Pipeline(stages)
+        pipeline.run(args.folders)
+        pipeline.report()
@@ -3,11 +3,24 @@
 To run in terminal:
 casa -c change_pol.py <measurement sets>
 
+To image a whole directory in parallel, one CASA process per file:
+casa -c change_pol.py /path/to/data --workers 8
+
+The measurement sets are never modified. Each file is imaged through a
+relabelled reference copy (see CASA_imaging/pol_view.py).
+
 '''
 
 #Import necessary packages
 import sys
 import os
+import argparse
+from casa import *
+
+#The reference copy and worker helpers live in CASA_imaging
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath([arg for arg in sys.argv if arg.endswith('change_pol.py')][-1])), '..', 'CASA_imaging'))
+from casa_worker import find_script, script_args, run_casa, run_pool
+from pol_view import pol_view, remove_view
 
 def find_pol_files(path=None):
     """
@@ -35,8 +48,8 @@ def find_pol_files(path=None):
     file_names = []
 
     #Search the directory for all the ms files and save them in the list
-    for current_file in os,listdir(path):
-            if (current_file[-12:]) == '.uvfits.ms':
+    for current_file in os.listdir(path):
+            if current_file.endswith('.uvfits.ms'):
                 file_names.append(os.path.join(path,current_file))
 
     #Sort the list
@@ -45,19 +58,11 @@ def find_pol_files(path=None):
     return (file_names)
 
 
-def change_pol(file_name, path=None):
+def fake_xx_name(file_name, path=None):
     """
 
-    This function reads in a file, changes the polarization index, runs clean, 
-    and returns the polarizations index to what it was originally
-
-    Parameters
-    ----------
-    file_name : str
-        File name of the ms file to be altered
-    path : str, optional
-        File path where the new ms file will be written.
-        Default is the current working directory.
+    Returns the name of the relabelled copy of a file, which the image
+    names are based on
 
     """
 
@@ -66,53 +71,132 @@ def change_pol(file_name, path=None):
     #Otherwise, it prints an error message
     if path is not None:
         if os.path.isdir(path):
-	    #Define a variable that holds the full path for our new file
-            vis_file = os.path.join(path,file_name) + '.fake_xx_pol.ms'
+            #Define a variable that holds the full path for our new file
+            return os.path.join(path,os.path.basename(file_name.rstrip('/'))) + '.fake_xx_pol.ms'
         else:
             raise IOError("%s not found." % path)
-    #If no path was specified, then we define the variable to hold the new file name
-    else:
-        vis_file = file_name + '.fake_xx_pol.ms'
+    #If no path was specified, then the new file goes next to the original
+    return file_name.rstrip('/') + '.fake_xx_pol.ms'
 
-    #Create a variable to point to the Polarization table
-    pol_cell = file_name + '/POLARIZATION'
 
-    #Open the polarization table and save the polarization index
-    tb.open(pol_cell, nomodify=False)
-    origin_pol = tb.getcell('CORR_TYPE')
+def change_pol(file_name, path=None, keep_view=False):
+    """
 
-    #Check to see if the polarization is already xx
-    if origin_pol[0] == 9:
-        print 'Already xx polarized'
-    else:
-	#If it is not xx polarized, we tell CASA that it is
-        tb.putcell('CORR_TYPE',0,[9])
-        print 'Now it is xx polarized'
+    This function makes a copy of a file labelled as xx polarized and runs
+    clean on it. The original file is never modified.
 
-    #Close the table
-    tb.close()
+    Parameters
+    ----------
+    file_name : str
+        File name of the ms file to be imaged
+    path : str, optional
+        File path where the relabelled copy and image will be written.
+        Default is next to the ms file.
+    keep_view : bool, optional
+        Keep the relabelled copy after imaging. Default is to remove it.
+
+    """
+
+    #Define a variable that holds the name of the relabelled copy
+    vis_file = fake_xx_name(file_name, path)
+
+    #Make a copy of the file that shares its data but has its own
+    #Polarization table, tell CASA it is xx polarized and save the
+    #original polarization index
+    origin_pol = pol_view(file_name, vis_file, corr_type=9)
+
+    #Check to see if the polarization was already xx
+    if origin_pol == 9:
+        print ('Already xx polarized')
+    else:
+        print ('Polarization %d labelled as xx in the copy' % origin_pol)
 
     #Create a variable to hold the clean output file name
     imgname = vis_file + '.init.img'
 
     #Clean the file to create images
     #niter is set to zero so that CASA does not actually clean the file
-    clean(vis=file_name, imagename=imgname, niter=0, weighting='briggs',robust=-0.5, imsize=[512,512], cell=['250arcsec'],mode='mfs',nterms=1,spw='0:150~900')
+    try:
+        clean(vis=vis_file, imagename=imgname, niter=0, weighting='briggs',robust=-0.5, imsize=[512,512], cell=['250arcsec'],mode='mfs',nterms=1,spw='0:150~900')
+    finally:
+        #Remove the copy, this only removes the links to the original data
+        if not keep_view:
+            remove_view(vis_file)
 
-    #Put the original polariazation back in the data
-    if origin_pol[0] == 9:
-        print 'Was already xx'
-    else:
-        tb.open(pol_cell, nomodify=False)
-        tb.putcell('CORR_TYPE',0,[origin_pol[0]])
-        print 'Polarization returned'        
-        tb.close()
+
+def run_workers(file_names, workers, path=None, keep_view=False):
+    """
+
+    This function images files in a pool of CASA processes, one process
+    per file
+
+    Parameters
+    ----------
+    file_names : list
+        File names of the ms files to be imaged
+    workers : int
+        Number of CASA processes to run at once
+    path : str, optional
+        File path where the images will be written.
+        Default is next to each ms file.
+    keep_view : bool, optional
+        Keep the relabelled copies after imaging
+
+    Returns
+    -------
+    failed : list
+        File names of the ms files that could not be imaged
+
+    """
+
+    script = find_script('change_pol.py')
+
+    def image_file(file_name):
+        vis_file = fake_xx_name(file_name, path)
+        worker_args = [os.path.abspath(file_name)]
+        if path is not None:
+            worker_args += ['--path', os.path.abspath(path)]
+        if keep_view:
+            worker_args.append('--keep-view')
+        print ('Starting worker for: ' + file_name)
+        returncode, _ = run_casa(script, worker_args, cwd=os.path.dirname(vis_file),
+                                 log=vis_file + '.casa.log')
+        #CASA tasks log errors instead of raising, so check for the image too
+        ok = returncode == 0 and os.path.exists(vis_file + '.init.img.image')
+        print ('Worker ' + ('done' if ok else 'failed') + ' for: ' + file_name)
+        return ok
+
+    results = run_pool(image_file, file_names, workers)
+    return [file_name for file_name, ok in zip(file_names, results) if not ok]
 
 #Run the functions
 if __name__ == '__main__':
-    try:
-	folders = sys.argv[3:]
-        for my_file in folders:
-            change_pol(my_file)
-    except IndexError:
+    parser = argparse.ArgumentParser(description='Image cross polarization measurement sets as xx')
+    parser.add_argument('files', nargs='*', help='ms files, or directories to search for .uvfits.ms files')
+    parser.add_argument('--path', default=None, help='directory for the images (default: next to each file)')
+    parser.add_argument('--workers', type=int, default=1, help='number of files imaged at once')
+    parser.add_argument('--keep-view', action='store_true', help='keep the relabelled copies')
+    args = parser.parse_args(script_args('change_pol.py'))
+
+    #A measurement set is a directory too, so directories without a main
+    #table are searched for ms files
+    file_names = []
+    for f in args.files:
+        if os.path.isdir(f) and not os.path.exists(os.path.join(f, 'table.dat')):
+            file_names.extend(find_pol_files(f))
+        else:
+            file_names.append(f)
+
+    if not file_names:
         print ('No file specified to change the polarization')
+    elif args.workers > 1:
+        failed = run_workers(file_names, args.workers, path=args.path, keep_view=args.keep_view)
+        print ('Imaged %d of %d files' % (len(file_names) - len(failed), len(file_names)))
+        for file_name in failed:
+            print ('Failed: ' + file_name)
+    else:
+        for my_file in file_names:
+            try:
+                change_pol(my_file, path=args.path, keep_view=args.keep_view)
+            except Exception as e:
+                print ('{}: {}'.format(my_file, e))
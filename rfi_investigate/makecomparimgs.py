@@ -3,12 +3,31 @@
 # be run using CASA from the command line, and has CASA commands in it.
 #
 # Run this command using casa -c 
+#
+# casa -c makecomparimgs.py --import-workers 2 --flag-workers 2 --image-workers 4
+#
+# The dirty images can also be made without CASA from the uvfits files, with
+# every resolution made from one read of each file:
+#
+# python makecomparimgs.py --engine numpy --image-workers 16
 
 import numpy as np
-from casa import *
+try:
+	from casa import *
+except ImportError:
+	#Not needed by the numpy engine, the CASA tasks run in their own processes
+	pass
 import os
+import sys
+import argparse
 from glob import glob
 
+#The pipeline helpers live in CASA_imaging
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath([arg for arg in sys.argv if arg.endswith('makecomparimgs.py')][0])), '..', 'CASA_imaging'))
+from casa_worker import script_args
+from pipeline import Stage, Pipeline, casa_tasks
+from dirty_image import image_files
+
 #Obserations to Image
 filepath1='/data6/HERA/data/2458042'
 filepath2='/data6/HERA/data/2458140/dml_uv_files2/'
@@ -54,19 +73,52 @@ for file in range(len(file_list1)):
 
 '''
 
-#filestofinish=np.arange(0,72)
-for i,file in enumerate(file_list2):
+clean_params=dict(niter=niter, weighting=weighting, robust=robust, imsize=imsize, mode=mode, nterms=nterms, spw=spw, phasecenter=phasecenter, mask=mask)
+
+#Each step runs in its own CASA process, so file N+1 is imported while file N is cleaned.
+#The number of files each step works on at once is set on the command line.
+parser=argparse.ArgumentParser(description='Import, flag and image uvfits files for comparison images')
+parser.add_argument('--import-workers', type=int, default=1, help='number of files imported at once')
+parser.add_argument('--flag-workers', type=int, default=1, help='number of files flagged at once')
+parser.add_argument('--image-workers', type=int, default=1, help='number of files imaged at once')
+parser.add_argument('--engine', choices=['casa', 'numpy'], default='casa', help='make the images with CASA clean or with dirty_image.py')
+args=parser.parse_args(script_args('makecomparimgs.py'))
+
+def import_file(i):
 	print('Importing '+file_locations2[i])
-        importuvfits(file_locations2[i],fileout+file_list2[i]+'.ms')
-        print('Flagging '+file_list2[i]+'.ms')
-        flagdata(fileout+file_list2[i]+'.ms', autocorr=True)
-        # Note: calibration was applied in Jupyter Notebook, this line is no longer valid.
-        #print('Calibrating...'+file_list2[file]+'.ms')
-        #applycal(fileout+file_list2[file]+'.ms', gaintable=[kc,gc,bc,bc1])
-        print ('Clean 1: '+file_list2[i]+'.ms')      
-        clean(file_locations2[i]+'.ms',fileout+file_list2[i]+'.ms.img',niter=niter, weighting=weighting, robust=robust, imsize=imsize, cell=cell, mode=mode,nterms=nterms, spw=spw, phasecenter=phasecenter, mask=mask)
-        print('Clean 2: '+file_list2[i]+'.ms')
-        clean(file_locations2[i]+'.ms',fileout+file_list2[i]+'.ms.img2',niter=niter, weighting=weighting, robust=robust, imsize=imsize, cell=cell2, mode=mode,nterms=nterms, spw=spw, phasecenter=phasecenter, mask=mask)
+	casa_tasks([('importuvfits', dict(fitsfile=file_locations2[i], vis=fileout+file_list2[i]+'.ms'))], log=fileout+file_list2[i]+'.import.log')
+	return i
+
+def flag_file(i):
+	print('Flagging '+file_list2[i]+'.ms')
+	casa_tasks([('flagdata', dict(vis=fileout+file_list2[i]+'.ms', autocorr=True))], log=fileout+file_list2[i]+'.flag.log')
+	# Note: calibration was applied in Jupyter Notebook, this line is no longer valid.
+	#print('Calibrating...'+file_list2[file]+'.ms')
+	#applycal(fileout+file_list2[file]+'.ms', gaintable=[kc,gc,bc,bc1])
+	return i
+
+def image_file(i):
+	print('Clean 1 and 2: '+file_list2[i]+'.ms')
+	casa_tasks([('clean', dict(clean_params, vis=fileout+file_list2[i]+'.ms', imagename=fileout+file_list2[i]+'.ms.img', cell=cell)),
+		    ('clean', dict(clean_params, vis=fileout+file_list2[i]+'.ms', imagename=fileout+file_list2[i]+'.ms.img2', cell=cell2))],
+		   log=fileout+file_list2[i]+'.clean.log')
+	return i
+
+#filestofinish=np.arange(0,72)
+if args.engine=='numpy':
+	#niter is 0, so the dirty images are all clean makes. Both resolutions are
+	#gridded from one read of each uvfits file, with no import or flagging step
+	#(autocorrelations are dropped when the file is read).
+	results=image_files(file_locations2, path=fileout, workers=args.image_workers,
+			    resolutions=[(imsize, cell, '.img.fits'), (imsize, cell2, '.img2.fits')],
+			    spw=spw, weighting=weighting, robust=robust)
+	print('Imaged %d of %d files' % (len([r for r in results if r is not None]), len(results)))
+else:
+	pipeline=Pipeline([Stage('import', import_file, workers=args.import_workers),
+			   Stage('flag', flag_file, workers=args.flag_workers),
+			   Stage('image', image_file, workers=args.image_workers)])
+	pipeline.run(range(len(file_list2)))
+	pipeline.report()
 
 '''
 #print(file_list1)